@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+"""
+Stand-in for the external programs cziso drives (rocks, ssh, kpartx, losetup,
+fdisk, fsck, exportfs, expect, genisoimage, unzip, qemu-img, qemu-nbd, fstrim,
+tune2fs, zerofree, mount, umount, blkid, partclone, sfdisk, dd, blockdev).  The benchmark
+driver symlinks each program name to this script and puts the directory first
+on PATH.  The program to emulate is taken from argv[0].
+
+Behavior is controlled by the JSON file named in $CZISO_BENCH_CONFIG:
+
+	latency         A hash of program name to seconds to sleep per call
+	disk_size_gb    Size of generated disk images
+	partitions      Number of Linux partitions written to generated disks
+	iso_size_mb     Size of ISO files written by the fake expect/genisoimage
+	zfs_list_lines  Number of lines returned by 'zfs list'
+	state_dir       Directory for fake devices and mapping state; loop and
+	                nbd devices are published under state_dir/sys/block
+
+Every call appends '<program> <seconds slept>' to $CZISO_BENCH_LOG (default
+state_dir/latency.log) so the driver can separate injected backend latency
+from cziso overhead.
+"""
+import fcntl
+import gzip
+import json
+import os
+import re
+import shutil
+import struct
+import sys
+import time
+import zlib
+
+SECTOR = 512
+
+
+def load_config():
+	with open(os.environ["CZISO_BENCH_CONFIG"]) as f:
+		return json.load(f)
+
+
+class State:
+	"""
+	Locked JSON state shared by concurrent fake commands
+	"""
+	def __init__(self, state_dir):
+		self.path = os.path.join(state_dir, "state.json")
+		self.lock = open(os.path.join(state_dir, "state.lock"), "a")
+		self.data = None
+
+	def __enter__(self):
+		fcntl.flock(self.lock, fcntl.LOCK_EX)
+		if os.path.exists(self.path):
+			with open(self.path) as f:
+				self.data = json.load(f)
+		else:
+			self.data = {"loops": {}, "zvols": {}, "mapped": {}}
+		return self.data
+
+	def __exit__(self, *exc):
+		with open(self.path, "w") as f:
+			json.dump(self.data, f)
+		fcntl.flock(self.lock, fcntl.LOCK_UN)
+		return False
+
+
+def inject_latency(config, program):
+	seconds = float(config.get("latency", {}).get(program, 0))
+	if seconds > 0:
+		time.sleep(seconds)
+	log = open(os.environ.get("CZISO_BENCH_LOG", os.path.join(
+		config["state_dir"], "latency.log")), "a")
+	fcntl.flock(log, fcntl.LOCK_EX)
+	log.write("%s %f\n" % (program, seconds))
+	log.close()
+
+
+def make_disk(config, path, size_gb=None, size_bytes=None):
+	"""
+	Write a sparse disk image with an MBR containing Linux partitions
+	"""
+	if size_gb is None:
+		size_gb = config.get("disk_size_gb", 10)
+	size = int(size_gb) * 1024 * 1024 * 1024
+	if size_bytes is not None:
+		size = int(size_bytes)
+	nparts = min(int(config.get("partitions", 1)), 4)
+	sectors = size // SECTOR
+	part_sectors = (sectors - 2048) // max(nparts, 1)
+	part_sectors -= part_sectors % 2048
+	mbr = bytearray(SECTOR)
+	for i in range(nparts):
+		start = 2048 + i * part_sectors
+		entry = struct.pack(
+			"<B3sB3sII", 0x80 if i == 0 else 0, b"\0\0\0", 0x83, b"\0\0\0",
+			start, part_sectors)
+		mbr[446 + 16 * i:446 + 16 * (i + 1)] = entry
+	mbr[510:512] = b"\x55\xaa"
+	with open(path, "wb") as f:
+		f.write(bytes(mbr))
+		f.truncate(size)
+
+
+def read_partitions(path):
+	with open(path, "rb") as f:
+		mbr = f.read(SECTOR)
+	parts = []
+	for i in range(4):
+		entry = mbr[446 + 16 * i:446 + 16 * (i + 1)]
+		ptype = struct.unpack("<B", entry[4:5])[0]
+		start, count = struct.unpack("<II", entry[8:16])
+		if ptype != 0:
+			parts.append((i + 1, start, count, ptype))
+	return parts
+
+
+def write_file(path, size_mb):
+	with open(path, "wb") as f:
+		f.truncate(int(size_mb) * 1024 * 1024)
+
+
+def fake_rocks(config, args):
+	cmd = " ".join(args)
+	if cmd.startswith("report host attr"):
+		print("bench-host-0-0")
+	elif cmd.startswith("report nextip"):
+		print("10.1.255.254")
+	elif cmd.startswith("report host interface"):
+		print("IPADDR=10.1.1.1\nNETMASK=255.255.0.0")
+	elif cmd.startswith("add host storagemap"):
+		nas, pool, vol, host, size = args[3:8]
+		device = os.path.join(config["state_dir"], "zvol-%s-%s" % (pool, vol))
+		with State(config["state_dir"]) as state:
+			if vol not in state["zvols"]:
+				make_disk(config, device, size)
+				state["zvols"][vol] = {"pool": pool, "device": device}
+			state["mapped"][vol] = device
+		print("Mapping %s/%s to %s" % (pool, vol, host))
+		print(device)
+	elif cmd.startswith("remove host storagemap"):
+		with State(config["state_dir"]) as state:
+			state["mapped"].pop(args[4], None)
+	elif cmd.startswith("remove host storageimg"):
+		with State(config["state_dir"]) as state:
+			zvol = state["zvols"].pop(args[5], None)
+			if zvol and os.path.exists(zvol["device"]):
+				os.remove(zvol["device"])
+	elif cmd.startswith("list host storagemap"):
+		print("ZVOL ZPOOL LUN REMOTE_HOST STATUS TIME")
+		with State(config["state_dir"]) as state:
+			for vol, zvol in state["zvols"].items():
+				status = "mapped" if vol in state["mapped"] else "unmapped"
+				print("%s %s lun0 bench-host-0-0 %s -" % (
+					vol, zvol["pool"], status))
+	return 0
+
+
+def fake_ssh(config, args):
+	cmd = args[1:]
+	if len(cmd) == 1:
+		cmd = cmd[0].split()
+	if cmd[:2] == ["zfs", "create"]:
+		pool, vol = cmd[-1].split("/", 1)
+		device = os.path.join(config["state_dir"], "zvol-%s-%s" % (pool, vol))
+		with State(config["state_dir"]) as state:
+			if vol in state["zvols"]:
+				sys.stderr.write("cannot create '%s': dataset already exists\n"
+					% cmd[-1])
+				return 1
+			make_disk(config, device, size_bytes=cmd[cmd.index("-V") + 1])
+			state["zvols"][vol] = {"pool": pool, "device": device}
+	elif cmd[:2] == ["zfs", "destroy"]:
+		pass
+	elif cmd[:2] == ["zfs", "get"]:
+		if "guid" in cmd:
+			print("9876543210")
+		print("0")
+	elif cmd[:2] == ["zfs", "list"]:
+		if len(cmd) == 3:
+			pool, vol = cmd[2].split("/", 1)
+			with State(config["state_dir"]) as state:
+				return 0 if vol in state["zvols"] else 1
+		print("NAME ORIGIN")
+		for i in range(int(config.get("zfs_list_lines", 100))):
+			print("tank/vm-%05d -" % i)
+	return 0
+
+
+def sys_block(config, device):
+	return os.path.join(
+		config["state_dir"], "sys", "block", os.path.basename(device))
+
+
+def fake_kpartx(config, args):
+	image = args[-1]
+	with State(config["state_dir"]) as state:
+		if args[0] == "-a":
+			for loop, backing in state["loops"].items():
+				if backing == image:
+					return 0
+			i = 0
+			while "/dev/loop%i" % i in state["loops"]:
+				i += 1
+			loop = "/dev/loop%i" % i
+			state["loops"][loop] = image
+			loop_dir = os.path.join(sys_block(config, loop), "loop")
+			if not os.path.exists(loop_dir):
+				os.makedirs(loop_dir)
+			with open(os.path.join(loop_dir, "backing_file"), "w") as f:
+				f.write("%s\n" % os.path.realpath(image))
+		elif args[0] == "-d":
+			for loop, backing in list(state["loops"].items()):
+				if backing == image:
+					del state["loops"][loop]
+					os.remove(os.path.join(
+						sys_block(config, loop), "loop", "backing_file"))
+	return 0
+
+
+def fake_qemu_nbd(config, args):
+	if args[0].startswith("--connect="):
+		pid_file = os.path.join(
+			sys_block(config, args[0].split("=", 1)[1]), "pid")
+		if os.path.exists(pid_file):
+			sys.stderr.write("qemu-nbd: device is busy\n")
+			return 1
+		with open(pid_file, "w") as f:
+			f.write("%i\n" % os.getpid())
+	elif args[0] == "--disconnect":
+		pid_file = os.path.join(sys_block(config, args[1]), "pid")
+		if os.path.exists(pid_file):
+			os.remove(pid_file)
+	return 0
+
+
+def fake_losetup(config, args):
+	with State(config["state_dir"]) as state:
+		for loop, backing in sorted(state["loops"].items()):
+			print("%s: [2049]:1234 (%s)" % (loop, backing))
+	return 0
+
+
+def fake_fdisk(config, args):
+	device = args[-1]
+	path = device
+	with State(config["state_dir"]) as state:
+		path = state["loops"].get(device, device)
+	if not os.path.exists(path):
+		sys.stderr.write("fdisk: cannot open %s\n" % device)
+		return 1
+	size = os.path.getsize(path)
+	print("Disk %s: %.1f GB, %i bytes" % (device, size / 1e9, size))
+	print("255 heads, 63 sectors/track, %i cylinders" % (size // 8225280))
+	print("")
+	print("   Device Boot      Start         End      Blocks   Id  System")
+	for number, start, count, ptype in read_partitions(path):
+		print("%sp%i   *   %10i  %10i  %10i   %x  Linux" % (
+			device, number, start, start + count - 1, count // 2, ptype))
+	return 0
+
+
+def fake_expect(config, args):
+	with open(args[-1]) as f:
+		script = f.read()
+	vm_name = re.search(r"virsh console (\S+)", script)
+	nfs = re.search(r"mount \S+:(\S+) /home/partimag", script)
+	scratch = re.search(r"mount /dev/(\S+) /home/partimag", script)
+	iso_dir = None
+	if nfs:
+		iso_dir = nfs.group(1)
+	elif scratch and vm_name:
+		# write to the files backing the scratch disk in the domain XML
+		xml = update_domain(config, vm_name.group(1))["xml"]
+		source = re.search(r"<source file='([^']+)'/>\s*<target dev='%s'" % (
+			scratch.group(1)), xml)
+		iso_dir = scratch_dir(source.group(1))
+	jobs = re.search(r"foreach job \{(.*)\} \{", script)
+	if iso_dir and jobs:
+		for disk, vm_id in re.findall(r"\{(\S+) (\S+)\}", jobs.group(1)):
+			iso = os.path.join(iso_dir, "clonezilla-live-%s.iso" % vm_id)
+			write_file(iso, config.get("iso_size_mb", 1))
+	# guests that confirm the Clonezilla shutdown prompt power off at the end
+	if vm_name and "press ENTER to continue" in script:
+		update_domain(config, vm_name.group(1), power_off=True)
+	return 0
+
+
+def update_domain(config, name, power_off=False):
+	"""
+	Get a fake libvirt domain and optionally power it off like a guest
+	shutting itself down, logging the lifecycle event for the fake libvirt
+	"""
+	path = os.path.join(config["state_dir"], "libvirt.json")
+	lock = open("%s.lock" % path, "a")
+	fcntl.flock(lock, fcntl.LOCK_EX)
+	try:
+		with open(path) as f:
+			domains = json.load(f)
+		if power_off:
+			# VIR_DOMAIN_SHUTOFF
+			domains[name]["state"] = 5
+			with open(path, "w") as f:
+				json.dump(domains, f)
+			# VIR_DOMAIN_EVENT_STOPPED with detail SHUTDOWN
+			with open(os.path.join(
+				config["state_dir"], "libvirt-events.log"), "a") as f:
+				f.write("%s\n" % json.dumps([name, 5, 0]))
+		return domains[name]
+	finally:
+		lock.close()
+
+
+def scratch_dir(path):
+	"""
+	Get the directory holding the files of a fake filesystem image
+	"""
+	return "%s.files" % path
+
+
+def fake_mkfs(config, args):
+	path = scratch_dir(args[-1])
+	if os.path.exists(path):
+		shutil.rmtree(path)
+	os.mkdir(path)
+	return 0
+
+
+def fake_genisoimage(config, args):
+	write_file(args[args.index("-o") + 1], config.get("iso_size_mb", 1))
+	return 0
+
+
+def write_live_tree(live_dir):
+	"""
+	Write the parts of a Clonezilla Live tree that cziso edits
+	"""
+	syslinux = os.path.join(live_dir, "syslinux")
+	os.makedirs(syslinux)
+	with open(os.path.join(syslinux, "isolinux.cfg"), "w") as f:
+		f.write("label live\n  append locales= keyboard-layouts= "
+			"ocs_live_run=\"ocs-live-general\" ip= quiet\ntimeout 300\n")
+
+
+def fake_unzip(config, args):
+	write_live_tree(args[args.index("-d") + 1])
+	return 0
+
+
+def write_clonezilla_image(config, image_dir):
+	"""
+	Write a Clonezilla image directory with one ext4 partition
+	"""
+	os.makedirs(image_dir)
+	sectors = int(config.get("disk_size_gb", 10)) * 1024 * 1024 * 1024 // SECTOR
+	files = {
+		"disk": "vda\n",
+		"parts": "vda1\n",
+		"vda-pt.sf": "label: dos\ndevice: /dev/vda\nunit: sectors\n\n"
+			"/dev/vda1 : start=2048, size=%i, type=83\n" % (sectors - 2048),
+		"vda-pt.parted": "Disk /dev/vda: %is\n" % sectors,
+		"vda-mbr": "\0" * SECTOR,
+	}
+	for filename, content in files.items():
+		with open(os.path.join(image_dir, filename), "w") as f:
+			f.write(content)
+	volume = os.path.join(image_dir, "vda1.ext4-ptcl-img.gz.aa")
+	with gzip.open(volume, "wb") as f:
+		f.write(b"partclone-image" * 4096)
+
+
+def fake_mount(config, args):
+	if "-o" in args and os.path.isdir(scratch_dir(args[-2])):
+		# a filesystem image made by mkfs
+		for name in os.listdir(scratch_dir(args[-2])):
+			shutil.copy(os.path.join(scratch_dir(args[-2]), name), args[-1])
+		with State(config["state_dir"]) as state:
+			state.setdefault("iso_mounts", []).append(args[-1])
+	elif "-o" in args and "loop" in args[args.index("-o") + 1]:
+		write_live_tree(args[-1])
+		write_clonezilla_image(
+			config, os.path.join(args[-1], "home", "partimag", "bench"))
+		with State(config["state_dir"]) as state:
+			state.setdefault("iso_mounts", []).append(args[-1])
+	return 0
+
+
+def fake_umount(config, args):
+	with State(config["state_dir"]) as state:
+		mounts = state.setdefault("iso_mounts", [])
+		if args[-1] not in mounts:
+			return 0
+		mounts.remove(args[-1])
+	for name in os.listdir(args[-1]):
+		path = os.path.join(args[-1], name)
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		else:
+			os.remove(path)
+	return 0
+
+
+def fake_blkid(config, args):
+	print("DEVNAME=%s\nUUID=0f3c2d4e-1111-2222-3333-444455556666\nTYPE=ext4"
+		% args[-1])
+	return 0
+
+
+def fake_partclone(config, args):
+	if "-o" in args and args[args.index("-o") + 1] != "-":
+		# restore: consume the image stream
+		stream = getattr(sys.stdin, "buffer", sys.stdin)
+		while stream.read(65536):
+			pass
+		return 0
+	out = getattr(sys.stdout, "buffer", sys.stdout)
+	out.write(b"partclone-image" * 4096)
+	return 0
+
+
+def fake_sfdisk(config, args):
+	device = args[-1]
+	print("label: dos\nlabel-id: 0x12345678\ndevice: %s\nunit: sectors\n" %
+		device)
+	with State(config["state_dir"]) as state:
+		path = state["loops"].get(device, device)
+	if os.path.exists(path):
+		for number, start, count, ptype in read_partitions(path):
+			print("%sp%i : start=%12i, size=%12i, type=%x" % (
+				device, number, start, count, ptype))
+	return 0
+
+
+def fake_qemu_img(config, args):
+	if args[0] == "create":
+		if args[-1].endswith("G"):
+			make_disk(config, args[-2], args[-1].rstrip("G"))
+		else:
+			make_disk(config, args[-2], size_bytes=args[-1])
+	return 0
+
+
+def fake_fstrim(config, args):
+	print("%s: 1 GiB (1073741824 bytes) trimmed" % args[-1])
+	return 0
+
+
+def fake_tune2fs(config, args):
+	print("Block count:              262144")
+	print("Block size:               4096")
+	return 0
+
+
+def fake_zerofree(config, args):
+	print("65536/131072/262144")
+	return 0
+
+
+def fake_pigz(config, args):
+	stdin = getattr(sys.stdin, "buffer", sys.stdin)
+	stdout = getattr(sys.stdout, "buffer", sys.stdout)
+	# gzip framing; GzipFile cannot read from a pipe on Python 2
+	if [a for a in args if a.startswith("-d")]:
+		z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		data = stdin.read(65536)
+		while data:
+			stdout.write(z.decompress(data))
+			data = stdin.read(65536)
+	else:
+		z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		data = stdin.read(65536)
+		while data:
+			stdout.write(z.compress(data))
+			data = stdin.read(65536)
+	stdout.write(z.flush())
+	return 0
+
+
+def fake_success(config, args):
+	return 0
+
+
+FAKES = {
+	"rocks": fake_rocks,
+	"ssh": fake_ssh,
+	"kpartx": fake_kpartx,
+	"losetup": fake_losetup,
+	"fdisk": fake_fdisk,
+	"fsck": fake_success,
+	"exportfs": fake_success,
+	"expect": fake_expect,
+	"genisoimage": fake_genisoimage,
+	"unzip": fake_unzip,
+	"qemu-img": fake_qemu_img,
+	"qemu-nbd": fake_qemu_nbd,
+	"fstrim": fake_fstrim,
+	"mkfs.ext4": fake_mkfs,
+	"mount": fake_mount,
+	"umount": fake_umount,
+	"blkid": fake_blkid,
+	"partclone.ext4": fake_partclone,
+	"partclone.dd": fake_partclone,
+	"partclone.restore": fake_partclone,
+	"sfdisk": fake_sfdisk,
+	"tune2fs": fake_tune2fs,
+	"zerofree": fake_zerofree,
+	"pigz": fake_pigz,
+}
+
+
+def main():
+	program = os.path.basename(sys.argv[0])
+	config = load_config()
+	inject_latency(config, program)
+	fake = FAKES.get(program, fake_success)
+	return fake(config, sys.argv[1:])
+
+
+if __name__ == "__main__":
+	sys.exit(main())
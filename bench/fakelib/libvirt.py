@@ -0,0 +1,250 @@
+"""
+Stand-in for the libvirt Python bindings used by cziso.virtualmachine.  The
+benchmark driver puts this directory first on sys.path.  Domain start/stop
+and disk hot-plug sleep for the 'libvirt_create', 'libvirt_destroy' and
+'libvirt_attach' latencies in the $CZISO_BENCH_CONFIG file and log them to
+state_dir/latency.log.  Domains are kept in state_dir/libvirt.json so that
+they are shared by all bench processes like a real libvirtd.  Every state
+change appends a lifecycle event to state_dir/libvirt-events.log and the
+default event implementation dispatches the events appended since the
+callbacks were registered, so quick transitions are not lost.
+"""
+import atexit
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+_open = open
+
+VIR_DOMAIN_NOSTATE = 0
+VIR_DOMAIN_RUNNING = 1
+VIR_DOMAIN_BLOCKED = 2
+VIR_DOMAIN_PAUSED = 3
+VIR_DOMAIN_SHUTDOWN = 4
+VIR_DOMAIN_SHUTOFF = 5
+VIR_DOMAIN_CRASHED = 6
+
+VIR_DOMAIN_AFFECT_LIVE = 1
+
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_DEFINED = 0
+VIR_DOMAIN_EVENT_UNDEFINED = 1
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_SUSPENDED = 3
+VIR_DOMAIN_EVENT_RESUMED = 4
+VIR_DOMAIN_EVENT_STOPPED = 5
+VIR_DOMAIN_EVENT_SHUTDOWN = 6
+VIR_DOMAIN_EVENT_PMSUSPENDED = 7
+VIR_DOMAIN_EVENT_CRASHED = 8
+
+VIR_DOMAIN_EVENT_STOPPED_SHUTDOWN = 0
+VIR_DOMAIN_EVENT_STOPPED_DESTROYED = 1
+VIR_DOMAIN_EVENT_STOPPED_CRASHED = 2
+VIR_DOMAIN_EVENT_STOPPED_FAILED = 5
+
+# (connection, callback, opaque) registered for lifecycle events
+_callbacks = []
+# offset in the event log of the next event to dispatch
+_event_offset = []
+# stop dispatching before the interpreter clears module globals at exit
+_dispatch_lock = threading.Lock()
+_stopping = []
+
+
+class libvirtError(Exception):
+	pass
+
+
+def _config():
+	with _open(os.environ["CZISO_BENCH_CONFIG"]) as f:
+		return json.load(f)
+
+
+def _inject_latency(name):
+	config = _config()
+	seconds = float(config.get("latency", {}).get(name, 0))
+	if seconds > 0:
+		time.sleep(seconds)
+	log = _open(os.environ.get("CZISO_BENCH_LOG", os.path.join(
+		config["state_dir"], "latency.log")), "a")
+	fcntl.flock(log, fcntl.LOCK_EX)
+	log.write("%s %f\n" % (name, seconds))
+	log.close()
+
+
+def _events_path():
+	return os.path.join(_config()["state_dir"], "libvirt-events.log")
+
+
+def _emit(name, event, detail=0):
+	"""
+	Append a lifecycle event for all bench processes; called while holding
+	the domain lock so that events are logged in the order of the changes
+	"""
+	with _open(_events_path(), "a") as f:
+		f.write("%s\n" % json.dumps([name, event, detail]))
+
+
+def _update_domains(function):
+	"""
+	Read, modify and write the domains shared by all bench processes
+	"""
+	path = os.path.join(_config()["state_dir"], "libvirt.json")
+	lock = _open("%s.lock" % path, "a")
+	# the event thread may hold the lock while the main thread forks commands
+	fcntl.fcntl(lock, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+	fcntl.flock(lock, fcntl.LOCK_EX)
+	try:
+		domains = {}
+		if os.path.exists(path):
+			with _open(path) as f:
+				domains = json.load(f)
+		result = function(domains)
+		with _open(path, "w") as f:
+			json.dump(domains, f)
+		return result
+	finally:
+		lock.close()
+
+
+class virDomain:
+	def __init__(self, conn, name):
+		self.conn = conn
+		self._name = name
+
+	def _set(self, key, value, event=None, detail=0):
+		def update(domains):
+			domains[self._name][key] = value
+			if event is not None:
+				_emit(self._name, event, detail)
+		_update_domains(update)
+
+	def _get(self, key):
+		domains = _update_domains(lambda d: d)
+		if self._name not in domains:
+			raise libvirtError("Domain not found: %s" % self._name)
+		return domains[self._name][key]
+
+	def name(self):
+		return self._name
+
+	def create(self):
+		_inject_latency("libvirt_create")
+		self._set("state", VIR_DOMAIN_RUNNING, VIR_DOMAIN_EVENT_STARTED)
+		return 0
+
+	def destroy(self):
+		_inject_latency("libvirt_destroy")
+		self._set("state", VIR_DOMAIN_SHUTOFF, VIR_DOMAIN_EVENT_STOPPED,
+			VIR_DOMAIN_EVENT_STOPPED_DESTROYED)
+		return 0
+
+	def undefine(self):
+		def remove(domains):
+			if domains.pop(self._name, None) is not None:
+				_emit(self._name, VIR_DOMAIN_EVENT_UNDEFINED)
+		_update_domains(remove)
+		return 0
+
+	def info(self):
+		return [self._get("state"), 1048576, 1048576, 1, 0]
+
+	def attachDeviceFlags(self, xml, flags=0):
+		_inject_latency("libvirt_attach")
+		self._set("xml", self._get("xml").replace(
+			"</devices>", "%s\n</devices>" % xml))
+		return 0
+
+	def detachDeviceFlags(self, xml, flags=0):
+		_inject_latency("libvirt_attach")
+		self._set("xml", self._get("xml").replace("%s\n" % xml, ""))
+		return 0
+
+	def XMLDesc(self, flags=0):
+		return self._get("xml").replace("port='-1'", "port='5900'")
+
+
+class virConnect:
+	def __init__(self, uri):
+		self.uri = uri
+
+	def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+		if not _event_offset:
+			# like libvirtd, only events after registering are delivered
+			path = _events_path()
+			_event_offset.append(
+				os.path.getsize(path) if os.path.exists(path) else 0)
+		_callbacks.append((self, cb, opaque))
+		return len(_callbacks) - 1
+
+	def isAlive(self):
+		return 1
+
+	def defineXML(self, xml):
+		name = re.search("<name>(.*)</name>", xml).group(1)
+
+		def define(domains):
+			domains[name] = {"xml": xml, "state": VIR_DOMAIN_SHUTOFF}
+			_emit(name, VIR_DOMAIN_EVENT_DEFINED)
+		_update_domains(define)
+		return virDomain(self, name)
+
+	def lookupByName(self, name):
+		if name not in _update_domains(lambda d: d):
+			raise libvirtError("Domain not found: %s" % name)
+		return virDomain(self, name)
+
+	def close(self):
+		return 0
+
+
+def open(uri):
+	return virConnect(uri)
+
+
+def virEventRegisterDefaultImpl():
+	return 0
+
+
+def virEventRunDefaultImpl(_sleep=time.sleep, _lock=_dispatch_lock,
+                           _stopping=_stopping):
+	# bound as defaults since module globals are cleared at interpreter exit
+	_sleep(0.05)
+	_lock.acquire()
+	if _stopping:
+		_lock.release()
+		# park the event thread like the blocking C implementation
+		while 1:
+			_sleep(60)
+	try:
+		_dispatch_events()
+	finally:
+		_lock.release()
+	return 0
+
+
+def _stop_events():
+	_dispatch_lock.acquire()
+	_stopping.append(True)
+	_dispatch_lock.release()
+
+
+atexit.register(_stop_events)
+
+
+def _dispatch_events():
+	if not _event_offset or not os.path.exists(_events_path()):
+		return
+	with _open(_events_path()) as f:
+		f.seek(_event_offset[0])
+		data = f.read()
+	# skip a partly written last line until the next round
+	data = data[:data.rfind("\n") + 1]
+	_event_offset[0] += len(data)
+	for line in data.splitlines():
+		name, event, detail = json.loads(line)
+		for conn, cb, opaque in list(_callbacks):
+			cb(conn, virDomain(conn, name), event, detail, opaque)
@@ -1,19 +1,32 @@
 import ConfigParser
 import cookielib
 import datetime
+import errno
 import logging
 import os
+import Queue
 import re
 import shlex
 import string
 import sys
 import subprocess
+import threading
+import time
 import urllib2
 
 
 logger = None
 
-__all__ = ["clonezilla", "gdrive", "image", "virtualmachine"]
+__all__ = [
+	"clonezilla", "czimage", "gdrive", "image", "partition", "profiling",
+	"qcow2", "replay", "virtualmachine"]
+
+# wall-clock time spent waiting on external commands (see record_command_time)
+command_stats = {}
+command_stats_lock = threading.Lock()
+
+# if set, external commands are sent here instead (see cziso.replay)
+command_backend = None
 
 
 def abort(error):
@@ -39,6 +52,36 @@ def abort_if_no_x():
 	in with -Y to forward X display""")
 
 
+def call_command(cmdline):
+	"""
+	Run an interactive command (e.g., an expect script) in a shell with its
+	output going straight to the terminal.
+
+	:param cmdline: A string containing the Bash command to run
+
+	:return: The exit code of the command
+	"""
+	logger.debug("Executing interactive command: '%s'" % cmdline)
+	start = time.time()
+	if command_backend is not None:
+		rc = command_backend.call(cmdline, _call)
+	else:
+		rc = _call(cmdline)
+	record_command_time(cmdline, time.time() - start)
+	return rc
+
+
+def _call(cmdline):
+	"""
+	Run an interactive command in a shell
+
+	:param cmdline: A string containing the Bash command to run
+
+	:return: The exit code of the command
+	"""
+	return subprocess.call(cmdline, shell=True)
+
+
 def config_logging(loglevel="INFO", logfile=None):
 	"""
 	Configure the logger for calling program.  If logfile is None, messages
@@ -97,7 +140,7 @@ def file_edit(file_path, substitutions):
 	for line in old_f:
 		for search_string, replace_string in substitutions.items():
 			found_index = line.find(search_string)
-			if found_index > 0:
+			if found_index >= 0:
 				line = line.replace(search_string, replace_string)
 		new_f.write(line)
 	old_f.close()
@@ -137,6 +180,21 @@ def fill_template(template_file, tmp_dir=None, **kwargs):
 	return expect_path
 
 
+def find_executable(name):
+	"""
+	Find a program on the PATH
+
+	:param name: A string containing the program name
+
+	:return: A string containing the path to the program or None if not found
+	"""
+	for path_dir in os.environ.get("PATH", "").split(os.pathsep):
+		path = os.path.join(path_dir, name)
+		if os.path.isfile(path) and os.access(path, os.X_OK):
+			return path
+	return None
+
+
 def gdrive_download(google_id, lpath):
 	"""
 	Download a file from Google drive using cookie trick from Phil
@@ -212,32 +270,38 @@ def get_current_time_string():
 	return str(now)
 
 
-def get_free_ip(iface):
+def get_netmask(iface):
 	"""
-	Find a free unused IP address using Rocks commands.
+	Get the netmask of a local interface from Rocks
 
-	:param iface: The interface to find the IP address for
+	:param iface: The interface to get the netmask of
 
-	:return: A tuple containing the free ip and netmask.
+	:return: A string containing the netmask or None on error
 	"""
-	free_ip = None
-	out, rc = run_command("rocks report nextip private")
-	if rc != 0 and len(out) > 0:
-		logger.error("Unable to get a free ip address from Rocks")
-		return None, None
-	free_ip = out[0]
-
 	out, rc = run_command("rocks report host interface localhost iface=%s" % iface)
 	if rc != 0 and len(out) > 0:
 		logger.error(out)
 		logger.error("Unable to get netmask from Rocks")
-		return None, None
+		return None
 	matcher = re.search("NETMASK=(\S+)", " ".join(out))
 	if matcher is None:
 		logger.error("Unable to parse netmask from Rocks command")
-		return None, None
-	netmask = matcher.group(1)
-	return free_ip, netmask
+		return None
+	return matcher.group(1)
+
+
+def get_next_ip():
+	"""
+	Get the IP address Rocks will assign to the next host on the private
+	network
+
+	:return: A string containing the IP address or None on error
+	"""
+	out, rc = run_command("rocks report nextip private")
+	if rc != 0 and len(out) > 0:
+		logger.error("Unable to get a free ip address from Rocks")
+		return None
+	return out[0]
 
 
 def get_command(args):
@@ -280,6 +344,42 @@ def increment_filename(filename):
 		i += 1
 
 
+def is_process_alive(pid):
+	"""
+	Check whether a process is still running
+
+	:param pid: An integer containing the process id
+
+	:return: True if running; otherwise False
+	"""
+	try:
+		os.kill(pid, 0)
+	except OSError as e:
+		return e.errno == errno.EPERM
+	return True
+
+
+def record_command_time(cmdline, seconds):
+	"""
+	Add the wall-clock time spent waiting on an external command to the
+	per-program totals in command_stats.  Safe to call from multiple threads.
+
+	:param cmdline: A string or list containing the command that was run
+	:param seconds: A float containing the time spent waiting on the command
+
+	:return:
+	"""
+	if isinstance(cmdline, basestring):
+		cmdline = cmdline.split()
+	program = os.path.basename(cmdline[0]) if cmdline else "?"
+	command_stats_lock.acquire()
+	try:
+		count, total = command_stats.get(program, (0, 0.0))
+		command_stats[program] = (count + 1, total + seconds)
+	finally:
+		command_stats_lock.release()
+
+
 def remove_nfs_export(dir, ip):
 	"""
 	Un-export NFS directory.  Returns if successful; otherwise aborts.
@@ -294,6 +394,57 @@ def remove_nfs_export(dir, ip):
 		abort("Unable to remove un-export temp directory")
 
 
+def run_parallel(function, items, max_threads, cancel_on_failure=True):
+	"""
+	Call function on each item using a bounded pool of threads.  The function
+	should return True on success.  A call that raises (including SystemExit
+	from abort) fails.  After the first failure, items that have not been
+	started yet are cancelled unless cancel_on_failure is False; calls
+	already running are allowed to finish.
+
+	:param function: A function taking a single item and returning a boolean
+	:param items: A list of items to pass to function
+	:param max_threads: An integer containing the max number of threads
+	:param cancel_on_failure: False to process every item even after a
+	failure
+
+	:return: A list containing the result for each item in order (True,
+	False, or None if the item was cancelled)
+	"""
+	results = [None] * len(items)
+	work = Queue.Queue()
+	for i, item in enumerate(items):
+		work.put((i, item))
+	failed = threading.Event()
+
+	def worker():
+		while not failed.is_set():
+			try:
+				i, item = work.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				results[i] = bool(function(item))
+			except SystemExit:
+				# abort already logged the error
+				results[i] = False
+			except BaseException as e:
+				logger.exception("Error processing %s: %s" % (item, str(e)))
+				results[i] = False
+			if not results[i] and cancel_on_failure:
+				failed.set()
+
+	threads = []
+	for i in range(max(1, min(max_threads, len(items)))):
+		thread = threading.Thread(target=worker)
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		thread.join()
+	return results
+
+
 def run_command(cmdline, input_string=None):
 	"""
 	Run popen pipe inputString and return a tuple of
@@ -310,6 +461,37 @@ def run_command(cmdline, input_string=None):
 	if isinstance(cmdline, str):
 		# needs to make a list
 		cmdline = shlex.split(cmdline)
+	start = time.time()
+	if command_backend is not None:
+		out, rc = command_backend.run(cmdline, input_string, _run)
+	else:
+		out, rc = _run(cmdline, input_string)
+	record_command_time(cmdline, time.time() - start)
+	return out, rc
+
+
+def run_pipeline(cmdlines):
+	"""
+	Run Bash commands connected by pipes.  Fails if any of the commands fail
+	rather than only the last one.
+
+	:param cmdlines: A list of strings containing the Bash commands to pipe
+	together
+
+	:return The stderr of the commands as a string array and exit code
+	"""
+	return run_command(["bash", "-o", "pipefail", "-c", " | ".join(cmdlines)])
+
+
+def _run(cmdline, input_string=None):
+	"""
+	Run command and return its combined stdout and stderr
+
+	:param cmdline A string array containing the command and its args
+	:param input_string A string containing input for command
+
+	:return The stdout as a string array and exit code
+	"""
 	p = subprocess.Popen(
 		cmdline, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
 		stderr=subprocess.STDOUT)
@@ -335,6 +517,21 @@ class CzisoConfig(ConfigParser.RawConfigParser):
 		self.config_file = os.path.join(config_dir, config_file)
 		self.logger = logging.getLogger(self.__module__)
 
+	def get_default(self, section, var, default):
+		"""
+		Get a variable from the config file or a default value if the
+		variable is not set (e.g., in config files from older releases)
+
+		:param section:  The section header to read variables from.
+		:param var: A string containing the variable to read from section
+		:param default: The value to return if the variable is not set
+
+		:return: A string containing the value or the default value
+		"""
+		if self.has_option(section, var):
+			return self.get(section, var)
+		return default
+
 	def get_path(self, section, var):
 		"""
 		Get a path from the config file.  If relative, it is assumed to be
@@ -1,15 +1,33 @@
 import cziso
+import cziso.czimage
+import cziso.files
+import cziso.image
+import cziso.network
 import cziso.virtualmachine
+import cziso.vmpool
+import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
-import subprocess
+import tempfile
 import time
 
 
 class Clonezilla:
 	CREATE_ISO_EXPECT = "create-iso.expect"
+	ENGINES = ["vm", "host"]
+	TRANSPORTS = ["nfs", "disk"]
+	SCRATCH_FILENAME = "scratch.img"
+	# boot options that restore the image saved by the host engine
+	HOST_RESTORE_RUN = (
+		"ocs_live_run=\"ocs-sr -g auto -e1 auto -e2 -batch -r -j2 -k1 "
+		"-p poweroff restoredisk %(image)s %(disk)s\" ocs_live_batch=\"yes\" "
+		"ocs_prerun=\"mount --bind %(medium)s/home/partimag /home/partimag\" "
+		"ocs_live_run_tty=/dev/ttyS0")
+	METADATA_SUFFIX = ".json"
+	METADATA_VERSION = 1
 	CUSTOMIZATIONS = {
 		"locales= ": "locales=en_US.UTF-8 ",
 		"keyboard-layouts= ": "keyboard-layouts=us ",
@@ -18,99 +36,358 @@ class Clonezilla:
 		"timeout 300": "timeout 1"
 	}
 
-	def __init__(self, config):
+	def __init__(self, config, vm_profile=None):
+		"""
+		Create a Clonezilla object
+
+		:param config: An object of type cziso.CzisoConfig
+		:param vm_profile: A string containing the name of the VM profile to
+		use for every VM or None to use the profile configured per purpose
+		(e.g., create_vm_profile)
+		"""
 		self.config = config
+		self.vm_profile = vm_profile
 		self.clonezilla_custom = ClonezillaIso(config, "custom")
 		self.clonezilla_regular = ClonezillaIso(config, "regular")
 		self.create_expect = config.get_path("cziso", "create_expect_template")
 		self.restore_expect = config.get_path(
 			"cziso", "restore_expect_template")
+		self.pool_create_expect = os.path.join(config.config_dir,
+			config.get_default(
+				"cziso", "pool_create_expect_template", "pool-create-iso.expect"))
+		self.pool_restore_expect = os.path.join(config.config_dir,
+			config.get_default(
+				"cziso", "pool_restore_expect_template", "pool-restore-iso.expect"))
+		self.copy_expect = os.path.join(config.config_dir, config.get_default(
+			"cziso", "copy_expect_template", "copy-disk.expect"))
 		self.priv_interface = config.get("cziso", "private_iface")
 		self.temp_dir = config.get("cziso", "temp_directory")
 		self.genisoimage_command = config.get("cziso", "genisoimage_command")
+		self.max_fsck_jobs = int(config.get_default("cziso", "max_fsck_jobs", 4))
+		self.max_vcpus = int(config.get_default("cziso", "max_vcpus", 4))
+		self.shutdown_timeout = int(
+			config.get_default("cziso", "vm_shutdown_timeout", 600))
+		self.test_expect = os.path.join(config.config_dir, config.get_default(
+			"cziso", "test_expect_template", "test-boot.expect"))
+		self.test_boot_pattern = config.get_default(
+			"cziso", "test_boot_pattern", "login:")
+		self.test_boot_timeout = int(
+			config.get_default("cziso", "test_boot_timeout", 600))
+		self.max_test_jobs = int(config.get_default("cziso", "max_test_jobs", 4))
+		self.fsck_cache = cziso.image.FsckCache(self.temp_dir)
+		self.live_media_dir = config.get_default(
+			"cziso", "live_media_dir", "/run/live/medium")
+		self.vm_pool = cziso.vmpool.VMPool(self)
+		self.ip_leases = cziso.network.IpLeases(config, self.priv_interface)
+		self.file_mover = cziso.files.FileMover(
+			config.get_default("cziso", "iso_checksum", "sha256"))
 
 		self.logger = logging.getLogger(self.__module__)
 		self.unique_id = "%s-%d" % (time.strftime('%Y%m%d'), os.getpid())
 
-	def convert_to_clonezilla_iso(self, image, out_dir, network):
+	def convert_to_clonezilla_iso(self, image, out_dir, network,
+	                              force_fsck=False, trim="none", engine="vm",
+	                              compressor="pigz", level=None,
+	                              transport="nfs"):
 		"""
-		Create a Clonezilla ISO file from specified image
-
-		:param image:  Path to raw image file to convert
-		:param ip: IP address to use for Clonezilla VM (default: from Rocks)
-		:param netmask: Netmask to use for Clonezilla VM (default: from Rocks)
+		Create a Clonezilla ISO file from specified image.  A list of images
+		is converted in one Clonezilla Live VM with one NFS export and IP.
+
+		:param image:  An object of type Image or a list of them to convert
+		:param network: A string containing <ip>:<netmask> for the Clonezilla
+		VM or None to lease a free IP from the configured range
+		:param force_fsck: Run fsck even if image is unchanged since its last
+		successful fsck
+		:param trim: A string containing the method used to release free
+		filesystem space after fsck (none, fstrim or zerofree)
+		:param engine: A string containing where to save the image partitions;
+		'vm' runs gen-rec-iso in a Clonezilla Live VM and 'host' runs
+		partclone directly on the host
+		:param compressor: A string containing the program used to compress
+		the partition images (none, gzip, pigz, lz4 or zstd)
+		:param level: A string containing the compression level or None for
+		the compressor default
+		:param transport: A string containing how the Clonezilla Live VM
+		writes the ISOs back; 'nfs' mounts the NFS exported temp directory and
+		'disk' mounts a scratch disk that is read on the host afterwards
 
 		:return:  Returns if successful; otherwise aborts
 		"""
-		if not image.exists():
-			cziso.abort("Image file %s does not exist" % image)
+		images = image
+		if not isinstance(images, list):
+			images = [images]
+		for image in images:
+			if not image.exists():
+				cziso.abort("Image file %s does not exist" % image)
+		image_ids = [image.get_image_id() for image in images]
+		if len(set(image_ids)) != len(image_ids):
+			cziso.abort("Images in a batch must have unique names")
 		if out_dir is not None and not os.path.exists(out_dir):
 			cziso.abort("Output directory %s does not exist" % out_dir)
-		self.logger.info("Converting image %s to iso" % image)
+		if engine not in Clonezilla.ENGINES:
+			cziso.abort("Unknown engine %s; use one of %s" % (
+				engine, ", ".join(Clonezilla.ENGINES)))
+		if transport not in Clonezilla.TRANSPORTS:
+			cziso.abort("Unknown transport %s; use one of %s" % (
+				transport, ", ".join(Clonezilla.TRANSPORTS)))
+		threads = min(self.max_vcpus, multiprocessing.cpu_count())
+		if engine == "host":
+			threads = max(1, multiprocessing.cpu_count() // self.max_fsck_jobs)
+		compressor = cziso.czimage.Compressor(compressor, level, threads)
+
+		dst_files = []
+		for image in images:
+			self.logger.info("Converting image %s to iso" % image)
+
+			# keep the image mapped from fsck through the Clonezilla VM;
+			# released at exit if we abort
+			image.hold()
+
+			# mount raw image and check it unless unchanged since last check
+			need_fsck = force_fsck or not self.fsck_cache.is_clean(image)
+			if not need_fsck:
+				self.logger.info(
+					"Skipping fsck; image %s unchanged since last fsck" % image)
+			if need_fsck or trim != "none":
+				if not image.mount():
+					cziso.abort("Unable to mount input image %s" % image)
+				if need_fsck:
+					image.fsck(self.max_fsck_jobs)
+				image.trim(trim, self.max_fsck_jobs)
+				image.unmount()
+				self.fsck_cache.record(image)
+
+			# check that we don't overwrite an existing ISO file
+			# insert the disk size into the file name
+			new_iso_filename = Clonezilla.get_cziso_restore_iso_filename(image)
+			candidate_dst_file = os.path.join(self.temp_dir, new_iso_filename)
+			if out_dir is not None:
+				candidate_dst_file = os.path.join(out_dir, new_iso_filename)
+			dst_files.append(cziso.increment_filename(candidate_dst_file))
+
+		if engine == "host":
+			for image, dst_file in zip(images, dst_files):
+				self.create_iso_on_host(image, dst_file, compressor)
+		else:
+			self.create_iso_in_vm(
+				images, dst_files, network, compressor, transport)
+		for image in images:
+			image.release()
 
-		# mount raw image and check it
-		if not image.mount():
-			cziso.abort("Unable to mount input image %s" % image)
-		image.fsck()
-		image.unmount()
+	def create_iso_in_vm(self, images, dst_files, network, compressor,
+	                     transport="nfs"):
+		"""
+		Create Clonezilla restore ISOs by running gen-rec-iso in a Clonezilla
+		Live VM that writes the ISOs to a NFS exported temp directory or to a
+		scratch disk.  All images are attached to the VM (as vda, vdb, ...)
+		and converted one after another in one console session.
+
+		:param images: A list of objects of type cziso.image.Image
+		:param dst_files: A list of strings containing the path of the ISO to
+		create for each image
+		:param network: A string containing <ip>:<netmask> for the VM or None
+		to lease a free IP
+		:param compressor: An object of type cziso.czimage.Compressor; the VM
+		gets a vCPU per compression thread
+		:param transport: A string containing how the VM writes the ISOs
+		back (nfs or disk)
 
-		# mount temp directory to place iso when complete
+		:return:  Returns if successful; otherwise aborts
+		"""
 		tmp = self.create_temp_directory()
-		ip, netmask = None, None
-		if network is None:
-			ip, netmask = cziso.get_free_ip(self.priv_interface)
+		ip, netmask, scratch = None, None, None
+		if transport == "disk":
+			# the VM writes the ISOs to a scratch disk instead of the network
+			scratch = self.create_scratch_disk(tmp, images)
 		else:
-			ip, netmask = network.split(":")
-		if netmask is None or ip is None:
-			cziso.abort("Unable to create a NFS export.  No ip or netmask")
-		cziso.create_nfs_export(tmp, ip)
-
-		# check that we don't overwrite an existing ISO file
-		generated_iso_filename = Clonezilla.get_cz_restore_iso_filename(image)
-		generated_iso_path = os.path.join(tmp, generated_iso_filename)
-		# insert the disk size into the file name
-		new_iso_filename = Clonezilla.get_cziso_restore_iso_filename(image)
-		candidate_dst_file = os.path.join(self.temp_dir, new_iso_filename)
-		if out_dir is not None:
-			candidate_dst_file = os.path.join(out_dir, new_iso_filename)
-		dst_file = cziso.increment_filename(candidate_dst_file)
-
-		# launch Clonezilla
-		libvirt_file = cziso.virtualmachine.LibvirtFile(self.config.config_dir)
-		libvirt_file.add_disk(
-			"file", "cdrom", self.clonezilla_custom.get_or_download())
-		image.add_to_libvirt(libvirt_file)
-		libvirt_file.set_interface(self.priv_interface)
-		vm = cziso.virtualmachine.VM()
-		status = vm.launch(libvirt_file.get_xml())
-		if status != 0:
-			cziso.abort("Unable to launch Clonezilla Live VM")
-
-		# run create iso script
+			# mount temp directory to place iso when complete
+			if network is None:
+				ip, netmask = self.ip_leases.acquire()
+			else:
+				ip, netmask = network.split(":")
+			if netmask is None or ip is None:
+				cziso.abort("Unable to create a NFS export.  No ip or netmask")
+			cziso.create_nfs_export(tmp, ip)
+
+		# use an idle VM from the pool or launch Clonezilla
+		vm = self.vm_pool.acquire()
+		if vm is not None:
+			libvirt_file = self.create_libvirt_file("create")
+			libvirt_file.set_name(vm.get_name())
+			devices = [image.add_to_libvirt(libvirt_file) for image in images]
+			if scratch is not None:
+				scratch_device = libvirt_file.add_disk("file", "disk", scratch)
+			expect_template = self.pool_create_expect
+			if not vm.attach_disks(libvirt_file.get_disk_xmls()):
+				self.vm_pool.release(vm, False)
+				for image in images:
+					image.unmount()
+				vm = None
+		if vm is None:
+			libvirt_file = self.create_libvirt_file("create")
+			expect_template = self.create_expect
+			libvirt_file.add_disk(
+				"file", "cdrom", self.clonezilla_custom.get_or_download())
+			devices = [image.add_to_libvirt(libvirt_file) for image in images]
+			if scratch is not None:
+				scratch_device = libvirt_file.add_disk("file", "disk", scratch)
+			else:
+				libvirt_file.set_interface(self.priv_interface)
+			if compressor.is_parallel() and \
+				compressor.threads > libvirt_file.vcpus:
+				libvirt_file.set_vcpus(compressor.threads)
+			vm = cziso.virtualmachine.VM()
+			status = vm.launch(libvirt_file.get_xml())
+			if status != 0:
+				cziso.abort("Unable to launch Clonezilla Live VM")
+
+		# run create iso script; jobs is a Tcl list of {disk vm_id} pairs
+		jobs = " ".join(["{%s %s}" % (device, image.get_image_id())
+			for device, image in zip(devices, images)])
+		if scratch is not None:
+			mount_output = "mount /dev/%s /home/partimag" % scratch_device
+			umount_output = "umount /home/partimag"
+		else:
+			mount_output = "ifconfig eth0 %s netmask %s; " \
+				"mount 10.1.1.1:%s /home/partimag" % (ip, netmask, tmp)
+			umount_output = "umount /home/partimag; ifconfig eth0 0.0.0.0"
 		expect_path = cziso.fill_template(
-			self.create_expect, tmp_dir=tmp, temp_dir=tmp,
-			vm_name=libvirt_file.get_name(), ip=ip, netmask=netmask,
-			vm_id=image.get_image_id())
+			expect_template, tmp_dir=tmp, vm_name=libvirt_file.get_name(),
+			mount_output=mount_output, umount_output=umount_output,
+			jobs=jobs, compress_env=compressor.get_env(),
+			compress_opt=compressor.get_ocs_option())
 		self.logger.info(
 			"""Running expect script to execute gen-rec-iso script -- it may
 take a few mins to boot the Clonezilla Live VM before you see any output""")
-		subprocess.call("expect %s" % expect_path, shell=True)
-
-		if os.path.exists(generated_iso_path):
-			self.logger.debug(
-				"Moving ISO file %s to %s" % (generated_iso_path, dst_file))
-			os.rename(generated_iso_path, dst_file)
-			self.logger.info(
-				"Clonezilla restore ISO file is now ready at %s" % dst_file)
-		else:
-			self.logger.error("Clonezilla did not generate ISO file")
+		rc = cziso.call_command("expect %s" % expect_path)
+		if not self.vm_pool.is_member(vm) and \
+			not self.wait_for_poweroff(vm) and rc == 0:
+			rc = 1
+
+		# the guest unmounted the scratch disk so it can be read on the host
+		iso_dir = tmp
+		if scratch is not None:
+			iso_dir = self.mount_iso(scratch)
+
+		created = 0
+		for image, dst_file in zip(images, dst_files):
+			generated_iso_path = os.path.join(
+				iso_dir, Clonezilla.get_cz_restore_iso_filename(image))
+			if os.path.exists(generated_iso_path):
+				self.logger.debug(
+					"Moving ISO file %s to %s" % (generated_iso_path, dst_file))
+				if scratch is not None:
+					checksum = self.file_mover.copy(generated_iso_path, dst_file)
+				else:
+					checksum = self.file_mover.move(generated_iso_path, dst_file)
+				Clonezilla.write_iso_metadata(
+					image, dst_file, compressor, checksum)
+				self.logger.info(
+					"Clonezilla restore ISO file is now ready at %s" % dst_file)
+				created += 1
+			else:
+				self.logger.error(
+					"Clonezilla did not generate ISO file for %s" % image)
 
 		# cleanup
-		vm.clean()
-		cziso.remove_nfs_export(tmp, ip)
+		self.release_vm(vm, libvirt_file, rc == 0 and created == len(images))
+		if scratch is not None:
+			self.unmount_iso(iso_dir)
+		else:
+			cziso.remove_nfs_export(tmp, ip)
+			if network is None:
+				self.ip_leases.release(ip)
 		shutil.rmtree(tmp)
+		for image in images:
+			image.unmount()
+
+	def create_iso_on_host(self, image, dst_file, compressor):
+		"""
+		Create a Clonezilla restore ISO without booting a VM.  The image
+		partitions are saved with partclone on the host into a Clonezilla
+		image directory, which is added to a copy of the regular Clonezilla
+		Live ISO set up to restore it on boot.
+
+		:param image: An object of type cziso.image.Image
+		:param dst_file: A string containing the path of the ISO to create
+		:param compressor: An object of type cziso.czimage.Compressor
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		if not image.mount():
+			cziso.abort("Unable to mount input image %s" % image)
+		tmp = self.create_temp_directory()
+		iso_dir = os.path.join(tmp, "iso")
+		self.extract_iso(self.clonezilla_regular.get_or_download(), iso_dir)
+
+		image_name = image.get_image_id()
+		cz_image = cziso.czimage.ClonezillaImage(
+			os.path.join(iso_dir, "home", "partimag", image_name))
+		cz_image.save(image, self.max_fsck_jobs, compressor)
 		image.unmount()
 
+		isolinux_file = os.path.join(iso_dir, "syslinux", "isolinux.cfg")
+		if not os.path.exists(isolinux_file):
+			cziso.abort("Unable to find %s" % isolinux_file)
+		customizations = dict(Clonezilla.CUSTOMIZATIONS)
+		customizations["ocs_live_run=\"ocs-live-general\""] = \
+			Clonezilla.HOST_RESTORE_RUN % {
+				"image": image_name, "disk": cz_image.DISK,
+				"medium": self.live_media_dir}
+		cziso.file_edit(isolinux_file, customizations)
+
+		cziso.generate_iso(
+			self.genisoimage_command, iso_dir, os.path.abspath(dst_file))
+		Clonezilla.write_iso_metadata(image, dst_file, compressor,
+			self.file_mover.get_checksum(dst_file))
+		shutil.rmtree(tmp)
+		self.logger.info(
+			"Clonezilla restore ISO file is now ready at %s" % dst_file)
+
+	def extract_iso(self, iso_file, dst_dir):
+		"""
+		Copy the contents of an ISO file to a directory
+
+		:param iso_file: A string containing the path to the ISO file
+		:param dst_dir: A string containing the directory to create
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		mount_dir = self.mount_iso(iso_file)
+		try:
+			self.logger.debug("Copying %s to %s" % (iso_file, dst_dir))
+			shutil.copytree(mount_dir, dst_dir, symlinks=True)
+		finally:
+			self.unmount_iso(mount_dir)
+
+	def mount_iso(self, iso_file):
+		"""
+		Mount an ISO file (or a scratch disk) read-only on a new temporary
+		directory
+
+		:param iso_file: A string containing the path to the ISO file
+
+		:return: A string containing the mount directory; aborts on error
+		"""
+		mount_dir = tempfile.mkdtemp(prefix="cziso-iso-")
+		out, rc = cziso.run_command(
+			"mount -o loop,ro %s %s" % (iso_file, mount_dir))
+		if rc != 0:
+			os.rmdir(mount_dir)
+			cziso.abort("Unable to mount %s: %s" % (iso_file, "\n".join(out)))
+		return mount_dir
+
+	def unmount_iso(self, mount_dir):
+		"""
+		Unmount an ISO file mounted by mount_iso and remove its directory
+
+		:param mount_dir: A string containing the mount directory
+
+		:return:
+		"""
+		cziso.run_command("umount %s" % mount_dir)
+		os.rmdir(mount_dir)
+
 	@staticmethod
 	def get_cziso_restore_iso_filename(image):
 		"""
@@ -136,6 +413,58 @@ take a few mins to boot the Clonezilla Live VM before you see any output""")
 		"""
 		return  "clonezilla-live-%s.iso" % image.get_image_id()
 
+	def create_scratch_disk(self, tmp_dir, images):
+		"""
+		Create a sparse raw file with an empty filesystem that is large
+		enough to hold the restore ISOs of the images
+
+		:param tmp_dir: A string containing the directory for the file
+		:param images: A list of objects of type cziso.image.Image
+
+		:return: A string containing the path to the scratch disk; aborts on
+		error
+		"""
+		# the ISOs are compressed so the image sizes plus room for the
+		# Clonezilla Live system on each ISO are an upper bound
+		size_gb = sum([image.get_size() + 1 for image in images])
+		path = os.path.join(tmp_dir, Clonezilla.SCRATCH_FILENAME)
+		f = open(path, "wb")
+		f.truncate(size_gb * 1024 * 1024 * 1024)
+		f.close()
+		out, rc = cziso.run_command(
+			"mkfs.ext4 -F -q -m 0 -O ^has_journal -E lazy_itable_init=1 %s" % path)
+		if rc != 0:
+			cziso.abort("Unable to create scratch disk %s: %s" % (
+				path, "\n".join(out)))
+		self.logger.debug("Created %i GB scratch disk %s" % (size_gb, path))
+		return path
+
+	def create_libvirt_file(self, purpose):
+		"""
+		Create a libvirt file with the resources of the VM profile selected
+		for the command or configured for the purpose of the VM and the disk
+		I/O settings from the config file
+
+		:param purpose: A string containing what the VM is for (create,
+		restore, modify or test)
+
+		:return: An object of type cziso.virtualmachine.LibvirtFile
+		"""
+		libvirt_file = cziso.virtualmachine.LibvirtFile(self.config.config_dir)
+		if self.vm_profile is not None:
+			profile = cziso.virtualmachine.VMProfile.load(
+				self.config, self.vm_profile)
+		else:
+			# a profile named after the purpose is used if configured
+			name = self.config.get_default(
+				"cziso", "%s_vm_profile" % purpose, purpose)
+			profile = cziso.virtualmachine.VMProfile.load(
+				self.config, name, name != purpose)
+		libvirt_file.set_profile(profile)
+		if self.config.has_section("disk_io"):
+			libvirt_file.set_disk_io(dict(self.config.items("disk_io")))
+		return libvirt_file
+
 	def create_temp_directory(self):
 		"""
 		Create a temporary sub-directory relative to the config temp dir
@@ -147,17 +476,25 @@ take a few mins to boot the Clonezilla Live VM before you see any output""")
 		os.mkdir(tmp_dir)
 		return tmp_dir
 
-	def modify_image(self, image, target_image):
+	def modify_image(self, image, target_image, auto=False):
 		"""
 		Modify image using regular Clonezilla
 
 		:param image: An object of Image
+		:param target_image: An object of Image attached as the second disk
+		or None
+		:param auto: True to copy image to target_image with ocs-onthefly
+		without a VNC console (see copy_image)
 
 		:return:  Returns if successful; otherwise aborts
 		"""
+		if auto:
+			if target_image is None:
+				cziso.abort("A target image is required to copy an image")
+			return self.copy_image(image, target_image)
 		self.logger.info("Modifying image %s" % image)
 
-		libvirt_file = cziso.virtualmachine.LibvirtFile(self.config.config_dir)
+		libvirt_file = self.create_libvirt_file("modify")
 		libvirt_file.add_disk(
 			"file", "cdrom", self.clonezilla_regular.get_or_download())
 		image.add_to_libvirt(libvirt_file)
@@ -172,21 +509,85 @@ take a few mins to boot the Clonezilla Live VM before you see any output""")
 		if target_image is not None:
 			target_image.unmount()
 
-	def restore_clonezilla_iso(self, iso_file, image):
+	def copy_image(self, image, target_image):
+		"""
+		Copy an image disk to disk to a target image (e.g., a ZFS vol to a
+		qcow2 file) with ocs-onthefly in a Clonezilla Live VM driven over its
+		serial console, so no restore ISO is needed
+
+		:param image: An object of type cziso.image.Image to copy from
+		:param target_image: An object of type cziso.image.Image to copy to;
+		must be at least as large as image
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		self.logger.info("Copying image %s to image %s" % (image, target_image))
+
+		# launch Clonezilla
+		libvirt_file = self.create_libvirt_file("modify")
+		libvirt_file.add_disk(
+			"file", "cdrom", self.clonezilla_custom.get_or_download())
+		source = image.add_to_libvirt(libvirt_file)
+		target = target_image.add_to_libvirt(libvirt_file)
+		vm = cziso.virtualmachine.VM()
+		status = vm.launch(libvirt_file.get_xml())
+		if status != 0:
+			cziso.abort("Unable to launch Clonezilla Live VM")
+
+		# run copy script
+		tmp = self.create_temp_directory()
+		expect_path = cziso.fill_template(
+			self.copy_expect, tmp_dir=tmp, vm_name=libvirt_file.get_name(),
+			source=source, target=target)
+		self.logger.info("""Running copy expect script -- it may take a few
+mins to boot the Clonezilla Live VM before you see any output""")
+		rc = cziso.call_command("expect %s" % expect_path)
+		powered_off = self.wait_for_poweroff(vm)
+
+		# cleanup
+		vm.clean()
+		image.unmount()
+		target_image.unmount()
+		shutil.rmtree(tmp)
+		if rc != 0 or not powered_off:
+			cziso.abort("Copy of image %s to image %s did not complete" % (
+				image, target_image))
+		self.logger.info("Copied image %s is now ready" % target_image)
+
+	def restore_clonezilla_iso(self, iso_file, image, engine="vm",
+	                           vm_fallback=True):
 		"""
 		Restpre a Clonezilla VM ISO file
 
 		:param iso_file:  Path to Clonezilla ISO file to restore
 		:param image: Destination for restored image of type Image
+		:param engine: A string containing where to restore the image
+		partitions; 'vm' boots the ISO in a VM and 'host' restores them on the
+		host, falling back to the VM if the ISO can not be restored on the host
+		:param vm_fallback: If False, abort instead of falling back to the VM
+		(e.g., the image is smaller than the original disk, which Clonezilla
+		refuses)
 
 		:return:  Returns if successful; otherwise aborts
 		"""
 		self.logger.info("Restoring image %s to image %s" % (iso_file, image))
 		if not os.path.exists(iso_file):
 			cziso.abort("ISO file %s does not exist" % iso_file)
+		if engine not in Clonezilla.ENGINES:
+			cziso.abort("Unknown engine %s; use one of %s" % (
+				engine, ", ".join(Clonezilla.ENGINES)))
+		if engine == "host" and self.restore_iso_on_host(iso_file, image):
+			self.logger.info("Restored image %s is now ready" % image)
+			return
+		if not vm_fallback:
+			cziso.abort("Unable to restore %s to %s on the host" % (
+				iso_file, image))
+		if self.restore_iso_in_pool_vm(iso_file, image):
+			self.logger.info("Restored image %s is now ready" % image)
+			return
 
 		# launch Clonezilla
-		libvirt_file = cziso.virtualmachine.LibvirtFile(self.config.config_dir)
+		libvirt_file = self.create_libvirt_file("restore")
 		libvirt_file.add_disk("file", "cdrom", iso_file)
 		image.add_to_libvirt(libvirt_file)
 
@@ -196,19 +597,213 @@ take a few mins to boot the Clonezilla Live VM before you see any output""")
 			cziso.abort("Unable to launch Clonezilla Live VM")
 
 		# run restore iso script
+		tmp = self.create_temp_directory()
 		expect_path = cziso.fill_template(
-			self.restore_expect, tmp_dir=self.temp_dir,
+			self.restore_expect, tmp_dir=tmp,
 			vm_name=libvirt_file.get_name())
 		self.logger.info("""Running restore expect script -- it may take a few
 mins to boot the Clonezilla Live VM before you see any output""")
-		subprocess.call("expect %s" % expect_path, shell=True)
+		cziso.call_command("expect %s" % expect_path)
+		powered_off = self.wait_for_poweroff(vm)
 
 		# cleanup
 		vm.clean()
 		image.unmount()
-		os.remove(expect_path)
+		shutil.rmtree(tmp)
+		if not powered_off:
+			cziso.abort("Restore of image %s did not complete" % image)
 		self.logger.info("Restored image %s is now ready" % image)
 
+	def restore_iso_in_pool_vm(self, iso_file, image):
+		"""
+		Restore a Clonezilla ISO file in an idle VM from the pool.  The image
+		and the ISO are hot-plugged as vda and vdb and ocs-sr restores the
+		Clonezilla image on the ISO.
+
+		:param iso_file:  Path to Clonezilla ISO file to restore
+		:param image: Destination for restored image of type Image
+
+		:return: True if restored; False if no pool VM is idle or the ISO
+		has no Clonezilla image
+		"""
+		if not os.path.exists(self.vm_pool.path):
+			return False
+		mount_dir = self.mount_iso(iso_file)
+		try:
+			cz_image = cziso.czimage.ClonezillaImage.find(
+				os.path.join(mount_dir, "home", "partimag"))
+		finally:
+			self.unmount_iso(mount_dir)
+		if cz_image is None:
+			self.logger.debug("No Clonezilla image found in %s" % iso_file)
+			return False
+		vm = self.vm_pool.acquire()
+		if vm is None:
+			return False
+
+		libvirt_file = self.create_libvirt_file("restore")
+		libvirt_file.set_name(vm.get_name())
+		image.add_to_libvirt(libvirt_file)
+		libvirt_file.add_disk("file", "disk", iso_file)
+		if not vm.attach_disks(libvirt_file.get_disk_xmls()):
+			self.vm_pool.release(vm, False)
+			image.unmount()
+			return False
+
+		tmp = self.create_temp_directory()
+		expect_path = cziso.fill_template(
+			self.pool_restore_expect, tmp_dir=tmp,
+			vm_name=libvirt_file.get_name(),
+			image_name=os.path.basename(cz_image.path))
+		self.logger.info("Running restore expect script in pool VM %s" %
+			vm.get_name())
+		rc = cziso.call_command("expect %s" % expect_path)
+		self.release_vm(vm, libvirt_file, rc == 0)
+		image.unmount()
+		shutil.rmtree(tmp)
+		if rc != 0:
+			cziso.abort("Unable to restore %s in pool VM" % iso_file)
+		return True
+
+	def wait_for_poweroff(self, vm):
+		"""
+		Wait for a Clonezilla Live VM to power off at the end of its job
+
+		:param vm: An object of type cziso.virtualmachine.VM
+
+		:return: True if the VM powered off cleanly; otherwise False
+		"""
+		return vm.wait_for_shutdown(self.shutdown_timeout)
+
+	def release_vm(self, vm, libvirt_file, success):
+		"""
+		Detach the disks of a pool VM and return it to the pool or destroy a
+		VM launched for a single job
+
+		:param vm: An object of type cziso.virtualmachine.VM
+		:param libvirt_file: An object of type virtualmachine.LibvirtFile with
+		the disks of the job
+		:param success: True if the job succeeded
+
+		:return:
+		"""
+		if not self.vm_pool.is_member(vm):
+			vm.clean()
+			return
+		detached = vm.detach_disks(libvirt_file.get_disk_xmls())
+		self.vm_pool.release(vm, success and detached)
+
+	def restore_iso_on_host(self, iso_file, image):
+		"""
+		Restore the Clonezilla image inside a restore ISO directly to the
+		image on the host without booting a VM
+
+		:param iso_file:  Path to Clonezilla ISO file to restore
+		:param image: Destination for restored image of type Image
+
+		:return:  True if restored; False if the ISO needs to be restored in a
+		VM instead; aborts on error
+		"""
+		mount_dir = self.mount_iso(iso_file)
+		try:
+			cz_image = cziso.czimage.ClonezillaImage.find(
+				os.path.join(mount_dir, "home", "partimag"))
+			if cz_image is None:
+				self.logger.warning(
+					"No Clonezilla image found in %s; restoring in VM" % iso_file)
+				return False
+
+			if not image.mount():
+				cziso.abort("Unable to mount image %s" % image)
+			try:
+				saved_size = cz_image.get_disk_size()
+				metadata = Clonezilla.read_iso_metadata(iso_file)
+				if metadata is not None:
+					saved_size = metadata["size_bytes"]
+				if saved_size is None or image.get_size_bytes() > saved_size:
+					# partitions need to be resized by Clonezilla (-k1)
+					self.logger.info(
+						"Image %s is larger than the saved disk; restoring in "
+						"VM" % image)
+					return False
+				compressor = None
+				if metadata is not None:
+					compressor = metadata.get("compressor")
+				cz_image.restore(image, self.max_fsck_jobs, compressor)
+			finally:
+				image.unmount()
+		finally:
+			self.unmount_iso(mount_dir)
+		return True
+
+	@staticmethod
+	def read_iso_metadata(iso_file):
+		"""
+		Read the metadata file written next to a restore ISO file
+
+		:param iso_file: A string containing the path to the ISO file
+
+		:return: A hash of the metadata or None if the ISO has no metadata
+		"""
+		path = iso_file + Clonezilla.METADATA_SUFFIX
+		if not os.path.exists(path):
+			return None
+		try:
+			f = open(path, "r")
+			try:
+				metadata = json.load(f)
+			finally:
+				f.close()
+		except (IOError, ValueError) as e:
+			cziso.abort("Unable to read ISO metadata file %s: %s" % (
+				path, str(e)))
+		if metadata.get("version") != Clonezilla.METADATA_VERSION:
+			cziso.abort("Unsupported ISO metadata version in %s" % path)
+		return metadata
+
+	@staticmethod
+	def write_iso_metadata(image, iso_file, compressor=None, checksum=None):
+		"""
+		Write the exact disk size and partition layout of the original image
+		and how it was compressed next to its restore ISO file so restores can
+		be sized precisely and use the matching decompressor
+
+		:param image: An object of type cziso.image.Image
+		:param iso_file: A string containing the path to the ISO file
+		:param compressor: An object of type cziso.czimage.Compressor used
+		to compress the partition images or None if unknown
+		:param checksum: A tuple containing the checksum algorithm and hex
+		digest of the ISO file or None if not computed
+
+		:return:
+		"""
+		table = image.read_partition_table()
+		if table is None:
+			cziso.abort("Unable to read partition table of %s" % image)
+		partitions = []
+		for partition in table.partitions:
+			partitions.append({
+				"number": partition.number, "start": partition.start,
+				"size": partition.size, "type": partition.type_id})
+		metadata = {
+			"version": Clonezilla.METADATA_VERSION,
+			"image": str(image),
+			"size_bytes": table.disk_size,
+			"min_size_bytes": table.get_min_size(),
+			"scheme": table.scheme,
+			"partitions": partitions
+		}
+		if compressor is not None:
+			metadata["compressor"] = compressor.name
+			metadata["compression_level"] = compressor.level
+		if checksum is not None:
+			metadata["checksum_type"], metadata["checksum"] = checksum
+		f = open(iso_file + Clonezilla.METADATA_SUFFIX, "w")
+		try:
+			json.dump(metadata, f, indent=2, sort_keys=True)
+		finally:
+			f.close()
+
 	@staticmethod
 	def parse_image_size_from_iso_filename(filename):
 		"""
@@ -233,7 +828,7 @@ mins to boot the Clonezilla Live VM before you see any output""")
 		"""
 		self.logger.info("Testing image %s" % image)
 
-		libvirt_file = cziso.virtualmachine.LibvirtFile(self.config.config_dir)
+		libvirt_file = self.create_libvirt_file("test")
 		image.add_to_libvirt(libvirt_file)
 		vm = cziso.virtualmachine.VM()
 		vm.launch(libvirt_file.get_xml())
@@ -241,6 +836,92 @@ mins to boot the Clonezilla Live VM before you see any output""")
 		vm.clean()
 		image.unmount()
 
+	def test_images_headless(self, images, pattern=None, timeout=None,
+	                         max_jobs=None):
+		"""
+		Test images by booting each in a VM without a display and waiting for
+		a pattern on its serial console (e.g., a login prompt).  Images are
+		tested concurrently and each VM is destroyed when its test is done.
+
+		:param images: A list of objects of type cziso.image.Image
+		:param pattern: A string containing a Tcl regular expression printed
+		on the serial console once the image booted or None to use
+		test_boot_pattern from the config file
+		:param timeout: An integer containing the max seconds to wait for the
+		pattern or None to use test_boot_timeout from the config file
+		:param max_jobs: An integer containing the max number of VMs booted
+		at once or None to use max_test_jobs from the config file
+
+		:return:  Returns if every image booted; otherwise aborts
+		"""
+		pattern = pattern or self.test_boot_pattern
+		timeout = timeout or self.test_boot_timeout
+		max_jobs = max_jobs or self.max_test_jobs
+		self.logger.info("Testing %i images (%i at a time)" % (
+			len(images), min(max_jobs, len(images))))
+
+		boot_times = {}
+
+		def boot(job):
+			index, image = job
+			boot_times[index] = self.boot_test_image(
+				image, index, pattern, timeout)
+			return boot_times[index] is not None
+
+		results = cziso.run_parallel(
+			boot, list(enumerate(images)), max_jobs, False)
+		failed = [str(image) for image, result in zip(images, results)
+			if not result]
+		for index, image in enumerate(images):
+			if boot_times.get(index) is not None:
+				self.logger.info("Image %s booted in %.1f seconds" % (
+					image, boot_times[index]))
+		if failed:
+			cziso.abort("Boot test failed for %s" % ", ".join(failed))
+
+	def boot_test_image(self, image, index, pattern, timeout):
+		"""
+		Boot an image in a VM without a display and wait for the pattern on
+		its serial console
+
+		:param image: An object of type cziso.image.Image
+		:param index: An integer used to give the VM a unique name
+		:param pattern: A string containing a Tcl regular expression
+		:param timeout: An integer containing the max seconds to wait
+
+		:return: A float containing the seconds from launch until the pattern
+		was seen or None if the image did not boot
+		"""
+		libvirt_file = self.create_libvirt_file("test")
+		libvirt_file.set_name("%s-test-%i" % (libvirt_file.get_name(), index))
+		image.add_to_libvirt(libvirt_file)
+		vm = cziso.virtualmachine.VM()
+		if vm.launch(libvirt_file.get_xml()) != 0:
+			self.logger.error("Unable to launch VM for image %s" % image)
+			image.unmount()
+			return None
+
+		tmp = tempfile.mkdtemp(prefix="cziso-test-", dir=self.temp_dir)
+		expect_path = cziso.fill_template(
+			self.test_expect, tmp_dir=tmp, vm_name=libvirt_file.get_name(),
+			pattern=pattern, timeout=timeout)
+		out, rc = cziso.run_command("expect %s" % expect_path)
+		boot_time = vm.get_runtime()
+		self.logger.debug("Serial console of %s:\n%s" % (image, "\n".join(out)))
+		if rc == 2:
+			self.logger.error("Image %s did not boot within %i seconds" % (
+				image, timeout))
+		elif rc != 0:
+			self.logger.error("VM for image %s stopped before it booted" % image)
+
+		# cleanup
+		vm.clean()
+		image.unmount()
+		shutil.rmtree(tmp)
+		if rc != 0:
+			return None
+		return boot_time
+
 	def update(self, zip_path, out_dir=os.getcwd()):
 		"""
 		Generate new Clonezilla Live ISOs for both the custom and regular
@@ -1,4 +1,6 @@
 import cziso
+import cziso.profiling
+import cziso.replay
 import logging
 import os
 import re
@@ -231,6 +233,31 @@ class CommonArgs(Args):
 			"Print out log messages from specified level",
 			"INFO"
 		))
+		opts.append(Opt(
+			"profile",
+			"""Profile the command with cProfile and write the pstats dump
+		to the specified path.  Prints a wall-clock breakdown (python cpu vs
+		time waiting on subprocesses) and the top cumulative hotspots.""",
+			None
+		))
+		opts.append(Opt(
+			"record",
+			"""Record every external command and libvirt call along with
+		its output and timing to the specified fixture file""",
+			None
+		))
+		opts.append(Opt(
+			"replay",
+			"""Serve external commands and libvirt calls from the specified
+		fixture file instead of running them""",
+			None
+		))
+		opts.append(Opt(
+			"replay-scale",
+			"""Multiply recorded durations by this factor when replaying
+		(0 replays as fast as possible)""",
+			"1.0"
+		))
 		Args.__init__(self, description, args, opts)
 
 
@@ -247,6 +274,79 @@ class Command:
 		self.logger = logging.getLogger(self.__module__)
 		self.file = __file__
 
+	def execute(self, config, args):
+		"""
+		Run the command; if the record or replay option is specified, send
+		external commands through a record/replay backend.  If the profile
+		option is specified, run it under cProfile and report where the
+		time went.
+
+		:param config:  An CzisoConfig object containing all config info
+		:param args:  An array of string arguments.  Required arguments are
+		single values and optional arguments are of name=value format
+
+		:return: The return value of run
+		"""
+		backend = None
+		replay_file = self.find_opt(args, "replay")
+		record_file = self.find_opt(args, "record")
+		if self.__class__.usage.has_opt("replay") and \
+			(replay_file is not None or record_file is not None):
+			# the backend may need to log or abort before parse_args is run
+			cziso.config_logging(self.find_opt(args, "loglevel") or "INFO")
+			if replay_file is not None:
+				scale = self.find_opt(args, "replay-scale") or "1.0"
+				backend = cziso.replay.Replayer(replay_file, float(scale))
+			else:
+				backend = cziso.replay.Recorder(record_file)
+		if backend is None:
+			return self.profile(config, args)
+
+		cziso.replay.install(backend)
+		try:
+			return self.profile(config, args)
+		finally:
+			cziso.replay.uninstall(backend)
+
+	def profile(self, config, args):
+		"""
+		Run the command under cProfile if the profile option is specified
+
+		:param config:  An CzisoConfig object containing all config info
+		:param args:  An array of string arguments.  Required arguments are
+		single values and optional arguments are of name=value format
+
+		:return: The return value of run
+		"""
+		stats_file = self.find_opt(args, "profile")
+		if stats_file is None or not self.__class__.usage.has_opt("profile"):
+			return self.run(config, args)
+
+		profiler = cziso.profiling.Profiler(stats_file)
+		profiler.start()
+		try:
+			return self.run(config, args)
+		finally:
+			profiler.stop()
+			profiler.report()
+
+	def find_opt(self, args, name):
+		"""
+		Look for an optional argument in the user's raw command-line args
+		before they are parsed
+
+		:param args: A string array of user's command-line args and opts
+		:param name: A string containing the name of the option
+
+		:return: A string containing the option value or None if not found
+		"""
+		for arg in args:
+			if re.search("\S+=\S+", arg):
+				(opt_name, val) = arg.split("=", 1)
+				if opt_name == name:
+					return val
+		return None
+
 	def is_arg_true(self, arg):
 		"""
 		Returns true if specified value is interpreted as true
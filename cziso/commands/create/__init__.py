@@ -11,6 +11,8 @@ class Command(cziso.commands.Command):
 		image file.  This leverages a specialized version of Clonezilla Live VM
 		with some built-in assumptions so that the conversion process is mostly
 		automated.  Currently only RAW and ZFS volumes are supported.
+		Multiple images can be specified separated by commas; they are
+		converted one after another in a single Clonezilla Live VM.
 		""",
 		[
 			ImageArg("image")
@@ -24,9 +26,56 @@ class Command(cziso.commands.Command):
 			Opt(
 				"net",
 			    """Temporary IP address and netmask to assign Clonezilla Live
-		VM.  Format is <ip>:<netmask>.  If blank attempts to use
-		'rocks report nextip command'.  """,
-				None)
+		VM.  Format is <ip>:<netmask>.  If blank leases a free IP from
+		ip_range in the config file (if not set, a range below 'rocks
+		report nextip' that is seeded once and again when idle for
+		ip_range_max_age seconds).  """,
+				None),
+			Opt(
+				"force-fsck",
+				"""Run fsck on the image even if it has not changed since
+		its last successful fsck.  Changes to ZFS vols are tracked against
+		a cziso-fsck snapshot of the vol.""",
+				"false"),
+			Opt(
+				"trim",
+				"""Release free filesystem space on the image partitions
+		before creating the ISO.  Use 'fstrim' to discard free blocks (shrinks
+		sparse files and thin zvols) or 'zerofree' to zero them (ext2/3/4
+		only).  Note that Clonezilla already skips free blocks of supported
+		filesystems when saving partitions.""",
+				"none"),
+			Opt(
+				"engine",
+				"""Where to save the image partitions.  'vm' runs gen-rec-iso
+		in a Clonezilla Live VM.  'host' runs partclone directly on the
+		host and builds the restore ISO from the regular Clonezilla Live ISO,
+		which avoids booting a VM and the temporary IP and NFS export.""",
+				"vm"),
+			Opt(
+				"compressor",
+				"""Program used to compress the partition images: none, gzip,
+		pigz, lz4 or zstd.  pigz and zstd are multi-threaded and the
+		Clonezilla Live VM gets a vCPU per thread (up to max_vcpus).""",
+				"pigz"),
+			Opt(
+				"level",
+				"""Compression level (e.g., 1-9 for gzip/pigz, 1-19 for zstd).
+		If blank uses the compressor default.""",
+				""),
+			Opt(
+				"transport",
+				"""How the Clonezilla Live VM writes the ISO back to the host.
+		'nfs' mounts the temp directory over NFS, which needs a temporary IP
+		on the private interface.  'disk' attaches a scratch disk that is
+		read on the host afterwards, which needs no network or NFS.""",
+				"nfs"),
+			Opt(
+				"vm-profile",
+				"""Name of the VM resource profile ([vm_profile_<name>] section
+		of the config file) for the Clonezilla Live VM.  If blank uses
+		create_vm_profile from the config file.""",
+				"")
 		]
 	)
 
@@ -37,6 +86,12 @@ class Command(cziso.commands.Command):
 	def run(self, config, args):
 		arg_vals = self.parse_args(args)
 
-		in_image = cziso.image.Image.factory(arg_vals["image"])
-		cz = cziso.clonezilla.Clonezilla(config)
-		cz.convert_to_clonezilla_iso(in_image, arg_vals["out"], arg_vals["net"])
+		in_images = [cziso.image.Image.factory(uri)
+			for uri in arg_vals["image"].split(",")]
+		cz = cziso.clonezilla.Clonezilla(
+			config, arg_vals["vm-profile"] or None)
+		cz.convert_to_clonezilla_iso(
+			in_images, arg_vals["out"], arg_vals["net"],
+			self.is_arg_true(arg_vals["force-fsck"]), arg_vals["trim"],
+			arg_vals["engine"], arg_vals["compressor"], arg_vals["level"] or None,
+			arg_vals["transport"])
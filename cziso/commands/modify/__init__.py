@@ -2,7 +2,7 @@ import cziso
 import cziso.commands
 import cziso.clonezilla
 import cziso.image
-from cziso.commands import CommonArgs, ImageArg, ImageOpt
+from cziso.commands import CommonArgs, ImageArg, ImageOpt, Opt
 
 
 class Command(cziso.commands.Command):
@@ -13,12 +13,34 @@ class Command(cziso.commands.Command):
 		console to Clonezilla Live VM instance.  Will shutdown and destroy
 		VM once vncviewer window is closed.  Currently requires X
 		forwarding enabled in order to run vncviewer.
+		With auto=true no VNC console is needed; the image is copied to the
+		target image disk to disk with ocs-onthefly (e.g., to convert a ZFS
+		vol to a qcow2 file without creating a restore ISO).
 		""",
 		[
 			ImageArg("image")
 		],
 		[
-			ImageOpt("target-image", None)
+			ImageOpt("target-image", None),
+			Opt(
+				"auto",
+				"""Copy the image to target-image with ocs-onthefly over the
+		serial console instead of opening a VNC console.  target-image is
+		created for the copy.""",
+				"false"),
+			Opt("overwrite", "Replace target-image if exists", "false"),
+			Opt(
+				"size",
+			    """Size of target-image (GB) with auto=true; default is the
+		image size but can be larger, in which case the partitions are
+		resized in proportion""",
+				""),
+			Opt(
+				"vm-profile",
+				"""Name of the VM resource profile ([vm_profile_<name>] section
+		of the config file) for the Clonezilla Live VM.  If blank uses
+		modify_vm_profile from the config file.""",
+				"")
 		]
 	)
 
@@ -29,12 +51,50 @@ class Command(cziso.commands.Command):
 	def run(self, config, args):
 		arg_vals = self.parse_args(args)
 
-		cziso.abort_if_no_x()
+		auto = self.is_arg_true(arg_vals["auto"])
+		if not auto:
+			cziso.abort_if_no_x()
 		image = cziso.image.Image.factory(arg_vals["image"])
 		target_image = None
 		if arg_vals["target-image"] is not None:
 			target_image = cziso.image.Image.factory(arg_vals["target-image"])
 		if not image.exists():
 			cziso.abort("Image %s does not exists" % image)
-		cz = cziso.clonezilla.Clonezilla(config)
-		cz.modify_image(image, target_image)
\ No newline at end of file
+		if auto:
+			if target_image is None:
+				cziso.abort("target-image is required with auto=true")
+			self.create_target_image(
+				image, target_image, self.is_arg_true(arg_vals["overwrite"]),
+				arg_vals["size"])
+		cz = cziso.clonezilla.Clonezilla(
+			config, arg_vals["vm-profile"] or None)
+		cz.modify_image(image, target_image, auto)
+
+	def create_target_image(self, image, target_image, overwrite, size):
+		"""
+		Create the target image with the size of the image or larger
+
+		:param image: An object of type cziso.image.Image to copy from
+		:param target_image: An object of type cziso.image.Image to copy to
+		:param overwrite: True to replace an existing target image
+		:param size: A string containing the size of the target image in GB
+		or blank to use the exact size of the image
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		if target_image.exists():
+			if not overwrite:
+				cziso.abort("""Image %s already exists; use overwrite=true to
+replace existing image""" % target_image)
+			target_image.delete()
+		if not image.mount():
+			cziso.abort("Unable to mount image %s" % image)
+		image_size, size_bytes = image.get_size(), image.get_size_bytes()
+		image.unmount()
+		if size != "":
+			if int(size) < image_size:
+				cziso.abort("""Image size is %i GB.  Please specify a target
+image size >= %i GB""" % (image_size, image_size))
+			image_size, size_bytes = int(size), None
+		if not target_image.create(image_size, size_bytes):
+			cziso.abort("Unable to create image %s" % target_image)
\ No newline at end of file
@@ -0,0 +1,57 @@
+import cziso
+import cziso.commands
+import cziso.clonezilla
+from cziso.commands import CommonArgs, Arg, Opt
+
+
+class Command(cziso.commands.Command):
+	usage = CommonArgs(
+		"""
+		Manage a pool of booted Clonezilla Live VMs.  When the pool has an idle
+		VM, create and restore hot-plug their disks into it instead of booting
+		a new Clonezilla Live VM.  VMs are replaced after max_jobs jobs or when
+		a job fails.
+		""",
+		[
+			Arg("action", """One of 'start' to boot VMs until the pool has
+		size VMs, 'stop' to destroy the pool VMs or 'status' to list them""")
+		],
+		[
+			Opt(
+				"size",
+				"""Number of VMs in the pool (default: size in the vm_pool
+		section of the config file)""",
+				None),
+			Opt(
+				"vm-profile",
+				"""Name of the VM resource profile ([vm_profile_<name>] section
+		of the config file) for the pool VMs.  If blank uses pool_vm_profile
+		from the config file.""",
+				"")
+		]
+	)
+	ACTIONS = ["start", "stop", "status"]
+
+	def __init__(self):
+		cziso.commands.Command.__init__(self)
+		self.file = __file__
+
+	def run(self, config, args):
+		arg_vals = self.parse_args(args)
+
+		action = arg_vals["action"]
+		if action not in Command.ACTIONS:
+			cziso.abort("Unknown action %s; use one of %s" % (
+				action, ", ".join(Command.ACTIONS)))
+		cz = cziso.clonezilla.Clonezilla(
+			config, arg_vals["vm-profile"] or None)
+		if action == "start":
+			size = None
+			if arg_vals["size"] is not None:
+				size = int(arg_vals["size"])
+			cz.vm_pool.start(size)
+		elif action == "stop":
+			cz.vm_pool.stop()
+		else:
+			for name, state, jobs in cz.vm_pool.status():
+				print "%-20s %-20s %i jobs" % (name, state, jobs)
@@ -19,7 +19,22 @@ class Command(cziso.commands.Command):
 			Opt(
 				"size",
 			    """Size of destination image (GB); default is original image
-size but can be larger if desired""",
+size but can be larger if desired.  Use 'min' to size the image to the end of
+its last partition (requires the metadata file written next to the ISO by
+create and engine=host)""",
+				""),
+			Opt(
+				"engine",
+				"""Where to restore the image partitions.  'vm' boots the ISO in
+a Clonezilla Live VM.  'host' restores the partitions directly on the host,
+falling back to the VM when the image is larger than the original disk (so
+Clonezilla can resize the partitions) or the ISO has no Clonezilla image.""",
+				"vm"),
+			Opt(
+				"vm-profile",
+				"""Name of the VM resource profile ([vm_profile_<name>] section
+of the config file) for the Clonezilla Live VM.  If blank uses
+restore_vm_profile from the config file.""",
 				"")
 		]
 	)
@@ -30,24 +45,40 @@ size but can be larger if desired""",
 
 	def run(self, config, args):
 		arg_vals = self.parse_args(args)
+		# Clonezilla (ocs-sr -k1) refuses or resizes a smaller disk
+		if arg_vals["size"] == "min" and arg_vals["engine"] != "host":
+			cziso.abort("""size=min keeps the original partition layout and
+is only supported with engine=host""")
 
 		out_img = cziso.image.Image.factory(arg_vals["image"])
 		if out_img.exists() and not self.is_arg_true(arg_vals["overwrite"]):
 			cziso.abort("""Image %s already exists; use overwrite=true to
 replace existing image""" % out_img)
-		if out_img.exists():
-			# we remove to get a new creation timestamp on ZFS
-			out_img.delete()
 
 		image_size = Clonezilla.parse_image_size_from_iso_filename(
 			arg_vals["iso"])
-		if arg_vals["size"] != "":
+		image_size_bytes = None
+		metadata = Clonezilla.read_iso_metadata(arg_vals["iso"])
+		if arg_vals["size"] == "min":
+			if metadata is None:
+				cziso.abort("""No metadata file found for %s; size=min is
+only supported for ISOs created with metadata""" % arg_vals["iso"])
+			image_size_bytes = metadata["min_size_bytes"]
+		elif arg_vals["size"] != "":
 			if int(arg_vals["size"]) < image_size:
 				cziso.abort("""Original image size is %i GB.  Please specify
 an image size >= %i GB""" % (image_size, image_size))
 			image_size = int(arg_vals["size"])
-		if not out_img.create(image_size):
+		elif metadata is not None and out_img.EXACT_SIZE:
+			image_size_bytes = metadata["size_bytes"]
+
+		if out_img.exists():
+			# we remove to get a new creation timestamp on ZFS
+			out_img.delete()
+		if not out_img.create(image_size, image_size_bytes):
 			cziso.abort("Unable to create image %s" % arg_vals["image"])
 
-		cz = Clonezilla(config)
-		cz.restore_clonezilla_iso(arg_vals["iso"], out_img)
+		cz = Clonezilla(config, arg_vals["vm-profile"] or None)
+		cz.restore_clonezilla_iso(
+			arg_vals["iso"], out_img, arg_vals["engine"],
+			vm_fallback=arg_vals["size"] != "min")
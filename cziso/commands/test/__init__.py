@@ -2,7 +2,7 @@ import cziso.commands
 import cziso.clonezilla
 import cziso.image
 import cziso.virtualmachine
-from cziso.commands import CommonArgs, ImageArg
+from cziso.commands import CommonArgs, ImageArg, Opt
 
 
 class Command(cziso.commands.Command):
@@ -12,12 +12,42 @@ class Command(cziso.commands.Command):
 		VM instance.  Will destroy VM instance once VNC console is closed so
 		should only be used for verification of the VM.
 		Currently requires X forwarding enabled in order to run vncviewer.
+		With headless=true no display is needed; each image passes once its
+		serial console prints the boot pattern and the time to boot is
+		reported.  Multiple images can be specified separated by commas;
+		headless tests boot them concurrently.
 		""",
 		[
 			ImageArg("image")
 		],
 		[
-
+			Opt(
+				"headless",
+				"""Boot the images without vncviewer and wait for the boot
+		pattern on the serial console instead""",
+				"false"),
+			Opt(
+				"pattern",
+				"""Tcl regular expression printed on the serial console once
+		the image booted (e.g., 'login:' or a cloud-init marker).  If blank
+		uses test_boot_pattern from the config file.""",
+				""),
+			Opt(
+				"timeout",
+				"""Max seconds to wait for the boot pattern.  If blank uses
+		test_boot_timeout from the config file.""",
+				""),
+			Opt(
+				"jobs",
+				"""Max number of images booted at once.  If blank uses
+		max_test_jobs from the config file.""",
+				""),
+			Opt(
+				"vm-profile",
+				"""Name of the VM resource profile ([vm_profile_<name>] section
+		of the config file) for the test VM.  If blank uses test_vm_profile
+		from the config file.""",
+				"")
 		]
 	)
 
@@ -28,9 +58,22 @@ class Command(cziso.commands.Command):
 	def run(self, config, args):
 		arg_vals = self.parse_args(args)
 
-		cziso.abort_if_no_x()
-		image = cziso.image.Image.factory(arg_vals["image"])
-		if not image.exists():
-			cziso.abort("Input image %s does not exists" % in_image)
-		cz = cziso.clonezilla.Clonezilla(config)
-		cz.test_image(image)
\ No newline at end of file
+		headless = self.is_arg_true(arg_vals["headless"])
+		if not headless:
+			cziso.abort_if_no_x()
+		images = []
+		for uri in arg_vals["image"].split(","):
+			image = cziso.image.Image.factory(uri)
+			if not image.exists():
+				cziso.abort("Input image %s does not exists" % uri)
+			images.append(image)
+		cz = cziso.clonezilla.Clonezilla(
+			config, arg_vals["vm-profile"] or None)
+		if headless:
+			cz.test_images_headless(
+				images, arg_vals["pattern"] or None,
+				int(arg_vals["timeout"] or 0) or None,
+				int(arg_vals["jobs"] or 0) or None)
+			return
+		for image in images:
+			cz.test_image(image)
\ No newline at end of file
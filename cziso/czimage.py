@@ -0,0 +1,532 @@
+import cziso
+import cziso.partition
+import logging
+import os
+import re
+
+
+class Compressor:
+	"""
+	Convenience class for the programs Clonezilla can compress partition
+	images with
+	"""
+	# name: (ocs-sr option, image suffix, command, multi-threaded)
+	TYPES = {
+		"none": ("-z0", "uncomp", "cat", False),
+		"gzip": ("-z1", "gz", "gzip -c%(level)s", False),
+		"pigz": ("-z1p", "gz", "pigz -c%(level)s -p %(threads)i", True),
+		"lz4": ("-z8", "lz4", "lz4 -c%(level)s", False),
+		"zstd": ("-z9p", "zst", "zstd -c%(level)s -T%(threads)i", True)
+	}
+
+	def __init__(self, name, level=None, threads=1):
+		"""
+		Create a Compressor object
+
+		:param name: A string containing the compressor name (e.g., pigz)
+		:param level: A string or integer containing the compression level or
+		None for the program default
+		:param threads: An integer containing the number of threads for
+		multi-threaded compressors
+		"""
+		if name not in Compressor.TYPES:
+			cziso.abort("Unknown compressor %s; use one of %s" % (
+				name, ", ".join(sorted(Compressor.TYPES.keys()))))
+		if level is not None and not re.match("^\d+$", str(level)):
+			cziso.abort("Compression level must be an integer: %s" % level)
+		self.name = name
+		self.level = level
+		self.threads = threads
+		self.ocs_option, self.suffix, self.command, self.parallel = \
+			Compressor.TYPES[name]
+
+	def __str__(self):
+		"""
+		Returns the compressor name
+
+		:return: A string containing the compressor name
+		"""
+		return self.name
+
+	def get_command(self):
+		"""
+		Get the command to compress stdin to stdout
+
+		:return: A string containing the command
+		"""
+		level = ""
+		if self.level is not None and self.name != "none":
+			level = " -%s" % self.level
+		return self.command % {"level": level, "threads": self.threads}
+
+	def get_env(self):
+		"""
+		Get a shell command that sets the compression level and threads in
+		the environment of the compression programs Clonezilla runs
+
+		:return: A string containing the shell command
+		"""
+		env = ["ZSTD_NBTHREADS=%i" % self.threads]
+		if self.level is not None:
+			env.extend([
+				"GZIP=-%s" % self.level, "PIGZ=-%s" % self.level,
+				"ZSTD_CLEVEL=%s" % self.level])
+		return "export %s" % " ".join(env)
+
+	def get_ocs_option(self):
+		"""
+		Get the ocs-sr option that selects this compressor
+
+		:return: A string containing the option
+		"""
+		return self.ocs_option
+
+	def get_program(self):
+		"""
+		Get the name of the compression program
+
+		:return: A string containing the program name
+		"""
+		return self.command.split()[0]
+
+	def get_suffix(self):
+		"""
+		Get the suffix of images compressed with this compressor
+
+		:return: A string containing the suffix (e.g., gz)
+		"""
+		return self.suffix
+
+	def is_parallel(self):
+		"""
+		Check whether the compressor uses multiple threads
+
+		:return: True if multi-threaded; otherwise False
+		"""
+		return self.parallel
+
+
+class ClonezillaImage:
+	"""
+	Convenience class for a Clonezilla image directory (i.e., what ocs-sr
+	savedisk writes to /home/partimag/<name>).  Partitions are saved with
+	partclone on the host so that no Clonezilla Live VM is needed.
+	"""
+	# the disk name the image is restored to in the Clonezilla Live VM
+	DISK = "vda"
+	# filesystems with a partclone program; others are saved with partclone.dd
+	PARTCLONE_FILESYSTEMS = [
+		"btrfs", "exfat", "ext2", "ext3", "ext4", "hfsplus", "ntfs",
+		"reiserfs", "vfat", "xfs"]
+	# Clonezilla's default image volume size so files fit on an ISO
+	SPLIT_SIZE = "4096MB"
+	# Clonezilla saves up to 1 MiB of data hidden between the MBR and the
+	# first partition (e.g., grub stage 1.5)
+	MAX_HIDDEN_DATA = 1024 * 1024
+	# MBR boot code that precedes the partition entries
+	BOOT_CODE_SIZE = 446
+	# decompression commands for each image suffix in order of preference;
+	# the parallel versions are used if installed
+	DECOMPRESSORS = {
+		"gz": [("pigz", "pigz -dc"), ("gzip", "gzip -dc")],
+		"bz2": [("pbzip2", "pbzip2 -dc"), ("bzip2", "bzip2 -dc")],
+		"xz": [("xz", "xz -dc -T0")],
+		"lzo": [("lzop", "lzop -dc")],
+		"lz4": [("lz4", "lz4 -dc")],
+		"zst": [("zstd", "zstd -dc")],
+		"uncomp": [("cat", "cat")]
+	}
+	PTCL_IMAGE_PATTERN = "^%s\\.([^.]+)-ptcl-img\\.([a-z0-9]+)(\\.[a-z]+)?$"
+
+	def __init__(self, path):
+		"""
+		Create a ClonezillaImage object
+
+		:param path: A string containing the path of the image directory
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.path = path
+
+	def _get_fs_info(self, device):
+		"""
+		Get the filesystem type, UUID and label of a partition
+
+		:param device: A string containing the partition device
+
+		:return: A hash of the blkid tags (e.g., TYPE, UUID, LABEL)
+		"""
+		out, rc = cziso.run_command("blkid -o export %s" % device)
+		info = {}
+		if rc != 0:
+			return info
+		for line in out:
+			if "=" in line:
+				key, value = line.strip().split("=", 1)
+				info[key] = value
+		return info
+
+	def _get_decompressor(self, suffix, preferred=None):
+		"""
+		Get the command to decompress a partclone image
+
+		:param suffix: A string containing the compression suffix (e.g., gz)
+		:param preferred: A string containing the program the image was
+		compressed with, which is tried first if it handles the suffix
+
+		:return: A string containing the decompression command; aborts if
+		none are installed
+		"""
+		decompressors = ClonezillaImage.DECOMPRESSORS.get(suffix, [])
+		decompressors = [d for d in decompressors if d[0] == preferred] + \
+			[d for d in decompressors if d[0] != preferred]
+		for program, command in decompressors:
+			if cziso.find_executable(program) is not None:
+				return command
+		cziso.abort("No decompression program found for .%s images" % suffix)
+
+	def _get_partition_name(self, partition):
+		"""
+		Get the Clonezilla name of a partition (e.g., vda1)
+
+		:param partition: An object of type cziso.partition.Partition
+
+		:return: A string containing the partition name
+		"""
+		return "%s%i" % (ClonezillaImage.DISK, partition.number)
+
+	def _save_partition(self, image, partition, compressor):
+		"""
+		Save a partition with partclone into compressed image volumes
+
+		:param image: An object of type cziso.image.Image
+		:param partition: An object of type cziso.partition.Partition
+		:param compressor: An object of type Compressor
+
+		:return: True if successful; otherwise False
+		"""
+		device = image.get_partition_device(partition)
+		name = self._get_partition_name(partition)
+		info = self._get_fs_info(device)
+		fs = info.get("TYPE", "")
+		if fs == "swap":
+			self._write_file("swappt-%s.info" % name,
+				'UUID="%s"\nLABEL="%s"\n' % (
+					info.get("UUID", ""), info.get("LABEL", "")))
+			return True
+		if fs not in ClonezillaImage.PARTCLONE_FILESYSTEMS:
+			self.logger.info("Saving %s (%s) with partclone.dd" % (
+				device, fs or "unknown filesystem"))
+			fs = "dd"
+		prefix = os.path.join(self.path, "%s.%s-ptcl-img.%s." % (
+			name, fs, compressor.get_suffix()))
+		out, rc = cziso.run_pipeline([
+			"partclone.%s -c -s %s -o -" % (fs, device),
+			compressor.get_command(),
+			"split -a 2 -b %s - %s" % (ClonezillaImage.SPLIT_SIZE, prefix)])
+		if rc != 0:
+			self.logger.error("Unable to save %s with partclone: %s" % (
+				device, "\n".join(out[-20:])))
+			return False
+		self.logger.info("Saved %s as %s" % (device, name))
+		return True
+
+	def _save_partition_table(self, image, table):
+		"""
+		Save the boot record, hidden data after it and partition table in the
+		formats ocs-sr restoredisk reads
+
+		:param image: An object of type cziso.image.Image
+		:param table: An object of type cziso.partition.PartitionTable
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		disk = ClonezillaImage.DISK
+		sector = cziso.partition.PartitionTable.SECTOR_SIZE
+		device = image.get_mount()
+		reader = image.open_disk_reader(image.get_table_path())
+		try:
+			self._write_file("%s-mbr" % disk, reader.read(0, sector))
+			first_start = min([p.start for p in table.partitions])
+			hidden = min(first_start, ClonezillaImage.MAX_HIDDEN_DATA) - sector
+			if table.scheme == "mbr" and hidden > 0:
+				self._write_file("%s-hidden-data-after-mbr" % disk,
+					reader.read(sector, hidden))
+			if table.scheme == "gpt":
+				head = cziso.partition.PartitionTable.HEAD_SECTORS * sector
+				tail = cziso.partition.PartitionTable.GPT_BACKUP_SECTORS * sector
+				self._write_file("%s-gpt-1st" % disk, reader.read(0, head))
+				self._write_file("%s-gpt-2nd" % disk,
+					reader.read(table.disk_size - tail, tail))
+		finally:
+			reader.close()
+
+		sectors = table.disk_size // sector
+		self._write_file("%s-chs.sf" % disk,
+			"cylinders=%i\nheads=255\nsectors=63\n" % (sectors // (255 * 63)))
+
+		out, rc = cziso.run_command("sfdisk -d %s" % device)
+		if rc != 0:
+			cziso.abort("Unable to dump partition table of %s: %s" % (
+				device, "\n".join(out)))
+		self._write_file(
+			"%s-pt.sf" % disk, self._rename_device(device, "\n".join(out)))
+		out, rc = cziso.run_command("parted -s %s unit s print" % device)
+		if rc != 0:
+			self.logger.warning("Unable to save parted output for %s" % device)
+		else:
+			self._write_file(
+				"%s-pt.parted" % disk, self._rename_device(device, "\n".join(out)))
+
+	def _get_volumes(self, name):
+		"""
+		Get the partclone image volumes of a partition
+
+		:param name: A string containing the partition name (e.g., vda1)
+
+		:return: A tuple containing a list of volume paths and the
+		compression suffix (e.g., gz) of the volumes
+		"""
+		pattern = re.compile(ClonezillaImage.PTCL_IMAGE_PATTERN % name)
+		volumes = []
+		suffix = None
+		for filename in sorted(os.listdir(self.path)):
+			matcher = pattern.match(filename)
+			if matcher is not None:
+				suffix = matcher.group(2)
+				volumes.append(os.path.join(self.path, filename))
+		return volumes, suffix
+
+	def _restore_partition(self, image, partition, decompressors):
+		"""
+		Restore a partition from its partclone image volumes
+
+		:param image: An object of type cziso.image.Image
+		:param partition: An object of type cziso.partition.Partition
+		:param decompressors: A hash of compression suffix to decompression
+		command from _get_decompressor
+
+		:return: True if successful; otherwise False
+		"""
+		device = image.get_partition_device(partition)
+		name = self._get_partition_name(partition)
+		swap_info = os.path.join(self.path, "swappt-%s.info" % name)
+		if os.path.exists(swap_info):
+			f = open(swap_info, "r")
+			info = dict(re.findall('(\w+)="([^"]*)"', f.read()))
+			f.close()
+			opts = ""
+			if info.get("UUID"):
+				opts += " -U %s" % info["UUID"]
+			if info.get("LABEL"):
+				opts += " -L %s" % info["LABEL"]
+			out, rc = cziso.run_command("mkswap%s %s" % (opts, device))
+			return rc == 0
+
+		volumes, suffix = self._get_volumes(name)
+		if not volumes:
+			self.logger.error("No partclone image found for %s" % name)
+			return False
+		out, rc = cziso.run_pipeline([
+			"cat %s" % " ".join(volumes),
+			decompressors[suffix],
+			"partclone.restore -s - -o %s" % device])
+		if rc != 0:
+			self.logger.error("Unable to restore %s with partclone: %s" % (
+				device, "\n".join(out[-20:])))
+			return False
+		self.logger.info("Restored %s to %s" % (name, device))
+		return True
+
+	def _restore_partition_table(self, image):
+		"""
+		Write the saved partition table, boot code and hidden data after the
+		MBR to the image
+
+		:param image: An object of type cziso.image.Image that is mounted
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		disk = ClonezillaImage.DISK
+		device = image.get_mount()
+		pt_file = os.path.join(self.path, "%s-pt.sf" % disk)
+		if not os.path.exists(pt_file):
+			cziso.abort("No partition table found in %s" % self.path)
+		f = open(pt_file, "r")
+		# drop last-lba so sfdisk relocates the backup GPT to the disk end
+		lines = [l for l in f.read().split("\n")
+			if not l.startswith("last-lba:")]
+		f.close()
+		separator = "p" if device[-1].isdigit() else ""
+		table = re.sub(
+			"/dev/%s(\d+)" % disk, "%s%s\\1" % (device, separator),
+			"\n".join(lines)).replace("/dev/%s" % disk, device)
+		out, rc = cziso.run_command(
+			"sfdisk --force %s" % device, input_string=table)
+		if rc != 0:
+			cziso.abort("Unable to write partition table to %s: %s" % (
+				device, "\n".join(out)))
+
+		mbr = os.path.join(self.path, "%s-mbr" % disk)
+		if os.path.exists(mbr):
+			cziso.run_command("dd if=%s of=%s bs=%i count=1 conv=notrunc" % (
+				mbr, device, ClonezillaImage.BOOT_CODE_SIZE))
+		hidden = os.path.join(self.path, "%s-hidden-data-after-mbr" % disk)
+		if os.path.exists(hidden):
+			cziso.run_command("dd if=%s of=%s bs=512 seek=1 conv=notrunc" % (
+				hidden, device))
+		if not image.rescan_partitions():
+			cziso.abort("Unable to find new partitions on %s" % image)
+
+	def _rename_device(self, device, text):
+		"""
+		Replace the host device and partition names in partition table dumps
+		with the disk name used in the Clonezilla Live VM
+
+		:param device: A string containing the host disk device
+		:param text: A string containing the partition table dump
+
+		:return: A string with the device names replaced
+		"""
+		disk = "/dev/%s" % ClonezillaImage.DISK
+		text = re.sub("%s-?p?(\d+)" % re.escape(device), disk + "\\1", text)
+		return text.replace(device, disk)
+
+	def _write_file(self, filename, content):
+		"""
+		Write a file in the image directory
+
+		:param filename: A string containing the name of the file
+		:param content: A string containing the file contents
+
+		:return:
+		"""
+		f = open(os.path.join(self.path, filename), "wb")
+		try:
+			f.write(content)
+		finally:
+			f.close()
+
+	@staticmethod
+	def find(partimag_dir):
+		"""
+		Find the Clonezilla image saved in a /home/partimag directory
+
+		:param partimag_dir: A string containing the path to the directory
+
+		:return: An object of type ClonezillaImage or None if not found
+		"""
+		if not os.path.isdir(partimag_dir):
+			return None
+		for name in sorted(os.listdir(partimag_dir)):
+			path = os.path.join(partimag_dir, name)
+			if os.path.exists(os.path.join(path, "parts")):
+				return ClonezillaImage(path)
+		return None
+
+	def get_disk_size(self):
+		"""
+		Get the size of the disk the image was saved from
+
+		:return: An integer containing the disk size in bytes or None if
+		not known
+		"""
+		parted = os.path.join(self.path, "%s-pt.parted" % ClonezillaImage.DISK)
+		if not os.path.exists(parted):
+			return None
+		f = open(parted, "r")
+		matcher = re.search("^Disk /dev/\S+: (\d+)s$", f.read(), re.M)
+		f.close()
+		if matcher is None:
+			return None
+		return int(matcher.group(1)) * cziso.partition.PartitionTable.SECTOR_SIZE
+
+	def restore(self, image, max_jobs=1, compressor=None):
+		"""
+		Restore the image directory to a mounted image like 'ocs-sr
+		restoredisk' would.  Partitions are restored concurrently.
+
+		:param image: An object of type cziso.image.Image that is mounted
+		:param max_jobs: An integer containing the max number of partclone
+		processes to run concurrently
+		:param compressor: A string containing the name of the compressor
+		the image was saved with (from the ISO metadata) or None if unknown
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		if image.get_mount() is None:
+			cziso.abort("Image %s is not mounted" % image)
+		self.logger.info("Restoring %s to image %s" % (self.path, image))
+		self._restore_partition_table(image)
+
+		f = open(os.path.join(self.path, "parts"), "r")
+		names = f.read().split()
+		f.close()
+		names.extend([
+			filename[len("swappt-"):-len(".info")]
+			for filename in sorted(os.listdir(self.path))
+			if filename.startswith("swappt-") and filename.endswith(".info")])
+		partitions = {}
+		for partition in image.read_partition_table().partitions:
+			partitions[self._get_partition_name(partition)] = partition
+		missing = [name for name in names if name not in partitions]
+		if missing:
+			cziso.abort("Partitions %s not found on %s" % (
+				", ".join(missing), image))
+
+		# find the decompressors before any partition is written so that a
+		# missing program aborts the restore up front
+		decompressors = {}
+		for name in names:
+			volumes, suffix = self._get_volumes(name)
+			if volumes and suffix not in decompressors:
+				decompressors[suffix] = self._get_decompressor(
+					suffix, compressor)
+
+		results = cziso.run_parallel(
+			lambda name: self._restore_partition(
+				image, partitions[name], decompressors), names, max_jobs)
+		if False in results:
+			cziso.abort("Unable to restore partitions to %s" % image)
+
+	def save(self, image, max_jobs=1, compressor=None):
+		"""
+		Save the partitions of a mounted image to the image directory like
+		'ocs-sr savedisk' would.  Partitions are saved concurrently.
+
+		:param image: An object of type cziso.image.Image that is mounted
+		:param max_jobs: An integer containing the max number of partclone
+		processes to run concurrently
+		:param compressor: An object of type Compressor (default: gzip)
+
+		:return:  Returns if successful; otherwise aborts
+		"""
+		if compressor is None:
+			compressor = Compressor("gzip")
+		if cziso.find_executable(compressor.get_program()) is None:
+			cziso.abort("Compressor %s is not installed" % compressor)
+		if image.get_mount() is None:
+			cziso.abort("Image %s is not mounted" % image)
+		table = image.read_partition_table()
+		if table is None or not table.partitions:
+			cziso.abort("Unable to find any partitions on %s" % image)
+		os.makedirs(self.path)
+		self.logger.info("Saving image %s to %s" % (image, self.path))
+
+		self._save_partition_table(image, table)
+		partitions = [p for p in table.partitions if not p.is_extended()]
+		results = cziso.run_parallel(
+			lambda p: self._save_partition(image, p, compressor), partitions,
+			max_jobs)
+		if False in results:
+			cziso.abort("Unable to save partitions of %s" % image)
+
+		saved = []
+		for partition in partitions:
+			name = self._get_partition_name(partition)
+			if not os.path.exists(
+				os.path.join(self.path, "swappt-%s.info" % name)):
+				saved.append(name)
+		self._write_file("disk", "%s\n" % ClonezillaImage.DISK)
+		self._write_file("parts", "%s\n" % " ".join(saved))
+		self._write_file("Info-saved-by-cmd.txt",
+			"Saved on host by cziso from %s\n" % image)
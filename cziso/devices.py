@@ -0,0 +1,145 @@
+import cziso
+import fcntl
+import glob
+import logging
+import os
+import re
+import time
+
+# overridable so that the benchmark fakes can provide their own sysfs tree
+SYS_BLOCK = "/sys/block"
+LOCK_DIR = "/var/lock"
+
+
+def find_loop_device(path):
+	"""
+	Find the loop device backed by the specified file by looking at sysfs
+	rather than parsing 'losetup -a' output
+
+	:param path: A string containing the path of the backing file
+
+	:return: A string containing the loop device path or None if not found
+	"""
+	path = os.path.realpath(path)
+	for backing_file in glob.glob(
+		os.path.join(SYS_BLOCK, "loop*", "loop", "backing_file")):
+		try:
+			f = open(backing_file, "r")
+			backing = f.read().strip()
+			f.close()
+		except IOError:
+			# loop device was detached while we were looking
+			continue
+		if backing == path:
+			loop = backing_file.split(os.sep)[-3]
+			return os.path.join("/dev", loop)
+	return None
+
+
+class NbdPool:
+	"""
+	Convenience class for allocating /dev/nbdN devices to attach qcow2 images
+	with qemu-nbd.  Allocation is serialized with a lock file so concurrent
+	cziso jobs never pick the same device.
+	"""
+	LOCK_FILE = "cziso-nbd.lock"
+	MAX_PARTITIONS = 16
+	CONNECT_TIMEOUT = 10
+
+	def __init__(self):
+		"""
+		Create a NbdPool object
+		"""
+		self.logger = logging.getLogger(self.__module__)
+
+	def _get_devices(self):
+		"""
+		Get the nbd devices on the host, loading the nbd module if needed
+
+		:return: A list of device names (e.g., nbd0) sorted by number
+		"""
+		devices = glob.glob(os.path.join(SYS_BLOCK, "nbd*"))
+		if not devices:
+			out, rc = cziso.run_command(
+				"modprobe nbd max_part=%i" % NbdPool.MAX_PARTITIONS)
+			if rc != 0:
+				cziso.abort("Unable to load nbd module: %s" % "\n".join(out))
+			devices = glob.glob(os.path.join(SYS_BLOCK, "nbd*"))
+		names = [os.path.basename(d) for d in devices]
+		return sorted(names, key=lambda n: int(re.sub("\D", "", n)))
+
+	def _is_connected(self, name):
+		"""
+		Check whether a nbd device is in use
+
+		:param name: A string containing the device name (e.g., nbd0)
+
+		:return: True if the device is connected; otherwise False
+		"""
+		return os.path.exists(os.path.join(SYS_BLOCK, name, "pid"))
+
+	def attach(self, path, qemu_type):
+		"""
+		Attach an image file to the first free nbd device
+
+		:param path: A string containing the path of the image file
+		:param qemu_type: A string containing the image format (e.g., qcow2)
+
+		:return: A string containing the nbd device path or None if failed
+		"""
+		lock = open(os.path.join(LOCK_DIR, NbdPool.LOCK_FILE), "a")
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			for name in self._get_devices():
+				if self._is_connected(name):
+					continue
+				device = os.path.join("/dev", name)
+				out, rc = cziso.run_command(
+					"qemu-nbd --connect=%s --format=%s --discard=unmap %s" % (
+						device, qemu_type, path))
+				if rc != 0:
+					self.logger.debug("Unable to connect %s to %s: %s" % (
+						path, device, "\n".join(out)))
+					continue
+				if not self._wait_for_connect(name):
+					self.detach(device)
+					continue
+				cziso.run_command("udevadm settle")
+				self.logger.info("Attached image %s as %s" % (path, device))
+				return device
+		finally:
+			lock.close()
+		self.logger.error("No free nbd device for %s" % path)
+		return None
+
+	def _wait_for_connect(self, name):
+		"""
+		Wait for the kernel to report the nbd device as connected
+
+		:param name: A string containing the device name (e.g., nbd0)
+
+		:return: True if connected; otherwise False
+		"""
+		deadline = time.time() + NbdPool.CONNECT_TIMEOUT
+		while not self._is_connected(name):
+			if time.time() > deadline:
+				self.logger.error("Timed out waiting for %s to connect" % name)
+				return False
+			time.sleep(0.1)
+		return True
+
+	def detach(self, device):
+		"""
+		Disconnect the image attached to a nbd device
+
+		:param device: A string containing the nbd device path
+
+		:return: True if successful; otherwise False
+		"""
+		out, rc = cziso.run_command("qemu-nbd --disconnect %s" % device)
+		if rc != 0:
+			self.logger.error("Unable to disconnect %s: %s" % (
+				device, "\n".join(out)))
+			return False
+		self.logger.debug("Detached %s" % device)
+		return True
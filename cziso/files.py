@@ -0,0 +1,375 @@
+import cziso
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+
+# ioctl to share the blocks of a file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+SEEK_DATA = 3
+SEEK_HOLE = 4
+CHUNK_SIZE = 8 * 1024 * 1024
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+	_libc = None
+
+# copy_file_range is only in glibc >= 2.27
+_copy_file_range = getattr(_libc, "copy_file_range", None)
+if _copy_file_range is not None:
+	_copy_file_range.argtypes = [
+		ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int,
+		ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint]
+	_copy_file_range.restype = ctypes.c_ssize_t
+_sendfile = getattr(_libc, "sendfile64", None)
+if _sendfile is not None:
+	_sendfile.argtypes = [
+		ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+		ctypes.c_size_t]
+	_sendfile.restype = ctypes.c_ssize_t
+
+
+class FileMover:
+	"""
+	Convenience class for publishing a file in another directory.  The file
+	is renamed if on the same filesystem.  Otherwise it is cloned (reflink)
+	or copied in the kernel with copy_file_range or sendfile, skipping
+	holes, to a temporary file that is synced and renamed into place so that
+	a partial file is never seen.  A checksum of the source is computed
+	while copying and the copy is checked against it before the rename.
+	"""
+	# errors meaning a copy method is not supported for the files
+	UNSUPPORTED = (
+		errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+		errno.ENOTTY, errno.EBADF)
+
+	def __init__(self, checksum="sha256"):
+		"""
+		Create a FileMover object
+
+		:param checksum: A string containing the hashlib algorithm used to
+		checksum files (e.g., sha256) or none to skip it
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.checksum = None
+		if checksum != "none":
+			try:
+				hashlib.new(checksum)
+			except ValueError:
+				cziso.abort("Unknown checksum algorithm %s" % checksum)
+			self.checksum = checksum
+		self.copy_range = _copy_file_range is not None
+		self.sendfile = _sendfile is not None
+
+	def _new_hash(self):
+		"""
+		Create a hash object for the checksum algorithm
+
+		:return: A hashlib object or None if no checksum is computed
+		"""
+		if self.checksum is None:
+			return None
+		return hashlib.new(self.checksum)
+
+	def _get_result(self, hasher):
+		"""
+		Get the checksum to return from the hash object
+
+		:param hasher: A hashlib object or None
+
+		:return: A tuple containing the algorithm and hex digest or None
+		"""
+		if hasher is None:
+			return None
+		return self.checksum, hasher.hexdigest()
+
+	@staticmethod
+	def _get_extents(fd, size):
+		"""
+		Get the ranges of a file that contain data, i.e. are not holes
+
+		:param fd: An integer containing the file descriptor
+		:param size: An integer containing the file size
+
+		:return: A list of tuples containing the start and end offsets
+		"""
+		extents = []
+		offset = 0
+		try:
+			while offset < size:
+				start = os.lseek(fd, offset, SEEK_DATA)
+				end = os.lseek(fd, start, SEEK_HOLE)
+				extents.append((start, end))
+				offset = end
+		except OSError as e:
+			if e.errno != errno.ENXIO:
+				# filesystem does not report holes
+				return [(0, size)]
+		return extents
+
+	@staticmethod
+	def _hash_zeros(hasher, length):
+		"""
+		Add a hole of zeros to the checksum
+
+		:param hasher: A hashlib object or None
+		:param length: An integer containing the length of the hole
+		"""
+		if hasher is None:
+			return
+		zeros = "\0" * min(CHUNK_SIZE, length)
+		while length > 0:
+			hasher.update(zeros[:length])
+			length -= len(zeros)
+
+	@staticmethod
+	def _read(fd, offset, length):
+		"""
+		Read a range of a file
+
+		:param fd: An integer containing the file descriptor
+		:param offset: An integer containing the offset to read from
+		:param length: An integer containing the number of bytes to read
+
+		:return: A string containing the bytes read
+		"""
+		os.lseek(fd, offset, os.SEEK_SET)
+		data = []
+		while length > 0:
+			chunk = os.read(fd, length)
+			if not chunk:
+				break
+			data.append(chunk)
+			length -= len(chunk)
+		return "".join(data)
+
+	def _clone(self, src_fd, dst_fd):
+		"""
+		Share the blocks of the source file with the destination file
+
+		:param src_fd: An integer containing the source file descriptor
+		:param dst_fd: An integer containing the destination file descriptor
+
+		:return: True if cloned; otherwise False
+		"""
+		try:
+			fcntl.ioctl(dst_fd, FICLONE, src_fd)
+		except (IOError, OSError) as e:
+			if e.errno not in FileMover.UNSUPPORTED:
+				raise
+			return False
+		return True
+
+	def _copy_chunk(self, src_fd, dst_fd, offset, length):
+		"""
+		Copy a range of the source file to the same offset of the
+		destination file with the fastest method that works
+
+		:param src_fd: An integer containing the source file descriptor
+		:param dst_fd: An integer containing the destination file descriptor
+		:param offset: An integer containing the offset of the range
+		:param length: An integer containing the length of the range
+
+		:return: A tuple containing the number of bytes copied and the data
+		if it was read into memory (or None)
+		"""
+		if self.copy_range:
+			off_in = ctypes.c_longlong(offset)
+			off_out = ctypes.c_longlong(offset)
+			copied = _copy_file_range(
+				src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out),
+				length, 0)
+			if copied >= 0:
+				# 0 means the source ended early, which the caller reports
+				return copied, None
+			err = ctypes.get_errno()
+			if err not in FileMover.UNSUPPORTED:
+				raise OSError(err, os.strerror(err))
+			self.logger.debug("copy_file_range not usable; trying sendfile")
+			self.copy_range = False
+		if self.sendfile:
+			os.lseek(dst_fd, offset, os.SEEK_SET)
+			off_in = ctypes.c_longlong(offset)
+			copied = _sendfile(dst_fd, src_fd, ctypes.byref(off_in), length)
+			if copied >= 0:
+				return copied, None
+			err = ctypes.get_errno()
+			if err not in FileMover.UNSUPPORTED:
+				raise OSError(err, os.strerror(err))
+			self.logger.debug("sendfile not usable; copying with read/write")
+			self.sendfile = False
+		data = FileMover._read(src_fd, offset, length)
+		os.lseek(dst_fd, offset, os.SEEK_SET)
+		written = 0
+		while written < len(data):
+			written += os.write(dst_fd, data[written:])
+		return len(data), data
+
+	def _copy_data(self, src_fd, dst_fd, size, hasher):
+		"""
+		Copy the data ranges of the source file, leaving holes as holes, and
+		add the file contents to the checksum
+
+		:param src_fd: An integer containing the source file descriptor
+		:param dst_fd: An integer containing the destination file descriptor
+		:param size: An integer containing the size of the source file
+		:param hasher: A hashlib object or None
+
+		:return:
+		"""
+		position = 0
+		for start, end in FileMover._get_extents(src_fd, size):
+			FileMover._hash_zeros(hasher, start - position)
+			offset = start
+			while offset < end:
+				copied, data = self._copy_chunk(
+					src_fd, dst_fd, offset, min(CHUNK_SIZE, end - offset))
+				if copied == 0:
+					raise IOError(errno.EIO, "Unexpected end of file")
+				if hasher is not None:
+					if data is None:
+						# still in the page cache from the copy
+						data = FileMover._read(src_fd, offset, copied)
+					hasher.update(data)
+				offset += copied
+			position = end
+		FileMover._hash_zeros(hasher, size - position)
+		# keep a hole at the end of the file
+		os.ftruncate(dst_fd, size)
+
+	def copy(self, src, dst):
+		"""
+		Copy a file to a temporary file next to the destination, sync it,
+		verify it and rename it to the destination.  The copy is checked
+		against the checksum of the source computed while copying.
+
+		:param src: A string containing the path of the file to copy
+		:param dst: A string containing the path to publish the file at
+
+		:return: A tuple containing the checksum algorithm and hex digest or
+		None if no checksum is computed
+		"""
+		dst_dir = os.path.dirname(os.path.abspath(dst))
+		tmp = os.path.join(dst_dir, ".%s.%i" % (os.path.basename(dst), os.getpid()))
+		hasher = self._new_hash()
+		src_fd = None
+		try:
+			src_fd = os.open(src, os.O_RDONLY)
+			size = os.fstat(src_fd).st_size
+			dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+			try:
+				cloned = self._clone(src_fd, dst_fd)
+				if cloned:
+					self.logger.debug("Cloned %s to %s" % (src, tmp))
+				else:
+					self._copy_data(src_fd, dst_fd, size, hasher)
+				os.fsync(dst_fd)
+			finally:
+				os.close(dst_fd)
+			error = None
+			checksum = self.get_checksum(tmp)
+			if os.path.getsize(tmp) != size:
+				error = "Copy of %s to %s is incomplete" % (src, dst)
+			elif not cloned and checksum is not None and \
+				checksum != self._get_result(hasher):
+				error = "Copy of %s to %s does not match its %s checksum" % (
+					src, dst, self.checksum)
+			if error is None:
+				shutil.copymode(src, tmp)
+				os.rename(tmp, dst)
+				FileMover._fsync_dir(dst_dir)
+		except (IOError, OSError) as e:
+			error = "Unable to copy %s to %s: %s" % (src, dst, str(e))
+		finally:
+			if src_fd is not None:
+				os.close(src_fd)
+		if error is not None:
+			if os.path.exists(tmp):
+				os.remove(tmp)
+			cziso.abort(error)
+		self.logger.debug("Copied %s to %s" % (src, dst))
+		return checksum
+
+	@staticmethod
+	def _fsync_dir(path):
+		"""
+		Sync a directory so that a rename in it is durable
+
+		:param path: A string containing the path to the directory
+		"""
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	def _hash_file(self, fd, size, hasher):
+		"""
+		Add the contents of a file to the checksum, skipping the reads of
+		holes
+
+		:param fd: An integer containing the file descriptor
+		:param size: An integer containing the file size
+		:param hasher: A hashlib object
+
+		:return:
+		"""
+		position = 0
+		for start, end in FileMover._get_extents(fd, size):
+			FileMover._hash_zeros(hasher, start - position)
+			offset = start
+			while offset < end:
+				data = FileMover._read(fd, offset, min(CHUNK_SIZE, end - offset))
+				if not data:
+					break
+				hasher.update(data)
+				offset += len(data)
+			position = end
+		FileMover._hash_zeros(hasher, size - position)
+
+	def get_checksum(self, path):
+		"""
+		Compute the checksum of a file
+
+		:param path: A string containing the path to the file
+
+		:return: A tuple containing the checksum algorithm and hex digest or
+		None if no checksum is computed
+		"""
+		hasher = self._new_hash()
+		if hasher is None:
+			return None
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			self._hash_file(fd, os.fstat(fd).st_size, hasher)
+		finally:
+			os.close(fd)
+		return self._get_result(hasher)
+
+	def move(self, src, dst):
+		"""
+		Move a file, renaming it if on the same filesystem; otherwise it is
+		copied and the source removed
+
+		:param src: A string containing the path of the file to move
+		:param dst: A string containing the path to publish the file at
+
+		:return: A tuple containing the checksum algorithm and hex digest or
+		None if no checksum is computed.  A renamed file is not read so no
+		checksum is computed for it.
+		"""
+		try:
+			os.rename(src, dst)
+			self.logger.debug("Renamed %s to %s" % (src, dst))
+			return None
+		except OSError as e:
+			if e.errno != errno.EXDEV:
+				raise
+		checksum = self.copy(src, dst)
+		os.remove(src)
+		return checksum
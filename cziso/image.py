@@ -1,13 +1,45 @@
 import abc
+import atexit
 import cziso
+import cziso.devices
+import cziso.partition
+import cziso.qcow2
+import fcntl
+import json
 import logging
 import math
 import os
 import re
+import tempfile
+import time
+
+
+# images held mapped until released; released at exit on abort
+_held_images = []
+
+
+def _release_held_images():
+	"""
+	Release the mappings of images still held when the program exits
+
+	:return:
+	"""
+	for image in list(_held_images):
+		image.release()
+
+atexit.register(_release_held_images)
 
 
 class Image:
 	CZ_IMAGE_NAME_LEN = 31
+	TRIM_METHODS = ["none", "fstrim", "zerofree"]
+	# whether libvirt needs the image mapped on the host to use it
+	MAP_FOR_LIBVIRT = True
+	# default I/O settings of the VM disk (see virtualmachine.DiskIO)
+	DISK_IO = {}
+	# whether restores create the image with the exact original size by
+	# default rather than only for size=min
+	EXACT_SIZE = True
 
 	"""
 	Convenience class for handling VM images
@@ -25,7 +57,12 @@ class Image:
 		self.disk_type = disk_type
 		self.qemu_type = qemu_type
 		self.partitions = []
+		self.partition_table = None
+		self.size_bytes = 0
 		self.size_gb = 0
+		self.map_refs = 0
+		self.mapped = False
+		self.held = False
 
 	def __str__(self):
 		"""
@@ -42,50 +79,60 @@ class Image:
 		:return: A tuple containing the disk size and string array containing
 		location of image partitions
 		"""
-		mount = self.get_mount()
+		table = self.read_partition_table()
+		if table is None:
+			return None, None
 		if self.get_mount() is None:
 			self.logger.error("Disk is not mounted")
 			return None, None
-		out, rc = cziso.run_command("fdisk -l %s" % mount)
-		if rc != 0:
-			cziso.abort("Unable to run fdisk command")
-
-		for line in out:
-			if self.size_gb == 0:
-				matcher = re.search("^Disk \S+: ([\d\.]+) GB", line)
-				if matcher is not None:
-					size_gb_float = float(matcher.group(1))
-					self.size_gb = int(math.ceil(size_gb_float))
-					self.logger.info("Disk size is %i GB" % self.size_gb)
-			matcher = re.match("^(%s\S+).*\s+(\S+)$" % mount, line)
-			if matcher:
-				if matcher.group(2) == "Linux":
-					self.partitions.append(matcher.group(1))
-		if self.size_gb == 0:
-			cziso.abort("Unable to find disk size of %s" % self)
+		self.partitions = [
+			self.get_partition_device(p) for p in table.get_linux_partitions()]
 		return self.size_gb, self.partitions
 
+	@abc.abstractmethod
+	def _map(self):
+		"""
+		Map the image to local host as block device
+
+		:return: True if successful, otherwise False
+		"""
+		pass
+
+	@abc.abstractmethod
+	def _unmap(self):
+		"""
+		Remove the block device mapping of the image from localhost
+
+		:return: True if successful; otherwise False
+		"""
+		pass
+
 	def add_to_libvirt(self, libvirt):
 		"""
 		Mount the image if necessary and add disk to libvirt config file
 
 		:param libvirt: An object of type virtualmachine.LibvirtFile
+
+		:return: A string containing the device name in the VM (e.g., vda)
 		"""
 		if not self.mount(libvirt=True):
 			cziso.abort("Unable to mount image %s" % self)
-		libvirt.add_disk(
+		return libvirt.add_disk(
 			self.get_disk_type(),
 			"disk",
 			self.get_mount(libvirt=True),
-			self.get_qemu_type()
+			self.get_qemu_type(),
+			self.DISK_IO
 		)
 
 	@abc.abstractmethod
-	def create(self, size):
+	def create(self, size, size_bytes=None):
 		"""
 		Create the image file
 
 		:param size An integer containing the file size in GB
+		:param size_bytes An integer containing the exact size in bytes;
+		overrides size if specified
 
 		:return: True if image created; otherwise False
 		"""
@@ -109,23 +156,66 @@ class Image:
 		"""
 		pass
 
-	def fsck(self):
+	def fsck(self, max_jobs=1):
 		"""
-		Runs fsck on disk to repair any issues
+		Runs fsck on disk partitions to repair any issues.  Partitions are
+		checked concurrently using up to max_jobs fsck processes.  On failure,
+		checks not yet started are cancelled, the image is unmounted and the
+		program aborts.
 
-		:return:  True if successful; otherwise False
+		:param max_jobs: An integer containing the max number of concurrent
+		fsck processes
+
+		:return:  True if successful; otherwise aborts
 		"""
 		self.logger.info("Running fsck on disk partitions")
 		self._get_disk_info()
 		if not self.partitions:
 			cziso.abort("Unable to find any partitions on disk")
-		for partition in self.partitions:
-			out, rc = cziso.run_command("fsck -y %s" % partition)
-			if rc != 0:
-				self.unmount()
-				cziso.abort(
-					"Problem running fsck -y on partition: %s" % "\n".join(out))
-			self.logger.debug("fsck output: %s" % "\n".join(out))
+
+		outputs = {}
+
+		def fsck_partition(partition):
+			start = time.time()
+			try:
+				out, rc = cziso.run_command("fsck -y %s" % partition)
+			except Exception as e:
+				self.logger.exception("Unable to run fsck on %s" % partition)
+				outputs[partition] = [str(e)]
+				return False
+			outputs[partition] = out
+			self.logger.info("fsck of %s finished in %.1fs (exit code %i)" % (
+				partition, time.time() - start, rc))
+			self.logger.debug("fsck output for %s: %s" % (
+				partition, "\n".join(out)))
+			return rc == 0
+
+		results = cziso.run_parallel(fsck_partition, self.partitions, max_jobs)
+		if False in results:
+			self.unmount()
+			errors = []
+			for partition, result in zip(self.partitions, results):
+				if result is False:
+					errors.append("%s:\n%s" % (
+						partition, "\n".join(outputs.get(partition, []))))
+				elif result is None:
+					self.logger.info("Cancelled fsck of %s" % partition)
+			cziso.abort(
+				"Problem running fsck -y on partition: %s" % "\n".join(errors))
+		return True
+
+	def get_identity(self, fresh=False):
+		"""
+		Get a string that changes whenever the contents of the image change.
+		Used to skip checks on images that have not changed.
+
+		:param fresh: Restart tracking changes from the current contents for
+		images that track them from a fixed point
+
+		:return: A string containing the identity of the image or None if
+		not supported
+		"""
+		return None
 
 	@abc.abstractmethod
 	def get_image_id(self):
@@ -137,6 +227,14 @@ class Image:
 		"""
 		pass
 
+	def get_allocated_size(self):
+		"""
+		Get the number of bytes allocated to the image
+
+		:return: An integer containing the allocated size in bytes
+		"""
+		return self.get_size_bytes()
+
 	def get_disk_type(self):
 		"""
 		Get the disk type (i.e., file or block)
@@ -145,6 +243,19 @@ class Image:
 		"""
 		return self.disk_type
 
+	def get_partition_device(self, partition):
+		"""
+		Get the path of the block device for a partition of the mounted image.
+		Follows the fdisk naming convention (e.g., sda1 but loop0p1).
+
+		:param partition: An object of type cziso.partition.Partition
+
+		:return: A string containing the path to the partition device
+		"""
+		mount = self.get_mount()
+		separator = "p" if mount[-1].isdigit() else ""
+		return "%s%s%i" % (mount, separator, partition.number)
+
 	def get_qemu_type(self):
 		"""
 		Get the type of qemu image (e.g., raw, qcow, qcow2, ...)
@@ -155,12 +266,33 @@ class Image:
 
 	def get_size(self):
 		"""
-		Return the disk size
+		Return the disk size rounded up to the nearest GB.  Reads the
+		partition table if not done yet and it can be read without mounting.
 
 		:return: An integer representing the disk size in GB
 		"""
+		if self.size_gb == 0 and self.get_table_path() is not None:
+			self.read_partition_table()
 		return self.size_gb
 
+	def get_size_bytes(self):
+		"""
+		Return the exact disk size
+
+		:return: An integer representing the disk size in bytes
+		"""
+		self.get_size()
+		return self.size_bytes
+
+	def get_table_path(self):
+		"""
+		Get the path to read the partition table from
+
+		:return: A string containing the path to a raw file or block device
+		or None if the image needs to be mounted first
+		"""
+		return self.get_mount()
+
 	@staticmethod
 	def factory(image):
 		"""
@@ -201,26 +333,336 @@ class Image:
 		"""
 		pass
 
-	@abc.abstractmethod
+	def hold(self):
+		"""
+		Keep the image mapped across mount/unmount pairs until release is
+		called (or the program exits) so that a pipeline of operations
+		shares a single mapping.
+
+		:return:
+		"""
+		if self.held:
+			return
+		self.held = True
+		self.map_refs += 1
+		_held_images.append(self)
+
 	def mount(self, libvirt=False):
 		"""
-		Mount the specified image to local host as block device.
+		Mount the specified image to local host as block device.  Mounts are
+		reference counted and the image is only mapped by the first one.
 
 		:param libvirt: Only mount if needed for libvirt (i.e. if mount not
 		supported by libvirt 0.12)
 
 		:return: True if successful, otherwise False
 		"""
-		pass
+		if not self.mapped and (not libvirt or self.MAP_FOR_LIBVIRT):
+			if not self._map():
+				return False
+			self.mapped = True
+		self.map_refs += 1
+		return True
+
+	def open_disk_reader(self, path):
+		"""
+		Open the disk for reading guest data
+
+		:param path: A string containing the path returned by get_table_path
+
+		:return: An object providing read(offset, length), get_size() and
+		close() (e.g., cziso.partition.DiskReader)
+		"""
+		return cziso.partition.DiskReader(path)
+
+	def read_partition_table(self):
+		"""
+		Read the partition table of the image and set the disk size
+
+		:return: An object of type cziso.partition.PartitionTable or None if
+		the image needs to be mounted first
+		"""
+		if self.partition_table is not None:
+			return self.partition_table
+		path = self.get_table_path()
+		if path is None:
+			self.logger.error("Disk is not mounted")
+			return None
+		try:
+			reader = self.open_disk_reader(path)
+			try:
+				table = cziso.partition.PartitionTable.read(reader)
+			finally:
+				reader.close()
+		except IOError as e:
+			cziso.abort("Unable to read partition table of %s: %s" % (
+				self, str(e)))
+		if table.disk_size == 0:
+			cziso.abort("Unable to find disk size of %s" % self)
+		self.partition_table = table
+		self.size_bytes = table.disk_size
+		self.size_gb = int(math.ceil(self.size_bytes / 1e9))
+		self.logger.info("Disk size is %i GB (%i bytes)" % (
+			self.size_gb, self.size_bytes))
+		for partition in table.partitions:
+			self.logger.debug("Found %s" % partition)
+		return table
+
+	def release(self):
+		"""
+		Drop the hold on the image mapping taken by hold
+
+		:return: True if successful; otherwise False
+		"""
+		if not self.held:
+			return True
+		self.held = False
+		_held_images.remove(self)
+		return self.unmount()
+
+	def rescan_partitions(self):
+		"""
+		Have the host pick up a partition table written to the mounted image
+		so that its partition devices exist
+
+		:return: True if successful; otherwise False
+		"""
+		self.partition_table = None
+		out, rc = cziso.run_command("blockdev --rereadpt %s" % self.get_mount())
+		if rc != 0:
+			self.logger.error("Unable to reread partition table of %s: %s" % (
+				self, "\n".join(out)))
+			return False
+		cziso.run_command("udevadm settle")
+		return True
+
+	def trim(self, method, max_jobs=1):
+		"""
+		Release or zero the free space of the filesystems on the disk
+		partitions so that stale deleted data is not kept in the image.
+		fstrim discards free blocks through the block device mapping (which
+		punches holes in sparse files and thin zvols); zerofree overwrites
+		free blocks of ext2/3/4 filesystems with zeros.  Failures are logged
+		but do not abort since this step is optional, except a partition that
+		cannot be unmounted after fstrim.
+
+		:param method: A string containing the trim method (fstrim or zerofree)
+		:param max_jobs: An integer containing the max number of partitions
+		to trim concurrently
+
+		:return: An integer containing the number of bytes trimmed or zeroed
+		"""
+		if method not in Image.TRIM_METHODS:
+			cziso.abort("Unknown trim method %s; use one of %s" % (
+				method, ", ".join(Image.TRIM_METHODS)))
+		if method == "none":
+			return 0
+		self.logger.info("Running %s on disk partitions" % method)
+		self._get_disk_info()
+		allocated = self.get_allocated_size()
+		reclaimed = {}
+
+		def trim_partition(partition):
+			start = time.time()
+			if method == "fstrim":
+				reclaimed[partition] = self._fstrim_partition(partition)
+				if reclaimed[partition] is None:
+					return False
+			else:
+				reclaimed[partition] = self._zerofree_partition(partition)
+			self.logger.info("%s of %s finished in %.1fs (%i bytes)" % (
+				method, partition, time.time() - start, reclaimed[partition]))
+			return True
+
+		results = cziso.run_parallel(
+			trim_partition, self.partitions, max_jobs, cancel_on_failure=False)
+		if False in results:
+			self.unmount()
+			cziso.abort("Unable to unmount partitions after %s" % method)
+		total = sum(reclaimed.values())
+		self.logger.info("%s reclaimed %i bytes of free space; image "
+			"allocation went from %i to %i bytes" % (
+				method, total, allocated, self.get_allocated_size()))
+		return total
+
+	def _fstrim_partition(self, partition):
+		"""
+		Mount a partition on a temporary directory and discard its free blocks
+
+		:param partition: A string containing the partition device
+
+		:return: An integer containing the number of bytes trimmed or None if
+		the partition could not be unmounted afterwards
+		"""
+		mount_dir = tempfile.mkdtemp(prefix="cziso-trim-")
+		try:
+			out, rc = cziso.run_command("mount %s %s" % (partition, mount_dir))
+		except Exception:
+			os.rmdir(mount_dir)
+			raise
+		if rc != 0:
+			os.rmdir(mount_dir)
+			self.logger.warning("Unable to mount %s for fstrim: %s" % (
+				partition, "\n".join(out)))
+			return 0
+		try:
+			out, rc = cziso.run_command("fstrim -v %s" % mount_dir)
+		finally:
+			umount_out, umount_rc = cziso.run_command("umount %s" % mount_dir)
+			if umount_rc == 0:
+				os.rmdir(mount_dir)
+		if umount_rc != 0:
+			self.logger.error("Unable to unmount %s from %s: %s" % (
+				partition, mount_dir, "\n".join(umount_out)))
+			return None
+		matcher = re.search("(\d+) bytes", "\n".join(out))
+		if rc != 0 or matcher is None:
+			self.logger.warning("Unable to fstrim %s: %s" % (
+				partition, "\n".join(out)))
+			return 0
+		return int(matcher.group(1))
+
+	def _zerofree_partition(self, partition):
+		"""
+		Zero the free blocks of an unmounted ext2/3/4 partition
+
+		:param partition: A string containing the partition device
+
+		:return: An integer containing the number of bytes zeroed
+		"""
+		out, rc = cziso.run_command("tune2fs -l %s" % partition)
+		matcher = re.search("Block size:\s+(\d+)", "\n".join(out))
+		if rc != 0 or matcher is None:
+			self.logger.warning(
+				"Skipping zerofree of %s; not an ext2/3/4 filesystem" % partition)
+			return 0
+		block_size = int(matcher.group(1))
+		out, rc = cziso.run_command("zerofree -v %s" % partition)
+		matcher = re.search("^(\d+)/(\d+)/(\d+)$", "\n".join(out), re.M)
+		if rc != 0 or matcher is None:
+			self.logger.warning("Unable to zerofree %s: %s" % (
+				partition, "\n".join(out)))
+			return 0
+		return int(matcher.group(1)) * block_size
 
-	@abc.abstractmethod
 	def unmount(self):
 		"""
-		Unmount the specified image from localhost
+		Unmount the specified image from localhost.  The mapping is only
+		removed when the last mount is unmounted.
 
 		:return: True if successful; otherwise False
 		"""
-		pass
+		if self.map_refs > 0:
+			self.map_refs -= 1
+		if self.map_refs > 0:
+			self.logger.debug("Keeping %s mapped (%i users)" % (
+				self, self.map_refs))
+			return True
+		if not self.mapped:
+			return True
+		if not self._unmap():
+			return False
+		self.mapped = False
+		return True
+
+
+class FsckCache:
+	"""
+	Convenience class for remembering which images passed fsck so that
+	unchanged images do not need to be mounted and checked again
+	"""
+	FILENAME = "fsck-cache.json"
+
+	def __init__(self, cache_dir):
+		"""
+		Create a FsckCache object
+
+		:param cache_dir: A string containing the directory to keep the
+		cache file in
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.path = os.path.join(cache_dir, FsckCache.FILENAME)
+
+	def _update(self, function):
+		"""
+		Read, modify and write the cache file while holding a lock on it
+
+		:param function: A function that is passed the cache hash array
+
+		:return:
+		"""
+		lock = open("%s.lock" % self.path, "a")
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			entries = self._read()
+			function(entries)
+			tmp = "%s.%i" % (self.path, os.getpid())
+			f = open(tmp, "w")
+			json.dump(entries, f, indent=2, sort_keys=True)
+			f.close()
+			os.rename(tmp, self.path)
+		finally:
+			lock.close()
+
+	def _read(self):
+		"""
+		Read the cache file
+
+		:return: A hash array of image URI to cache entry
+		"""
+		if not os.path.exists(self.path):
+			return {}
+		try:
+			f = open(self.path, "r")
+			entries = json.load(f)
+			f.close()
+			return entries
+		except ValueError:
+			self.logger.warning("Ignoring corrupt fsck cache %s" % self.path)
+			return {}
+
+	def is_clean(self, image):
+		"""
+		Check whether image passed fsck and has not changed since.  If so,
+		the disk info recorded at the time is restored to image.
+
+		:param image: An object of type Image
+
+		:return: True if the image is unchanged since its last successful
+		fsck; otherwise False
+		"""
+		entry = self._read().get(str(image))
+		if entry is None:
+			return False
+		identity = image.get_identity()
+		if identity is None or identity != entry["identity"]:
+			self.logger.debug("Image %s changed since last fsck" % image)
+			return False
+		image.size_gb = entry["size_gb"]
+		image.size_bytes = entry.get("size_bytes", 0)
+		return True
+
+	def record(self, image):
+		"""
+		Remember that image passed fsck
+
+		:param image: An object of type Image
+
+		:return:
+		"""
+		identity = image.get_identity(fresh=True)
+		if identity is None:
+			return
+
+		def add(entries):
+			entries[str(image)] = {
+				"identity": identity,
+				"size_gb": image.get_size(),
+				"size_bytes": image.get_size_bytes(),
+				"time": cziso.get_current_time_string()
+			}
+		self._update(add)
+		self.logger.debug("Recorded fsck of %s (%s)" % (image, identity))
 
 
 class QemuImg(Image):
@@ -228,6 +670,11 @@ class QemuImg(Image):
 	Convenience class for handling RAW VM images
 	"""
 	URI_PATTERN = "file://(/\S+\.(img|raw|vda|qcow2))"
+	# Files can be mounted by libvirt
+	MAP_FOR_LIBVIRT = False
+	# bypass the host page cache and pass discards through to keep the file
+	# sparse
+	DISK_IO = {"cache": "none", "io": "native", "discard": "unmap"}
 
 	def __init__(self, image):
 		"""
@@ -239,6 +686,7 @@ class QemuImg(Image):
 		self.file = matcher.group(1)
 		Image.__init__(self, image, "file", self._find_qemu_type())
 		self.loop_device = None
+		self.nbd_device = None
 		self.logger.debug("Creating Raw object for %s" % self.file)
 
 	def _find_qemu_type(self):
@@ -253,32 +701,25 @@ class QemuImg(Image):
 			qemu_type = "raw"
 		return qemu_type
 
-	def _get_disk_info(self):
-		"""
-		Find the provided image partitions on local host
-
-		:return: A tuple containing the disk size and string array containing
-		location of image partitions
-		"""
-		Image._get_disk_info(self)
-		mapper = os.path.join("dev", "mapper")
-		self.partitions = [p.replace("dev", mapper) for p in self.partitions]
-		return self.size_gb, self.partitions
-
-	def create(self, size):
+	def create(self, size, size_bytes=None):
 		"""
 		Create the image file
 
 		:param size An integer containing the file size in GB
+		:param size_bytes An integer containing the exact size in bytes;
+		overrides size if specified
 
 		:return: True if image created; otherwise False
 		"""
-		out, rc = cziso.run_command(
-			"qemu-img create -f %s %s %iG" % (self.qemu_type, self.file, size))
+		size_arg = "%iG" % size
+		if size_bytes is not None:
+			size_arg = "%i" % size_bytes
+		out, rc = cziso.run_command("qemu-img create -f %s %s %s" % (
+			self.qemu_type, self.file, size_arg))
 		if rc != 0:
 			self.logger.error("Unable to create image: %s" % "\n".join(out))
 			return False
-		self.logger.info("Created image file %s (%i GB)" % (self.file, size))
+		self.logger.info("Created image file %s (%s)" % (self.file, size_arg))
 		return True
 
 	def exists(self):
@@ -289,6 +730,21 @@ class QemuImg(Image):
 		"""
 		return os.path.exists(self.file)
 
+	def get_identity(self, fresh=False):
+		"""
+		Get a string that changes whenever the contents of the image file
+		change.
+
+		:param fresh: Unused since the file attributes change by themselves
+
+		:return: A string containing the file size, mtime and inode
+		"""
+		if not self.exists():
+			return None
+		stat = os.stat(self.file)
+		return "size=%i mtime=%r inode=%i" % (
+			stat.st_size, stat.st_mtime, stat.st_ino)
+
 	def get_image_id(self):
 		"""
 		Get a string representing the ID of the image.  Used to name new
@@ -309,9 +765,60 @@ class QemuImg(Image):
 		"""
 		if libvirt:
 			return self.file
+		elif self.nbd_device is not None:
+			return self.nbd_device
 		else:
 			return self.loop_device
 
+	def get_partition_device(self, partition):
+		"""
+		Get the path of the partition device created by the nbd driver or the
+		device mapper device kpartx created for a partition of the image
+
+		:param partition: An object of type cziso.partition.Partition
+
+		:return: A string containing the path to the partition device
+		"""
+		if self.nbd_device is not None:
+			return Image.get_partition_device(self, partition)
+		return os.path.join("/dev/mapper", "%sp%i" % (
+			os.path.basename(self.loop_device), partition.number))
+
+	def get_allocated_size(self):
+		"""
+		Get the number of bytes allocated to the image on disk.  For qcow2
+		images that can be read directly this is the guest data mapped by the
+		L1/L2 tables.
+
+		:return: An integer containing the allocated size in bytes
+		"""
+		if self.qemu_type == "qcow2":
+			qcow2 = cziso.qcow2.Qcow2Image.open(self.file)
+			if qcow2 is not None:
+				try:
+					return qcow2.get_allocated_size()
+				finally:
+					qcow2.close()
+		return os.stat(self.file).st_blocks * 512
+
+	def get_table_path(self):
+		"""
+		Get the path to read the partition table from.  Raw and qcow2 files
+		can be read directly without mounting, except qcow2 files with a
+		backing file or features the qcow2 reader does not support.
+
+		:return: A string containing the path to a file or block device or
+		None if the image needs to be mounted first
+		"""
+		if self.qemu_type in ("raw", "qcow2") and self.exists():
+			if self.qemu_type == "raw":
+				return self.file
+			qcow2 = cziso.qcow2.Qcow2Image.open(self.file)
+			if qcow2 is not None:
+				qcow2.close()
+				return self.file
+		return self.get_mount()
+
 	@staticmethod
 	def match(image):
 		"""
@@ -323,43 +830,80 @@ class QemuImg(Image):
 		"""
 		return re.match(QemuImg.URI_PATTERN, image)
 
-	def mount(self, libvirt=False):
+	def open_disk_reader(self, path):
 		"""
-		Mount the specified image to local host as block device.
+		Open the disk for reading guest data.  qcow2 files are read through
+		their cluster mapping.
 
-		:param libvirt: Only mount if needed for libvirt (i.e. if mount not
-		supported by libvirt 0.12)
+		:param path: A string containing the path returned by get_table_path
+
+		:return: An object providing read(offset, length), get_size() and
+		close()
+		"""
+		if self.qemu_type == "qcow2" and path == self.file:
+			qcow2 = cziso.qcow2.Qcow2Image.open(path)
+			if qcow2 is None:
+				cziso.abort("Unable to read qcow2 image %s directly" % path)
+			self.logger.info(
+				"qcow2 image %s: virtual size %i, cluster size %i" % (
+					self.file, qcow2.get_size(), qcow2.get_cluster_size()))
+			return qcow2
+		return Image.open_disk_reader(self, path)
+
+	def _map(self):
+		"""
+		Map the image file to local host as block device
 
 		:return: True if successful, otherwise False
 		"""
-		# Files can be mounted by libvirt
-		if libvirt:
-			return True
+		# qcow2 files cannot be looped so attach them with qemu-nbd
+		if self.qemu_type == "qcow2":
+			self.nbd_device = cziso.devices.NbdPool().attach(
+				self.file, self.qemu_type)
+			return self.nbd_device is not None
 
 		out, rc = cziso.run_command("kpartx -a %s" % self.file)
 		if rc != 0:
 			self.logger.error("Unable to mount %s as a control loop device")
 			return False
-		out, rc = cziso.run_command("losetup -a")
-		for line in out:
-			if line.find(self.file) >= 0:
-				matcher = re.search("(/dev/loop\d+)", line)
-				if matcher:
-					self.loop_device = matcher.group(1)
-					self.logger.info("Mounted image %s as %s" % (
-						self.file, self.loop_device))
-					return True
+		self.loop_device = cziso.devices.find_loop_device(self.file)
 		if not self.loop_device:
 			self.logger.error("Unable to find loop device for %s" % self.file)
 			return False
+		self.logger.info("Mounted image %s as %s" % (
+			self.file, self.loop_device))
 		return True
 
-	def unmount(self):
+	def rescan_partitions(self):
 		"""
-		Unmount the specified image from localhost
+		Have the host pick up a partition table written to the mounted image.
+		kpartx only maps the partitions found when the file was mapped so
+		it needs to be run again.
 
 		:return: True if successful; otherwise False
 		"""
+		if self.nbd_device is not None:
+			return Image.rescan_partitions(self)
+		self.partition_table = None
+		out, rc = cziso.run_command("kpartx -a %s" % self.file)
+		if rc != 0:
+			self.logger.error("Unable to map partitions of %s: %s" % (
+				self, "\n".join(out)))
+			return False
+		return True
+
+	def _unmap(self):
+		"""
+		Detach the nbd or loop device of the image file
+
+		:return: True if successful; otherwise False
+		"""
+		if self.nbd_device is not None:
+			if not cziso.devices.NbdPool().detach(self.nbd_device):
+				return False
+			self.nbd_device = None
+			return True
+
 		if self.loop_device is None:
 			self.logger.debug("No loop device needs to be unmounted")
 			return True
@@ -378,6 +922,19 @@ class ZfsVol(Image):
 	Convenience class for handling ZFS vol backed VM images
 	"""
 	URI_PATTERN = "zfs://([^\/]+)/([^\/]+)/([^\/]+)"
+	# volsize must be a multiple of the volblocksize
+	VOLSIZE_ALIGNMENT = 1024 * 1024
+	# exact sizes bypass Rocks, which creates zvols in whole GB, so they are
+	# only used for size=min
+	EXACT_SIZE = False
+	# snapshot that changes to the zvol are tracked against for the fsck
+	# cache; it holds on to overwritten blocks until the next create
+	IDENTITY_SNAPSHOT = "cziso-fsck"
+	# bypass the host page cache and turn zero writes into discards so thin
+	# zvols stay thin during restores
+	DISK_IO = {
+		"cache": "none", "io": "native", "discard": "unmap",
+		"detect_zeroes": "unmap"}
 
 	def __init__(self, image):
 		"""
@@ -399,14 +956,27 @@ class ZfsVol(Image):
 		self.hostname = out[0]
 		self.mountpoint = None
 
-	def create(self, size):
+	def create(self, size, size_bytes=None):
 		"""
-		Create the image file
+		Create the image file.  Rocks only creates zvols in whole GB so zvols
+		with an exact size are created on the NAS first and then mapped.
 
 		:param size An integer containing the file size in GB
+		:param size_bytes An integer containing the exact size in bytes;
+		overrides size if specified
 
 		:return: True if image created; otherwise False
 		"""
+		if size_bytes is not None:
+			align = ZfsVol.VOLSIZE_ALIGNMENT
+			size_bytes = ((size_bytes + align - 1) // align) * align
+			out, rc = cziso.run_command("ssh %s zfs create -V %i %s/%s" % (
+				self.nas, size_bytes, self.pool, self.vol))
+			if rc != 0:
+				self.logger.error("Unable to create zvol %s: %s" % (
+					self.vol, "\n".join(out)))
+				return False
+			size = int(math.ceil(size_bytes / 1e9))
 		out, rc = cziso.run_command("rocks add host storagemap %s %s %s %s %i img_sync=false" % (
 				self.nas, self.pool, self.vol, self.hostname, size))
 		if rc != 0:
@@ -415,6 +985,7 @@ class ZfsVol(Image):
 			return False
 		self.logger.info("Created ZFS vol %s (%i GB)" % (self, size))
 		self.mountpoint = out[1]
+		self.mapped = True
 		return True
 
 	def delete(self):
@@ -424,7 +995,8 @@ class ZfsVol(Image):
 		:return: True if image deleted; otherwise False
 		"""
 		if self.is_mapped():
-			self.unmount()
+			self._unmap()
+			self.mapped = False
 
 		if not self.promote_cloned_vols():
 			self.logger.error("Volume %s is not removable" % self.vol)
@@ -447,6 +1019,39 @@ class ZfsVol(Image):
 			self.nas, self.pool, self.vol))
 		return rc == 0
 
+	def get_identity(self, fresh=False):
+		"""
+		Get a string that changes whenever the contents of the zvol change.
+		Changes are tracked with the written@ property against the
+		IDENTITY_SNAPSHOT snapshot, which counts every block written since,
+		including in-place overwrites.
+
+		:param fresh: Replace the snapshot so that changes are tracked from
+		the current contents
+
+		:return: A string containing the GUID of the snapshot and the bytes
+		written since it
+		"""
+		vol = "%s/%s" % (self.pool, self.vol)
+		snapshot = "%s@%s" % (vol, ZfsVol.IDENTITY_SNAPSHOT)
+		if fresh:
+			out, rc = cziso.run_command(
+				"ssh %s \"zfs destroy %s 2>/dev/null; zfs snapshot %s\"" % (
+					self.nas, snapshot, snapshot))
+			if rc != 0:
+				self.logger.warning("Unable to snapshot %s: %s" % (
+					snapshot, "\n".join(out)))
+				return None
+		out, rc = cziso.run_command(
+			"ssh %s \"zfs get -H -p -o value guid %s && "
+			"zfs get -H -p -o value written@%s %s\"" % (
+				self.nas, snapshot, ZfsVol.IDENTITY_SNAPSHOT, vol))
+		lines = [line.strip() for line in out if line.strip()]
+		if rc != 0 or len(lines) != 2:
+			self.logger.debug("Unable to get identity of %s" % self)
+			return None
+		return "snapshot=%s written=%s" % (lines[0], lines[1])
+
 	def get_image_id(self):
 		"""
 		Get a string representing the ID of the image.  Used to name new
@@ -493,16 +1098,13 @@ class ZfsVol(Image):
 		"""
 		return re.match(ZfsVol.URI_PATTERN, image)
 
-	def mount(self, libvirt=False):
+	def _map(self):
 		"""
-		Mount the specified image to local host as block device.
-
-		:param libvirt: Only mount if needed for libvirt (i.e. if mount not
-		supported by libvirt 0.12)
+		Map the zvol to local host as block device.  ZFS mounts are not
+		supported by our libvirt version so this is also needed for libvirt.
 
 		:return: True if successful, otherwise False
 		"""
-		# ZFS mounts not supported by our libvirt version so always mount
 		# check if already mounted
 		if self.mountpoint is not None:
 			return True
@@ -541,16 +1143,16 @@ class ZfsVol(Image):
 			self.logger.info("Volume %s successfully promoted" % vol)
 		return True
 
-	def unmount(self):
+	def _unmap(self):
 		"""
-		Unmount the specified image from localhost
+		Remove the storagemap of the zvol to localhost
 
 		:return: True if successful; otherwise False
 		"""
 		out, rc = cziso.run_command(
 			"rocks remove host storagemap %s %s" % (self.nas, self.vol))
 		if rc != 0:
-			self.logger.error("Unable to unmount zvol at %s" % self.mount)
+			self.logger.error("Unable to unmount zvol at %s" % self.mountpoint)
 			return False
 		self.mountpoint = None
 		return True
@@ -0,0 +1,209 @@
+import cziso
+import fcntl
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+
+def ip_to_int(ip):
+	"""
+	Convert a dotted quad IP address to an integer
+
+	:param ip: A string containing the IP address
+
+	:return: An integer containing the IP address
+	"""
+	return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+	"""
+	Convert an integer to a dotted quad IP address
+
+	:param value: An integer containing the IP address
+
+	:return: A string containing the IP address
+	"""
+	return socket.inet_ntoa(struct.pack("!I", value))
+
+
+class IpLeases:
+	"""
+	Convenience class for handing out temporary IP addresses for Clonezilla
+	Live VMs to concurrent cziso jobs.  Addresses come from the configured
+	ip_range or, if not set, from a range below the next free IP reported by
+	Rocks, leaving ip_range_margin addresses for the next Rocks hosts.
+	Rocks is only asked when the state file is initialised and again when
+	no address is leased and the range is older than ip_range_max_age
+	seconds, so that the range follows hosts added since.  Leases are kept
+	in a state file in the temp directory and leases of jobs that died are
+	reclaimed.
+	"""
+	FILENAME = "cziso-ip-leases.json"
+
+	def __init__(self, config, iface):
+		"""
+		Create an IpLeases object
+
+		:param config: An object of type cziso.CzisoConfig
+		:param iface: A string containing the private interface used to
+		seed the range from Rocks
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.iface = iface
+		self.path = os.path.join(
+			config.get("cziso", "temp_directory"), IpLeases.FILENAME)
+		self.ip_range = config.get_default("cziso", "ip_range", "")
+		self.netmask = config.get_default("cziso", "ip_netmask", "")
+		self.range_size = int(config.get_default("cziso", "ip_range_size", 16))
+		self.range_margin = int(
+			config.get_default("cziso", "ip_range_margin", 16))
+		self.range_max_age = int(
+			config.get_default("cziso", "ip_range_max_age", 86400))
+		self.hostname = socket.gethostname()
+
+	def _update(self, function):
+		"""
+		Read, modify and write the state file while holding a lock on it
+
+		:param function: A function that is passed the state hash array and
+		whose return value is returned
+
+		:return: The return value of function
+		"""
+		lock = open("%s.lock" % self.path, "a")
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			state = self._read()
+			result = function(state)
+			tmp = "%s.%i" % (self.path, os.getpid())
+			f = open(tmp, "w")
+			json.dump(state, f, indent=2, sort_keys=True)
+			f.close()
+			os.rename(tmp, self.path)
+			return result
+		finally:
+			lock.close()
+
+	def _read(self):
+		"""
+		Read the state file
+
+		:return: A hash array containing the range seeded from Rocks and a
+		hash array of IP address to lease
+		"""
+		state = {"seed": None, "leases": {}}
+		if not os.path.exists(self.path):
+			return state
+		try:
+			f = open(self.path, "r")
+			state.update(json.load(f))
+			f.close()
+		except ValueError:
+			self.logger.warning("Ignoring corrupt IP lease state %s" % self.path)
+		return state
+
+	def _get_configured_range(self):
+		"""
+		Get the addresses of the configured ip_range
+
+		:return: A list of IP addresses
+		"""
+		try:
+			first, last = [ip_to_int(ip.strip())
+				for ip in self.ip_range.split("-")]
+		except (ValueError, socket.error):
+			cziso.abort("Invalid ip_range %s in config file; use first-last "
+				"(e.g., 10.1.200.1-10.1.200.16)" % self.ip_range)
+		if first > last:
+			cziso.abort("Invalid ip_range %s in config file; the first "
+				"address is after the last" % self.ip_range)
+		if not self.netmask:
+			cziso.abort("ip_netmask must be set with ip_range")
+		return [int_to_ip(i) for i in range(first, last + 1)]
+
+	def _get_range(self, state):
+		"""
+		Get the addresses that can be leased, seeding the range from Rocks if
+		no range is configured and the state has no current seed
+
+		:param state: The state hash array
+
+		:return: A tuple containing a list of IP addresses and the netmask or
+		(None, None) if no range is available
+		"""
+		if self.ip_range:
+			return self._get_configured_range(), self.netmask
+		seed = state.get("seed")
+		if seed is None or (not state["leases"] and
+			time.time() - seed["time"] > self.range_max_age):
+			next_ip = cziso.get_next_ip()
+			netmask = self.netmask or cziso.get_netmask(self.iface)
+			if next_ip is None or not netmask:
+				return None, None
+			seed = {"ip": next_ip, "netmask": netmask, "time": time.time()}
+			state["seed"] = seed
+			self.logger.info("Seeded IP lease range from %s" % next_ip)
+		# Rocks hands out addresses counting down so the ip_range_margin
+		# addresses below the next free IP are left for the next hosts
+		top = ip_to_int(seed["ip"]) - self.range_margin
+		ips = [int_to_ip(top - i) for i in range(self.range_size)]
+		return ips, self.netmask or seed["netmask"]
+
+	def _is_stale(self, lease):
+		"""
+		Check whether a lease belongs to a job on this host that died
+
+		:param lease: A hash array containing the host and pid of the lease
+
+		:return: True if the lease can be reclaimed; otherwise False
+		"""
+		return lease["host"] == self.hostname and \
+			not cziso.is_process_alive(lease["pid"])
+
+	def acquire(self):
+		"""
+		Lease a free IP address to this process
+
+		:return: A tuple containing the IP address and netmask or (None,
+		None) if no address is free
+		"""
+		def lease(state):
+			ips, netmask = self._get_range(state)
+			if ips is None:
+				return None, None
+			for ip in ips:
+				entry = state["leases"].get(ip)
+				if entry is not None:
+					if not self._is_stale(entry):
+						continue
+					self.logger.info("Reclaiming IP %s of dead job %i" % (
+						ip, entry["pid"]))
+				state["leases"][ip] = {
+					"host": self.hostname, "pid": os.getpid(),
+					"time": cziso.get_current_time_string()}
+				return ip, netmask
+			self.logger.error("All %i IP addresses are leased" % len(ips))
+			return None, None
+		ip, netmask = self._update(lease)
+		if ip is not None:
+			self.logger.debug("Leased IP %s" % ip)
+		return ip, netmask
+
+	def release(self, ip):
+		"""
+		Return a leased IP address
+
+		:param ip: A string containing the IP address from acquire
+
+		:return:
+		"""
+		def give_back(state):
+			entry = state["leases"].get(ip)
+			if entry is not None and entry["pid"] == os.getpid():
+				del state["leases"][ip]
+		self._update(give_back)
+		self.logger.debug("Released IP %s" % ip)
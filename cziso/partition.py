@@ -0,0 +1,311 @@
+import cziso
+import logging
+import os
+import struct
+import uuid
+
+
+class Partition:
+	"""
+	Convenience class for a partition found in a MBR or GPT partition table
+	"""
+	# GPT partition type GUIDs for Linux filesystems
+	GPT_LINUX_TYPES = [
+		"0fc63daf-8483-4772-8e79-3d69d8477de4",  # Linux filesystem data
+		"44479540-f297-41b2-9af7-d131d5f0458a",  # Linux root (x86)
+		"4f68bce3-e8cd-4db1-96e7-fbcaf984b709",  # Linux root (x86-64)
+		"933ac7e1-2eb4-4f13-b844-0e14e2aef915",  # Linux /home
+		"3b8f8425-20e0-4f3b-907f-1a25a76f98e8",  # Linux /srv
+	]
+	MBR_LINUX_TYPE = 0x83
+
+	def __init__(self, number, start, size, type_id, scheme):
+		"""
+		Create a Partition object
+
+		:param number: An integer containing the partition number (as used
+		in the device name, e.g. 5 for the first logical partition)
+		:param start: An integer containing the offset of the partition in bytes
+		:param size: An integer containing the size of the partition in bytes
+		:param type_id: An integer MBR type or a string GPT type GUID
+		:param scheme: A string containing the partition table type (mbr or gpt)
+		"""
+		self.number = number
+		self.start = start
+		self.size = size
+		self.type_id = type_id
+		self.scheme = scheme
+
+	def __str__(self):
+		"""
+		Return a short description of the partition
+
+		:return: A string describing the partition
+		"""
+		type_str = self.type_id
+		if self.scheme == "mbr":
+			type_str = "0x%02x" % self.type_id
+		return "partition %i (%s, start=%i, size=%i)" % (
+			self.number, type_str, self.start, self.size)
+
+	def get_end(self):
+		"""
+		Get the offset of the first byte after the partition
+
+		:return: An integer containing the end offset in bytes
+		"""
+		return self.start + self.size
+
+	def is_extended(self):
+		"""
+		Check whether the partition is a MBR extended partition container
+
+		:return: True if an extended partition; otherwise False
+		"""
+		return self.scheme == "mbr" and \
+			self.type_id in PartitionTable.EXTENDED_TYPES
+
+	def is_linux(self):
+		"""
+		Check whether the partition type is a Linux filesystem
+
+		:return: True if a Linux filesystem partition; otherwise False
+		"""
+		if self.scheme == "gpt":
+			return self.type_id in Partition.GPT_LINUX_TYPES
+		return self.type_id == Partition.MBR_LINUX_TYPE
+
+
+class DiskReader:
+	"""
+	Convenience class for reading byte ranges from a raw image file or block
+	device
+	"""
+	def __init__(self, path):
+		"""
+		Open the raw image file or block device for reading
+
+		:param path: A string containing the path to the file or device
+		"""
+		self.path = path
+		self.f = open(path, "rb")
+		self.f.seek(0, os.SEEK_END)
+		self.size = self.f.tell()
+
+	def close(self):
+		"""
+		Close the file or device
+
+		:return:
+		"""
+		self.f.close()
+
+	def get_size(self):
+		"""
+		Get the size of the disk
+
+		:return: An integer containing the size of the disk in bytes
+		"""
+		return self.size
+
+	def read(self, offset, length):
+		"""
+		Read a range of bytes from the disk
+
+		:param offset: An integer containing the offset to read from
+		:param length: An integer containing the number of bytes to read
+
+		:return: A string of length bytes (zero padded past the end of disk)
+		"""
+		self.f.seek(offset)
+		data = self.f.read(length)
+		return data + "\0" * (length - len(data))
+
+
+class PartitionTable:
+	"""
+	Convenience class for decoding MBR (including extended partitions) and
+	GPT partition tables without calling out to fdisk
+	"""
+	SECTOR_SIZE = 512
+	# MBR, GPT header and 128 GPT entries all fit in the first 34 sectors
+	HEAD_SECTORS = 34
+	EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+	GPT_PROTECTIVE_TYPE = 0xee
+	GPT_SIGNATURE = "EFI PART"
+	MAX_LOGICAL_PARTITIONS = 128
+	# backup GPT header and entries at the end of the disk
+	GPT_BACKUP_SECTORS = 33
+	ALIGNMENT = 1024 * 1024
+
+	def __init__(self, disk_size, scheme, partitions):
+		"""
+		Create a PartitionTable object
+
+		:param disk_size: An integer containing the size of the disk in bytes
+		:param scheme: A string containing the table type (mbr, gpt or None)
+		:param partitions: A list of Partition objects
+		"""
+		self.disk_size = disk_size
+		self.scheme = scheme
+		self.partitions = partitions
+
+	def get_min_size(self):
+		"""
+		Get the smallest disk size that holds every partition extent (and the
+		backup GPT), rounded up to a 1 MiB boundary
+
+		:return: An integer containing the minimum disk size in bytes
+		"""
+		if not self.partitions:
+			return self.disk_size
+		end = max([p.get_end() for p in self.partitions])
+		if self.scheme == "gpt":
+			end += PartitionTable.GPT_BACKUP_SECTORS * PartitionTable.SECTOR_SIZE
+		align = PartitionTable.ALIGNMENT
+		return min(((end + align - 1) // align) * align, self.disk_size)
+
+	def get_linux_partitions(self):
+		"""
+		Get the partitions containing Linux filesystems
+
+		:return: A list of Partition objects
+		"""
+		return [p for p in self.partitions if p.is_linux()]
+
+	@staticmethod
+	def read_path(path):
+		"""
+		Read the partition table of a raw image file or block device
+
+		:param path: A string containing the path to the file or device
+
+		:return: An object of type PartitionTable
+		"""
+		reader = DiskReader(path)
+		try:
+			return PartitionTable.read(reader)
+		finally:
+			reader.close()
+
+	@staticmethod
+	def read(reader):
+		"""
+		Read the partition table from a disk
+
+		:param reader: An object providing read(offset, length) and
+		get_size() for the disk (e.g., DiskReader)
+
+		:return: An object of type PartitionTable
+		"""
+		logger = logging.getLogger(PartitionTable.__module__)
+		sector = PartitionTable.SECTOR_SIZE
+		head = reader.read(0, PartitionTable.HEAD_SECTORS * sector)
+		disk_size = reader.get_size()
+
+		if head[510:512] != "\x55\xaa":
+			logger.debug("No partition table found")
+			return PartitionTable(disk_size, None, [])
+
+		entries = PartitionTable._decode_mbr_entries(head[0:sector])
+		if [e for e in entries if e[1] == PartitionTable.GPT_PROTECTIVE_TYPE]:
+			return PartitionTable._read_gpt(reader, head, disk_size)
+
+		partitions = []
+		logical = []
+		for number, type_id, start_lba, num_lbas in entries:
+			partitions.append(Partition(
+				number, start_lba * sector, num_lbas * sector, type_id, "mbr"))
+			if type_id in PartitionTable.EXTENDED_TYPES:
+				logical = PartitionTable._read_extended(reader, start_lba)
+		partitions.extend(logical)
+		return PartitionTable(disk_size, "mbr", partitions)
+
+	@staticmethod
+	def _decode_mbr_entries(mbr):
+		"""
+		Decode the 4 entries of a MBR or EBR sector
+
+		:param mbr: A string containing the 512 byte sector
+
+		:return: A list of tuples containing the entry number, type, start
+		lba and number of sectors for each used entry
+		"""
+		entries = []
+		for i in range(4):
+			entry = mbr[446 + 16 * i:446 + 16 * (i + 1)]
+			type_id = ord(entry[4])
+			start_lba, num_lbas = struct.unpack("<II", entry[8:16])
+			if type_id != 0 and num_lbas != 0:
+				entries.append((i + 1, type_id, start_lba, num_lbas))
+		return entries
+
+	@staticmethod
+	def _read_extended(reader, extended_lba):
+		"""
+		Follow the chain of EBRs in an extended partition
+
+		:param reader: An object providing read(offset, length)
+		:param extended_lba: An integer containing the first sector of the
+		extended partition
+
+		:return: A list of Partition objects for the logical partitions
+		"""
+		sector = PartitionTable.SECTOR_SIZE
+		partitions = []
+		ebr_lba = extended_lba
+		number = 5
+		while len(partitions) < PartitionTable.MAX_LOGICAL_PARTITIONS:
+			ebr = reader.read(ebr_lba * sector, sector)
+			if ebr[510:512] != "\x55\xaa":
+				break
+			entries = PartitionTable._decode_mbr_entries(ebr)
+			next_lba = None
+			for i, type_id, start_lba, num_lbas in entries:
+				if type_id in PartitionTable.EXTENDED_TYPES:
+					next_lba = extended_lba + start_lba
+				else:
+					partitions.append(Partition(
+						number, (ebr_lba + start_lba) * sector,
+						num_lbas * sector, type_id, "mbr"))
+					number += 1
+			if next_lba is None or next_lba <= ebr_lba:
+				break
+			ebr_lba = next_lba
+		return partitions
+
+	@staticmethod
+	def _read_gpt(reader, head, disk_size):
+		"""
+		Decode a GPT partition table
+
+		:param reader: An object providing read(offset, length)
+		:param head: A string containing the first sectors of the disk
+		:param disk_size: An integer containing the size of the disk in bytes
+
+		:return: An object of type PartitionTable
+		"""
+		sector = PartitionTable.SECTOR_SIZE
+		header = head[sector:2 * sector]
+		if header[0:8] != PartitionTable.GPT_SIGNATURE:
+			cziso.abort("Protective MBR found but no valid GPT header")
+		entries_lba, num_entries, entry_size = struct.unpack(
+			"<QII", header[72:88])
+		entries_offset = entries_lba * sector
+		entries_length = num_entries * entry_size
+		if entries_offset + entries_length <= len(head):
+			data = head[entries_offset:entries_offset + entries_length]
+		else:
+			data = reader.read(entries_offset, entries_length)
+
+		partitions = []
+		for i in range(num_entries):
+			entry = data[i * entry_size:(i + 1) * entry_size]
+			if entry[0:16] == "\0" * 16:
+				continue
+			type_guid = str(uuid.UUID(bytes_le=entry[0:16]))
+			first_lba, last_lba = struct.unpack("<QQ", entry[32:48])
+			partitions.append(Partition(
+				i + 1, first_lba * sector, (last_lba - first_lba + 1) * sector,
+				type_guid, "gpt"))
+		return PartitionTable(disk_size, "gpt", partitions)
@@ -0,0 +1,97 @@
+import cProfile
+import cziso
+import logging
+import os
+import pstats
+import sys
+import time
+
+
+class Profiler:
+	"""
+	Convenience class for profiling a cziso command with cProfile and
+	reporting where the wall-clock time went
+	"""
+	TOP_FUNCTIONS = 25
+
+	def __init__(self, stats_file, stream=sys.stderr):
+		"""
+		Create a Profiler object
+
+		:param stats_file: A string containing the path to write the pstats
+		dump to
+		:param stream: A file object to print the report to
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.stats_file = stats_file
+		self.stream = stream
+		self.profile = cProfile.Profile()
+		self.start_times = None
+		self.start_wall = None
+		self.stop_times = None
+		self.stop_wall = None
+		self.command_stats = {}
+
+	def start(self):
+		"""
+		Reset the subprocess counters and start profiling
+
+		:return:
+		"""
+		cziso.command_stats_lock.acquire()
+		try:
+			cziso.command_stats.clear()
+		finally:
+			cziso.command_stats_lock.release()
+		self.start_times = os.times()
+		self.start_wall = time.time()
+		self.profile.enable()
+
+	def stop(self):
+		"""
+		Stop profiling, take a snapshot of the subprocess counters and write
+		the pstats dump to disk
+
+		:return:
+		"""
+		self.profile.disable()
+		self.stop_wall = time.time()
+		self.stop_times = os.times()
+		cziso.command_stats_lock.acquire()
+		try:
+			self.command_stats = dict(cziso.command_stats)
+		finally:
+			cziso.command_stats_lock.release()
+		self.profile.dump_stats(self.stats_file)
+
+	def report(self):
+		"""
+		Print a wall-clock breakdown and the top cumulative hotspots
+
+		:return:
+		"""
+		wall = self.stop_wall - self.start_wall
+		python_cpu = sum(self.stop_times[0:2]) - sum(self.start_times[0:2])
+		child_cpu = sum(self.stop_times[2:4]) - sum(self.start_times[2:4])
+		subprocess_wait = sum([t for c, t in self.command_stats.values()])
+		other = max(wall - python_cpu - subprocess_wait, 0.0)
+
+		out = self.stream
+		out.write("\nProfile written to %s\n\n" % self.stats_file)
+		out.write("Wall-clock breakdown:\n")
+		out.write("  %-28s %10.3fs\n" % ("total wall time", wall))
+		out.write("  %-28s %10.3fs\n" % ("python cpu (user+sys)", python_cpu))
+		out.write("  %-28s %10.3fs\n" % ("waiting on subprocesses", subprocess_wait))
+		out.write("  %-28s %10.3fs\n" % ("subprocess cpu (user+sys)", child_cpu))
+		out.write("  %-28s %10.3fs\n" % ("other (io, sleep, libvirt)", other))
+		if self.command_stats:
+			out.write("\nSubprocess wait by program:\n")
+			by_time = sorted(
+				self.command_stats.items(), key=lambda x: x[1][1], reverse=True)
+			for program, (count, seconds) in by_time:
+				out.write("  %-28s %10.3fs  (%i calls)\n" % (
+					program, seconds, count))
+		out.write("\nTop %i functions by cumulative time:\n" %
+			Profiler.TOP_FUNCTIONS)
+		stats = pstats.Stats(self.stats_file, stream=out)
+		stats.sort_stats("cumulative").print_stats(Profiler.TOP_FUNCTIONS)
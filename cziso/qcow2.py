@@ -0,0 +1,239 @@
+import cziso
+import logging
+import struct
+import zlib
+
+
+class Qcow2Image:
+	"""
+	Convenience class for reading a qcow2 image file directly (i.e., without
+	qemu-img, qemu-nbd or a loop device).  Decodes the header and the L1/L2
+	cluster mapping so that guest data like the partition table can be read.
+	"""
+	MAGIC = "QFI\xfb"
+	HEADER_FORMAT = ">4sIQIIQIIQQIIQ"
+	HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+	L1_OFFSET_MASK = 0x00fffffffffffe00
+	L2_OFFSET_MASK = 0x00fffffffffffe00
+	L2_COMPRESSED = 1 << 62
+	L2_ZERO = 1
+	VERSIONS = (2, 3)
+	# version 3 header fields after the version 2 header
+	V3_HEADER_FORMAT = ">QQQII"
+	V3_HEADER_LENGTH = struct.calcsize(V3_HEADER_FORMAT)
+	# incompatible features that can be read: only the dirty bit, which
+	# means the refcounts may be stale but the L1/L2 tables are valid
+	INCOMPATIBLE_DIRTY = 1
+	MIN_CLUSTER_BITS = 9
+	MAX_CLUSTER_BITS = 21
+
+	def __init__(self, path):
+		"""
+		Open a qcow2 image and read its header.  Images this class cannot
+		read (e.g., with a backing file) have the reason in unsupported.
+
+		:param path: A string containing the path to the qcow2 file
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.path = path
+		self.f = open(path, "rb")
+		header = self.f.read(Qcow2Image.HEADER_LENGTH)
+		if len(header) != Qcow2Image.HEADER_LENGTH or \
+			header[0:4] != Qcow2Image.MAGIC:
+			self.f.close()
+			cziso.abort("%s is not a qcow2 image" % path)
+		(magic, self.version, backing_file_offset, backing_file_size,
+			self.cluster_bits, self.size, crypt_method, self.l1_size,
+			self.l1_table_offset, refcount_table_offset,
+			refcount_table_clusters, nb_snapshots, snapshots_offset) = \
+			struct.unpack(Qcow2Image.HEADER_FORMAT, header)
+		self.incompatible_features = 0
+		if self.version >= 3:
+			v3_header = self.f.read(Qcow2Image.V3_HEADER_LENGTH)
+			if len(v3_header) == Qcow2Image.V3_HEADER_LENGTH:
+				self.incompatible_features = struct.unpack(
+					Qcow2Image.V3_HEADER_FORMAT, v3_header)[0]
+		self.backing_file = None
+		if backing_file_offset != 0:
+			self.f.seek(backing_file_offset)
+			self.backing_file = self.f.read(backing_file_size)
+		self.unsupported = self._check_supported(crypt_method)
+		if self.unsupported is not None:
+			return
+		self.cluster_size = 1 << self.cluster_bits
+		self.l2_bits = self.cluster_bits - 3
+		self.l2_size = 1 << self.l2_bits
+		self.f.seek(self.l1_table_offset)
+		l1 = self.f.read(self.l1_size * 8)
+		self.l1_table = struct.unpack(">%iQ" % self.l1_size, l1)
+		self.l2_cache = {}
+		self.logger.debug(
+			"qcow2 v%i image %s: virtual size %i, cluster size %i" % (
+				self.version, path, self.size, self.cluster_size))
+
+	def _check_supported(self, crypt_method):
+		"""
+		Check whether the guest data can be read from this file alone
+
+		:param crypt_method: An integer containing the encryption method from
+		the header
+
+		:return: A string containing why the image is not supported or None
+		if it is
+		"""
+		if self.version not in Qcow2Image.VERSIONS:
+			return "unsupported qcow2 version %i" % self.version
+		if self.incompatible_features & ~Qcow2Image.INCOMPATIBLE_DIRTY:
+			# e.g., corrupt, external data file, zstd compression or
+			# extended L2 entries
+			return "unsupported incompatible features 0x%x" % (
+				self.incompatible_features)
+		if crypt_method != 0:
+			return "encrypted"
+		if self.backing_file is not None:
+			return "backing file %s" % self.backing_file
+		if self.cluster_bits < Qcow2Image.MIN_CLUSTER_BITS or \
+			self.cluster_bits > Qcow2Image.MAX_CLUSTER_BITS:
+			return "invalid cluster bits %i" % self.cluster_bits
+		return None
+
+	@staticmethod
+	def open(path):
+		"""
+		Open a qcow2 image if its guest data can be read directly
+
+		:param path: A string containing the path to the qcow2 file
+
+		:return: An object of type Qcow2Image or None if the image is not
+		supported (e.g., it has a backing file) and needs to be attached
+		"""
+		qcow2 = Qcow2Image(path)
+		if qcow2.unsupported is not None:
+			logging.getLogger(Qcow2Image.__module__).debug(
+				"Unable to read qcow2 image %s directly: %s" % (
+					path, qcow2.unsupported))
+			qcow2.close()
+			return None
+		return qcow2
+
+	def close(self):
+		"""
+		Close the image file
+
+		:return:
+		"""
+		self.f.close()
+
+	def _get_l2_table(self, l1_index):
+		"""
+		Get the L2 table for the specified L1 entry
+
+		:param l1_index: An integer containing the index into the L1 table
+
+		:return: A tuple of L2 entries or None if not allocated
+		"""
+		if l1_index >= self.l1_size:
+			return None
+		l2_offset = self.l1_table[l1_index] & Qcow2Image.L1_OFFSET_MASK
+		if l2_offset == 0:
+			return None
+		if l2_offset not in self.l2_cache:
+			self.f.seek(l2_offset)
+			data = self.f.read(self.cluster_size)
+			self.l2_cache[l2_offset] = struct.unpack(
+				">%iQ" % self.l2_size, data)
+		return self.l2_cache[l2_offset]
+
+	def _read_cluster(self, cluster_index):
+		"""
+		Read a guest cluster
+
+		:param cluster_index: An integer containing the guest cluster number
+
+		:return: A string containing the cluster data
+		"""
+		l2_table = self._get_l2_table(cluster_index >> self.l2_bits)
+		entry = 0
+		if l2_table is not None:
+			entry = l2_table[cluster_index & (self.l2_size - 1)]
+
+		if entry & Qcow2Image.L2_COMPRESSED:
+			return self._read_compressed_cluster(entry)
+		offset = entry & Qcow2Image.L2_OFFSET_MASK
+		if offset == 0 or (self.version >= 3 and entry & Qcow2Image.L2_ZERO):
+			return "\0" * self.cluster_size
+		self.f.seek(offset)
+		data = self.f.read(self.cluster_size)
+		return data + "\0" * (self.cluster_size - len(data))
+
+	def _read_compressed_cluster(self, entry):
+		"""
+		Read and inflate a compressed guest cluster
+
+		:param entry: An integer containing the L2 entry of the cluster
+
+		:return: A string containing the cluster data
+		"""
+		size_bits = self.cluster_bits - 8
+		offset_bits = 62 - size_bits
+		offset = entry & ((1 << offset_bits) - 1)
+		sectors = ((entry >> offset_bits) & ((1 << size_bits) - 1)) + 1
+		length = sectors * 512 - (offset & 511)
+		self.f.seek(offset)
+		data = zlib.decompressobj(-12).decompress(self.f.read(length))
+		return data[0:self.cluster_size]
+
+	def get_allocated_size(self):
+		"""
+		Get the number of bytes of guest data allocated in the image by
+		walking the L1/L2 tables
+
+		:return: An integer containing the allocated size in bytes
+		"""
+		clusters = 0
+		for l1_index in range(self.l1_size):
+			l2_table = self._get_l2_table(l1_index)
+			if l2_table is None:
+				continue
+			for entry in l2_table:
+				if entry & Qcow2Image.L2_COMPRESSED or \
+					entry & Qcow2Image.L2_OFFSET_MASK:
+					clusters += 1
+		return clusters * self.cluster_size
+
+	def get_cluster_size(self):
+		"""
+		Get the cluster size of the image
+
+		:return: An integer containing the cluster size in bytes
+		"""
+		return self.cluster_size
+
+	def get_size(self):
+		"""
+		Get the virtual size of the disk
+
+		:return: An integer containing the virtual size in bytes
+		"""
+		return self.size
+
+	def read(self, offset, length):
+		"""
+		Read a range of guest bytes from the image
+
+		:param offset: An integer containing the guest offset to read from
+		:param length: An integer containing the number of bytes to read
+
+		:return: A string of length bytes (zero padded past the end of disk)
+		"""
+		data = []
+		end = min(offset + length, self.size)
+		while offset < end:
+			cluster_index = offset >> self.cluster_bits
+			cluster_offset = offset & (self.cluster_size - 1)
+			chunk = min(self.cluster_size - cluster_offset, end - offset)
+			cluster = self._read_cluster(cluster_index)
+			data.append(cluster[cluster_offset:cluster_offset + chunk])
+			offset += chunk
+		data = "".join(data)
+		return data + "\0" * (length - len(data))
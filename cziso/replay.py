@@ -0,0 +1,444 @@
+import cziso
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+
+class Fixture:
+	"""
+	Convenience class for reading and writing record/replay fixture files.
+	A fixture is a file of JSON objects, one per line, so that a run that
+	aborts part way through still leaves a usable fixture behind.
+	"""
+	VERSION = 1
+
+	def __init__(self, path):
+		"""
+		Create a Fixture object
+
+		:param path: A string containing the path to the fixture file
+		"""
+		self.path = path
+		self.lock = threading.Lock()
+		self.f = None
+
+	def close(self):
+		"""
+		Close the fixture file if open for writing
+
+		:return:
+		"""
+		if self.f is not None:
+			self.f.close()
+			self.f = None
+
+	def read(self):
+		"""
+		Read all events from the fixture file
+
+		:return: A list of hash arrays, one per recorded event
+		"""
+		events = []
+		try:
+			f = open(self.path, "r")
+		except IOError as e:
+			cziso.abort("Unable to open fixture %s: %s" % (self.path, str(e)))
+		for line in f:
+			if line.strip():
+				events.append(json.loads(line))
+		f.close()
+		if not events or events[0].get("type") != "header":
+			cziso.abort("%s is not a cziso fixture file" % self.path)
+		if events[0]["version"] != Fixture.VERSION:
+			cziso.abort("Unsupported fixture version %s" % events[0]["version"])
+		return events[1:]
+
+	def write(self, event):
+		"""
+		Append an event to the fixture file and flush it to disk
+
+		:param event: A hash array containing the event
+
+		:return:
+		"""
+		self.lock.acquire()
+		try:
+			if self.f is None:
+				self.f = open(self.path, "w")
+				self.f.write(json.dumps({
+					"type": "header", "version": Fixture.VERSION,
+					"argv": sys.argv, "time": cziso.get_current_time_string()
+				}) + "\n")
+			self.f.write(json.dumps(event) + "\n")
+			self.f.flush()
+		finally:
+			self.lock.release()
+
+
+class Recorder:
+	"""
+	Command backend that runs the real commands and records each call, its
+	output and its duration to a fixture file
+	"""
+	def __init__(self, path):
+		"""
+		Create a Recorder object
+
+		:param path: A string containing the path of the fixture to write
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.fixture = Fixture(path)
+		self.next_handle = 0
+		self.handle_lock = threading.Lock()
+
+	def call(self, cmdline, execute):
+		"""
+		Run and record an interactive command
+
+		:param cmdline: A string containing the Bash command to run
+		:param execute: The function that actually runs the command
+
+		:return: The exit code of the command
+		"""
+		start = time.time()
+		rc = execute(cmdline)
+		self.fixture.write({
+			"type": "call", "cmdline": cmdline, "rc": rc,
+			"duration": time.time() - start})
+		return rc
+
+	def close(self):
+		"""
+		Finish recording
+
+		:return:
+		"""
+		self.fixture.close()
+		self.logger.info("Recorded fixture to %s" % self.fixture.path)
+
+	def new_handle(self):
+		"""
+		Allocate an id for a recorded libvirt object
+
+		:return: An integer id
+		"""
+		self.handle_lock.acquire()
+		try:
+			self.next_handle += 1
+			return self.next_handle
+		finally:
+			self.handle_lock.release()
+
+	def run(self, cmdline, input_string, execute):
+		"""
+		Run and record a command
+
+		:param cmdline: A string array containing the command and its args
+		:param input_string: A string containing input for command
+		:param execute: The function that actually runs the command
+
+		:return: The stdout as a string array and exit code
+		"""
+		start = time.time()
+		out, rc = execute(cmdline, input_string)
+		self.fixture.write({
+			"type": "run", "cmdline": cmdline, "input": input_string,
+			"out": out, "rc": rc, "duration": time.time() - start})
+		return out, rc
+
+	def wrap_libvirt(self, libvirt_module):
+		"""
+		Wrap the libvirt module so that all calls through it are recorded
+
+		:param libvirt_module: The real libvirt module
+
+		:return: A proxy for the libvirt module
+		"""
+		return RecordingProxy(self, libvirt_module, 0)
+
+
+class RecordingProxy:
+	"""
+	Proxy for a libvirt object that records every method call and attribute
+	lookup made through it
+	"""
+	SIMPLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+	def __init__(self, recorder, target, handle):
+		self._recorder = recorder
+		self._target = target
+		self._handle = handle
+
+	def __getattr__(self, name):
+		attr = getattr(self._target, name)
+		if isinstance(attr, type) and issubclass(attr, BaseException):
+			return attr
+		if not callable(attr):
+			self._recorder.fixture.write({
+				"type": "libvirt_attr", "handle": self._handle, "name": name,
+				"value": self._encode(attr)})
+			return attr
+
+		def recorded_call(*args):
+			event = {
+				"type": "libvirt", "handle": self._handle, "name": name,
+				"args": [self._encode(a) for a in args]}
+			start = time.time()
+			try:
+				result = attr(*args)
+			except Exception as e:
+				event["error"] = str(e)
+				event["duration"] = time.time() - start
+				self._recorder.fixture.write(event)
+				raise
+			event["duration"] = time.time() - start
+			if isinstance(result, RecordingProxy.SIMPLE_TYPES) or \
+				isinstance(result, (list, tuple)):
+				event["result"] = self._encode(result)
+			else:
+				handle = self._recorder.new_handle()
+				event["result"] = {"handle": handle}
+				result = RecordingProxy(self._recorder, result, handle)
+			self._recorder.fixture.write(event)
+			return result
+		return recorded_call
+
+	def _encode(self, value):
+		"""
+		Convert a value to something that can be stored in JSON
+		"""
+		if isinstance(value, RecordingProxy):
+			return {"handle": value._handle}
+		if isinstance(value, (list, tuple)):
+			return [self._encode(v) for v in value]
+		if isinstance(value, RecordingProxy.SIMPLE_TYPES):
+			return value
+		return repr(value)
+
+
+class Replayer:
+	"""
+	Command backend that serves commands and libvirt calls from a fixture
+	file instead of running them.  Durations are replayed scaled by the
+	specified factor (0 replays as fast as possible).
+	"""
+	# Parts of command lines that differ between runs: the <date>-<pid>
+	# unique id in temp names and the random suffix of mkdtemp directories
+	VOLATILE = [
+		(re.compile(r"\b\d{8}-\d+\b"), "<date>-<pid>"),
+		(re.compile(r"\b(cziso-[a-z]+-)[a-z0-9_]{6}\b"), r"\1<tmp>"),
+	]
+
+	def __init__(self, path, scale=1.0):
+		"""
+		Create a Replayer object
+
+		:param path: A string containing the path of the fixture to replay
+		:param scale: A float to multiply recorded durations by
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.path = path
+		self.scale = scale
+		self.lock = threading.Lock()
+		self.commands = []
+		self.libvirt_calls = []
+		# (handle, method name) of every recorded libvirt call
+		self.libvirt_methods = set()
+		self.libvirt_attrs = {}
+		for event in Fixture(path).read():
+			if event["type"] in ("run", "call"):
+				self.commands.append(event)
+			elif event["type"] == "libvirt":
+				self.libvirt_calls.append(event)
+				self.libvirt_methods.add((event["handle"], event["name"]))
+			elif event["type"] == "libvirt_attr":
+				key = (event["handle"], event["name"])
+				self.libvirt_attrs[key] = event["value"]
+		self.logger.info("Replaying %i commands and %i libvirt calls from %s" % (
+			len(self.commands), len(self.libvirt_calls), path))
+
+	def _sleep(self, event):
+		"""
+		Wait for the scaled duration of the recorded event
+		"""
+		if self.scale > 0:
+			time.sleep(event["duration"] * self.scale)
+
+	@staticmethod
+	def _normalize(cmdline):
+		"""
+		Replace the parts of a command line that differ between runs with
+		placeholders
+
+		:param cmdline: A list of strings containing the command line
+
+		:return: A string containing the normalized command line
+		"""
+		normalized = " ".join(cmdline)
+		for pattern, placeholder in Replayer.VOLATILE:
+			normalized = pattern.sub(placeholder, normalized)
+		return normalized
+
+	def _take_command(self, event_type, cmdline):
+		"""
+		Find and consume the first recorded command that matches cmdline.
+		Only the parts listed in VOLATILE may differ from the recording.
+
+		:return: A hash array containing the recorded event
+		"""
+		normalized = Replayer._normalize(cmdline)
+		self.lock.acquire()
+		try:
+			for i, event in enumerate(self.commands):
+				if event["type"] != event_type:
+					continue
+				recorded = event["cmdline"]
+				if event["type"] == "call":
+					recorded = recorded.split()
+				if Replayer._normalize(recorded) == normalized:
+					return self.commands.pop(i)
+			cziso.abort("No recorded output for command '%s' in %s" % (
+				" ".join(cmdline), self.path))
+		finally:
+			self.lock.release()
+
+	def call(self, cmdline, execute):
+		"""
+		Replay an interactive command
+
+		:param cmdline: A string containing the Bash command to run
+		:param execute: The function that would actually run the command
+
+		:return: The recorded exit code of the command
+		"""
+		event = self._take_command("call", cmdline.split())
+		self._sleep(event)
+		return event["rc"]
+
+	def close(self):
+		"""
+		Finish replaying and report any recorded calls that were not used
+
+		:return:
+		"""
+		if self.commands or self.libvirt_calls:
+			self.logger.warning(
+				"%i commands and %i libvirt calls in %s were not replayed" % (
+					len(self.commands), len(self.libvirt_calls), self.path))
+
+	def run(self, cmdline, input_string, execute):
+		"""
+		Replay a command
+
+		:param cmdline: A string array containing the command and its args
+		:param input_string: A string containing input for command
+		:param execute: The function that would actually run the command
+
+		:return: The recorded stdout as a string array and exit code
+		"""
+		event = self._take_command("run", cmdline)
+		self._sleep(event)
+		return event["out"], event["rc"]
+
+	def take_libvirt_call(self, handle, name):
+		"""
+		Find and consume the next recorded libvirt call of the named method
+		on the specified object
+
+		:return: A hash array containing the recorded event
+		"""
+		self.lock.acquire()
+		try:
+			for i, event in enumerate(self.libvirt_calls):
+				if event["handle"] == handle and event["name"] == name:
+					return self.libvirt_calls.pop(i)
+		finally:
+			self.lock.release()
+		cziso.abort("No recorded libvirt call %s in %s" % (name, self.path))
+
+	def wrap_libvirt(self, libvirt_module):
+		"""
+		Return a stand-in for the libvirt module that serves recorded calls
+
+		:param libvirt_module: The real libvirt module (may be None)
+
+		:return: A proxy for the libvirt module
+		"""
+		return ReplayProxy(self, 0)
+
+
+class ReplayError(Exception):
+	"""
+	Raised when a replayed libvirt call had raised an error when recorded
+	"""
+	pass
+
+
+class ReplayProxy:
+	"""
+	Stand-in for a libvirt object that serves recorded calls
+	"""
+	libvirtError = ReplayError
+
+	def __init__(self, replayer, handle):
+		self._replayer = replayer
+		self._handle = handle
+
+	def __getattr__(self, name):
+		key = (self._handle, name)
+		if key in self._replayer.libvirt_attrs:
+			return self._replayer.libvirt_attrs[key]
+		if key not in self._replayer.libvirt_methods:
+			# also lets hasattr and getattr with a default work as usual
+			raise AttributeError("libvirt attribute %s is not in recording %s"
+				% (name, self._replayer.path))
+
+		def replayed_call(*args):
+			event = self._replayer.take_libvirt_call(self._handle, name)
+			self._replayer._sleep(event)
+			if "error" in event:
+				raise ReplayError(event["error"])
+			return self._decode(event["result"])
+		return replayed_call
+
+	def _decode(self, value):
+		"""
+		Convert a recorded value back to a Python value
+		"""
+		if isinstance(value, dict) and "handle" in value:
+			return ReplayProxy(self._replayer, value["handle"])
+		if isinstance(value, list):
+			return [self._decode(v) for v in value]
+		return value
+
+
+def install(backend):
+	"""
+	Send all external commands and libvirt calls through the specified
+	Recorder or Replayer
+
+	:param backend: An object of type Recorder or Replayer
+
+	:return:
+	"""
+	import cziso.virtualmachine
+	cziso.command_backend = backend
+	cziso.virtualmachine.libvirt = backend.wrap_libvirt(
+		cziso.virtualmachine.libvirt)
+
+
+def uninstall(backend):
+	"""
+	Stop sending external commands and libvirt calls through the backend
+
+	:param backend: An object of type Recorder or Replayer
+
+	:return:
+	"""
+	import cziso.virtualmachine
+	cziso.command_backend = None
+	cziso.virtualmachine.libvirt = cziso.virtualmachine.libvirt_module
+	backend.close()
@@ -1,24 +1,225 @@
 import cziso
-import libvirt
 import logging
 import os
-import subprocess
+import re
+import threading
 import time
 from xml.etree import ElementTree as ET
 
+try:
+	import libvirt
+except ImportError:
+	libvirt = None
+# the real libvirt module in case libvirt is replaced by cziso.replay
+libvirt_module = libvirt
+
+URI = "qemu:///session"
+# libvirt connections shared by all VM objects, by URI
+_connections = {}
+_connections_lock = threading.Lock()
+# domain states reported by lifecycle events, by domain name, as tuples of
+# the state and the time of the event
+_domain_states = {}
+_domain_states_cond = threading.Condition()
+_event_loop = None
+
+
+def _lifecycle_event(conn, dom, event, detail, opaque):
+	"""
+	Record the new state of a domain from a libvirt lifecycle event
+
+	:param conn: The libvirt connection
+	:param dom: The libvirt domain
+	:param event: An integer containing the lifecycle event type
+	:param detail: An integer containing the event detail
+	:param opaque: Unused
+	"""
+	states = {
+		libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+		libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+		libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+		libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+		libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: libvirt.VIR_DOMAIN_SHUTDOWN
+	}
+	# guest crashes are STOPPED events with a CRASHED or FAILED detail; newer
+	# libvirt (>= 1.1.1) also has a CRASHED event for guest panics
+	crashed_event = getattr(libvirt, "VIR_DOMAIN_EVENT_CRASHED", None)
+	if crashed_event is not None:
+		states[crashed_event] = libvirt.VIR_DOMAIN_CRASHED
+	if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail in (
+		getattr(libvirt, "VIR_DOMAIN_EVENT_STOPPED_CRASHED", 2),
+		getattr(libvirt, "VIR_DOMAIN_EVENT_STOPPED_FAILED", 5)):
+		state = libvirt.VIR_DOMAIN_CRASHED
+	else:
+		state = states.get(event)
+	_domain_states_cond.acquire()
+	try:
+		if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+			_domain_states.pop(dom.name(), None)
+		elif state is not None:
+			_domain_states[dom.name()] = (state, time.time())
+		_domain_states_cond.notify_all()
+	finally:
+		_domain_states_cond.release()
+
+
+def _record_state(name, state):
+	"""
+	Record a domain state read from libvirt, e.g. when its lifecycle event
+	was missed, so that later lookups do not return a stale state
+
+	:param name: A string containing the domain name
+	:param state: An integer containing the libvirt domain state
+	"""
+	_domain_states_cond.acquire()
+	try:
+		_domain_states[name] = (state, time.time())
+		_domain_states_cond.notify_all()
+	finally:
+		_domain_states_cond.release()
+
+
+def _forget_state(name):
+	"""
+	Drop the event state of a domain so that libvirt is asked until the next
+	lifecycle event arrives
+
+	:param name: A string containing the domain name
+	"""
+	_domain_states_cond.acquire()
+	try:
+		_domain_states.pop(name, None)
+	finally:
+		_domain_states_cond.release()
+
+
+def _run_event_loop():
+	"""
+	Dispatch libvirt events forever (run in a daemon thread)
+	"""
+	while True:
+		libvirt.virEventRunDefaultImpl()
+
+
+def _start_event_loop():
+	"""
+	Register the default libvirt event implementation and start dispatching
+	events in a daemon thread.  Must be called before opening connections.
+
+	:return: True if lifecycle events are available; otherwise False (e.g.,
+	when libvirt calls are recorded or replayed)
+	"""
+	global _event_loop
+	if _event_loop is not None:
+		return True
+	if libvirt is not libvirt_module or \
+		not hasattr(libvirt, "virEventRegisterDefaultImpl"):
+		return False
+	try:
+		libvirt.virEventRegisterDefaultImpl()
+	except libvirt.libvirtError as e:
+		logging.getLogger(__name__).debug(
+			"libvirt events not available: %s" % str(e))
+		return False
+	_event_loop = threading.Thread(target=_run_event_loop, name="libvirt-events")
+	_event_loop.daemon = True
+	_event_loop.start()
+	return True
+
+
+def get_connection(uri=URI):
+	"""
+	Get the libvirt connection to the URI shared by all VM objects, opening
+	it (and registering for domain lifecycle events) on first use or if the
+	previous connection died
+
+	:param uri: A string containing the libvirt URI
+
+	:return: An object of type libvirt.virConnect
+	"""
+	if libvirt is None:
+		cziso.abort("Missing libvirt Python module")
+	_connections_lock.acquire()
+	try:
+		conn = _connections.get(uri)
+		if conn is not None:
+			try:
+				if conn.isAlive():
+					return conn
+			except AttributeError:
+				# libvirt < 0.9.8 has no isAlive
+				return conn
+			except Exception:
+				pass
+			logging.getLogger(__name__).debug("Reopening connection to %s" % uri)
+		events = _start_event_loop()
+		conn = libvirt.open(uri)
+		if events:
+			conn.domainEventRegisterAny(
+				None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _lifecycle_event,
+				None)
+		_connections[uri] = conn
+		return conn
+	finally:
+		_connections_lock.release()
+
 
 class VM:
 	"""
 	Convenience class for booting Clonezilla VMs
 	"""
+	# max seconds between checks of libvirt while waiting for lifecycle
+	# events, in case an event is missed
+	POLL_INTERVAL = 1
+	# max seconds to wait for the event of a stop found by asking libvirt,
+	# which gives the exact stop time
+	EVENT_GRACE = 0.5
+	# max seconds to reuse a state asked from libvirt when no lifecycle
+	# event was received (e.g., events are not supported)
+	STATE_TTL = 1
 
 	def __init__(self):
 		self.clonezilla_vm_obj = None
 		self.logger = logging.getLogger(self.__module__)
 		self.virConnect_obj = None
+		self.name = None
+		# domain XML and the domain state it was read in
+		self.xml_root = None
+		self.xml_state = None
+		# last state asked from libvirt and when
+		self.polled_state = None
+		self.polled_time = None
+		# times the VM was started and powered off
+		self.start_time = None
+		self.stop_time = None
+
+	def attach_disks(self, disk_xmls):
+		"""
+		Hot-plug disks into the running VM
+
+		:param disk_xmls: A list of strings containing the disk XML (e.g.,
+		from LibvirtFile.get_disk_xmls)
+
+		:return: True if successful; otherwise False
+		"""
+		attached = []
+		for disk_xml in disk_xmls:
+			try:
+				self.clonezilla_vm_obj.attachDeviceFlags(
+					disk_xml, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+			except Exception as e:
+				self.logger.error("Unable to attach disk to VM %s: %s" % (
+					self.get_name(), str(e)))
+				self.detach_disks(attached)
+				return False
+			attached.append(disk_xml)
+		self.xml_root = None
+		self.logger.debug("Attached %i disks to VM %s" % (
+			len(attached), self.get_name()))
+		return True
 
 	def attach_vnc(self):
-		subprocess.call("vncviewer localhost::%s" % self.get_vnc_port(), shell=True)
+		cziso.call_command("vncviewer localhost::%s" % self.get_vnc_port())
 
 	def clean(self):
 		"""
@@ -27,12 +228,7 @@ class VM:
 		:return: Returns if successful; otherwise aborts
 		"""
 		self.logger.debug("Cleaning up VM instance %s" % self.get_name())
-		dom0 = self.virConnect_obj.lookupByName(self.get_name())
-		if dom0 is None:
-			self.logger.debug("VM already destroyed")
-			return True
-		status = dom0.info()[0]
-		if status == libvirt.VIR_DOMAIN_RUNNING:
+		if self.get_state(refresh=True) == libvirt.VIR_DOMAIN_RUNNING:
 			try:
 				self.clonezilla_vm_obj.destroy()
 			except Exception as e:
@@ -40,17 +236,86 @@ class VM:
 				return False
 		else:
 			self.logger.debug("VM instance already shutdown")
-		self.clonezilla_vm_obj.undefine()
+		try:
+			self.clonezilla_vm_obj.undefine()
+		except Exception as e:
+			self.logger.debug("VM already undefined: %s" % str(e))
+		self.xml_root = None
+		self.polled_state = None
+		_forget_state(self.get_name())
 		return True
 
+	def detach_disks(self, disk_xmls):
+		"""
+		Hot-unplug disks from the running VM
+
+		:param disk_xmls: A list of strings containing the disk XML used to
+		attach the disks
+
+		:return: True if successful; otherwise False
+		"""
+		success = True
+		for disk_xml in disk_xmls:
+			try:
+				self.clonezilla_vm_obj.detachDeviceFlags(
+					disk_xml, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+			except Exception as e:
+				self.logger.error("Unable to detach disk from VM %s: %s" % (
+					self.get_name(), str(e)))
+				success = False
+		self.xml_root = None
+		return success
+
 	def get_name(self):
 		"""
 		Get the name of the VM instance
 
 		:return: A string containing the name of the VM instance
 		"""
-		root = self.get_xml()
-		return root.find("name").text
+		if self.name is None:
+			self.name = self.clonezilla_vm_obj.name()
+		return self.name
+
+	def _get_event_state(self):
+		"""
+		Get the state of the VM instance reported by the lifecycle events
+
+		:return: A tuple containing the libvirt domain state and the time of
+		the event or None if no event was received
+		"""
+		_domain_states_cond.acquire()
+		try:
+			return _domain_states.get(self.get_name())
+		finally:
+			_domain_states_cond.release()
+
+	def get_state(self, refresh=False):
+		"""
+		Get the state of the VM instance from the lifecycle events or ask
+		libvirt if no event was received.  A state asked from libvirt is
+		reused for up to VM.STATE_TTL seconds.
+
+		:param refresh: If True, always ask libvirt
+
+		:return: An integer containing the libvirt domain state (e.g.,
+		VIR_DOMAIN_RUNNING)
+		"""
+		if not refresh:
+			entry = self._get_event_state()
+			if entry is not None:
+				return entry[0]
+			if self.polled_state is not None and \
+				time.time() - self.polled_time < VM.STATE_TTL:
+				return self.polled_state
+		try:
+			state = self.clonezilla_vm_obj.info()[0]
+		except Exception as e:
+			self.logger.debug("Unable to get state of VM: %s" % str(e))
+			self.polled_state = None
+			return libvirt.VIR_DOMAIN_NOSTATE
+		self.polled_state = state
+		self.polled_time = time.time()
+		return state
 
 	def get_vnc_port(self):
 		"""
@@ -66,14 +331,26 @@ class VM:
 
 	def get_xml(self):
 		"""
-		Get the XML from VM instance
+		Get the XML from VM instance.  The XML is cached until the domain
+		state changes or its devices are changed.
 
 		:return:  An ElementTree object
 		"""
-		# get the XML description of the VM
-		vm_xml = self.clonezilla_vm_obj.XMLDesc(0)
-		root = ET.fromstring(vm_xml)
-		return root
+		state = self.get_state()
+		if self.xml_root is None or state != self.xml_state:
+			# get the XML description of the VM
+			vm_xml = self.clonezilla_vm_obj.XMLDesc(0)
+			self.xml_root = ET.fromstring(vm_xml)
+			self.xml_state = state
+		return self.xml_root
+
+	def is_running(self):
+		"""
+		Check whether the VM instance is running
+
+		:return: True if running; otherwise False
+		"""
+		return self.get_state() == libvirt.VIR_DOMAIN_RUNNING
 
 	def launch(self, libvirt_xml, **kwargs):
 		"""
@@ -84,9 +361,363 @@ class VM:
 
 		:return: Returns 0 on success; otherwise non-zero
 		"""
-		self.virConnect_obj = libvirt.open("qemu:///session")
+		self.virConnect_obj = get_connection()
 		self.clonezilla_vm_obj = self.virConnect_obj.defineXML(libvirt_xml)
-		return self.clonezilla_vm_obj.create()
+		self.name = self.clonezilla_vm_obj.name()
+		self.xml_root = None
+		self.polled_state = None
+		_forget_state(self.name)
+		status = self.clonezilla_vm_obj.create()
+		self.start_time = time.time()
+		self.stop_time = None
+		return status
+
+	def get_runtime(self):
+		"""
+		Get how long the VM instance ran
+
+		:return: A float containing the seconds from launch to power off (or
+		until now if still running) or None if not launched by this object
+		"""
+		if self.start_time is None:
+			return None
+		return (self.stop_time or time.time()) - self.start_time
+
+	def _wait_for_event(self, states, timeout):
+		"""
+		Wait for a lifecycle event that puts the VM instance in one of the
+		states
+
+		:param states: A tuple of integers containing libvirt domain states
+		:param timeout: A float containing the max seconds to wait
+
+		:return: A tuple containing the domain state and the time of the
+		event or None if no such event arrived
+		"""
+		if _event_loop is None:
+			time.sleep(timeout)
+			return None
+		deadline = time.time() + timeout
+		name = self.get_name()
+		_domain_states_cond.acquire()
+		try:
+			while True:
+				entry = _domain_states.get(name)
+				if entry is not None and entry[0] in states:
+					return entry
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return None
+				_domain_states_cond.wait(remaining)
+		finally:
+			_domain_states_cond.release()
+
+	def wait_for_shutdown(self, timeout):
+		"""
+		Wait for the guest to power off.  The lifecycle events wake this up
+		as soon as the domain stops and give the exact stop time; libvirt is
+		also asked every VM.POLL_INTERVAL seconds in case an event is missed.
+
+		:param timeout: An integer containing the max seconds to wait
+
+		:return: True if the guest powered off; False if it crashed or did
+		not power off before the timeout
+		"""
+		stopped = (libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED)
+		deadline = time.time() + timeout
+		name = self.get_name()
+		entry = self._get_event_state()
+		if entry is not None and entry[0] in stopped:
+			state, stop_time = entry
+		else:
+			stop_time = None
+			# time of the last check that found the guest still running
+			running_time = None
+			state = self.get_state(refresh=True)
+			checked = time.time()
+			while state not in stopped:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				entry = self._wait_for_event(
+					stopped, min(remaining, VM.POLL_INTERVAL))
+				if entry is not None:
+					state, stop_time = entry
+					break
+				running_time = checked
+				state = self.get_state(refresh=True)
+				checked = time.time()
+		if state not in stopped:
+			self.logger.warning("VM %s did not power off within %i seconds" % (
+				name, timeout))
+			return False
+		if stop_time is None and _event_loop is not None:
+			# the event may still be on its way
+			entry = self._wait_for_event(stopped, VM.EVENT_GRACE)
+			if entry is not None:
+				state, stop_time = entry
+		accuracy = ""
+		if stop_time is None:
+			# no lifecycle event; the guest stopped between two checks
+			_record_state(name, state)
+			stop_time = checked
+			if running_time is None:
+				accuracy = " (or less; no lifecycle event)"
+			else:
+				accuracy = " (+/- %.1f; no lifecycle event)" % (
+					checked - running_time)
+		self.stop_time = stop_time
+		runtime = self.get_runtime()
+		if runtime is not None:
+			self.logger.info("VM %s %s after %.1f seconds%s" % (
+				name, "crashed" if state == libvirt.VIR_DOMAIN_CRASHED
+				else "powered off", runtime, accuracy))
+		return state == libvirt.VIR_DOMAIN_SHUTOFF
+
+	def lookup(self, name):
+		"""
+		Find an existing VM instance (e.g., one launched by another cziso
+		process)
+
+		:param name: A string containing the name of the VM instance
+
+		:return: True if found; otherwise False
+		"""
+		self.virConnect_obj = get_connection()
+		try:
+			self.clonezilla_vm_obj = self.virConnect_obj.lookupByName(name)
+		except Exception as e:
+			self.logger.debug("Unable to find VM %s: %s" % (name, str(e)))
+			return False
+		self.name = name
+		self.xml_root = None
+		self.polled_state = None
+		return True
+
+
+class VMProfile:
+	"""
+	Convenience class for the resources (vCPUs, memory, hugepages, CPU pinning
+	and NUMA placement) of a Clonezilla or test VM.  Profiles are read from
+	[vm_profile_<name>] sections of the config file.
+	"""
+	SECTION_PREFIX = "vm_profile_"
+	DEFAULTS = {
+		"vcpus": "1",
+		"memory": "1024",
+		"hugepages": "false",
+		"cpuset": "",
+		"numa_nodeset": "",
+		"numa_mode": "strict",
+		"machine": "rhel6.6.0"
+	}
+	NUMA_MODES = ["strict", "preferred", "interleave"]
+
+	def __init__(self, name, **settings):
+		"""
+		Create a VMProfile object
+
+		:param name: A string containing the name of the profile
+		:param settings: key/value settings overriding VMProfile.DEFAULTS
+		"""
+		values = dict(VMProfile.DEFAULTS)
+		values.update(settings)
+		self.name = name
+		try:
+			self.vcpus = int(values["vcpus"])
+			self.memory = int(values["memory"])
+		except ValueError:
+			cziso.abort("VM profile %s: vcpus and memory must be integers" %
+				name)
+		if self.vcpus < 1 or self.memory < 1:
+			cziso.abort("VM profile %s: vcpus and memory must be positive" %
+				name)
+		self.hugepages = values["hugepages"].lower() in ["true", "yes", "1"]
+		self.cpus = VMProfile.parse_cpuset(values["cpuset"])
+		self.numa_nodeset = values["numa_nodeset"]
+		self.numa_mode = values["numa_mode"]
+		if self.numa_mode not in VMProfile.NUMA_MODES:
+			cziso.abort("VM profile %s: numa_mode must be one of %s" % (
+				name, ", ".join(VMProfile.NUMA_MODES)))
+		self.machine = values["machine"]
+
+	def __str__(self):
+		"""
+		Returns a short description of the profile
+
+		:return: A string describing the profile
+		"""
+		return "%s (%i vCPUs, %i MiB)" % (self.name, self.vcpus, self.memory)
+
+	@staticmethod
+	def load(config, name, required=True):
+		"""
+		Read a profile from the config file
+
+		:param config: An object of type cziso.CzisoConfig
+		:param name: A string containing the name of the profile
+		:param required: If False, a missing profile section is not an error
+		and the built-in defaults are used
+
+		:return: An object of type VMProfile
+		"""
+		section = VMProfile.SECTION_PREFIX + name
+		if not config.has_section(section):
+			if required:
+				cziso.abort("VM profile %s not found; add a [%s] section to %s"
+					% (name, section, config.config_file))
+			return VMProfile(name)
+		settings = dict(config.items(section))
+		unknown = [k for k in settings if k not in VMProfile.DEFAULTS]
+		if unknown:
+			cziso.abort("Unknown settings in [%s]: %s" % (
+				section, ", ".join(sorted(unknown))))
+		return VMProfile(name, **settings)
+
+	@staticmethod
+	def parse_cpuset(cpuset):
+		"""
+		Expand a cpuset string like 2-5,8 into a list of host CPUs
+
+		:param cpuset: A string containing comma separated CPUs and ranges
+
+		:return: A list of integers containing the host CPUs
+		"""
+		cpus = []
+		for item in [i.strip() for i in cpuset.split(",") if i.strip()]:
+			matcher = re.match("^(\d+)(?:-(\d+))?$", item)
+			if matcher is None:
+				cziso.abort("Invalid cpuset %s" % cpuset)
+			first = int(matcher.group(1))
+			last = int(matcher.group(2) or first)
+			cpus.extend(range(first, last + 1))
+		return cpus
+
+	def get_tuning_xml(self, vcpus):
+		"""
+		Get the libvirt memoryBacking, cputune and numatune elements
+
+		:param vcpus: An integer containing the number of vCPUs of the VM,
+		which may exceed the profile vCPUs (e.g., for parallel compression)
+
+		:return: A string containing the XML elements
+		"""
+		xml = []
+		if self.hugepages:
+			xml.append("<memoryBacking>\n    <hugepages/>\n  </memoryBacking>")
+		if self.cpus:
+			# pin vCPUs 1:1 to the listed CPUs, wrapping if there are fewer
+			pins = ["    <vcpupin vcpu='%i' cpuset='%i'/>" % (
+				vcpu, self.cpus[vcpu % len(self.cpus)]) for vcpu in range(vcpus)]
+			xml.append("<cputune>\n%s\n  </cputune>" % "\n".join(pins))
+		if self.numa_nodeset:
+			xml.append(
+				"<numatune>\n    <memory mode='%s' nodeset='%s'/>\n  </numatune>"
+				% (self.numa_mode, self.numa_nodeset))
+		return "\n  ".join(xml)
+
+
+class DiskIO:
+	"""
+	Convenience class for the I/O settings of a VM disk (cache and io mode,
+	discard, zero detection, iothreads, queues and virtio-blk or virtio-scsi
+	bus).  Empty settings are left to the libvirt/qemu defaults.
+	"""
+	DEFAULTS = {
+		"cache": "",
+		"io": "",
+		"discard": "",
+		"detect_zeroes": "",
+		"iothreads": "0",
+		"queues": "0",
+		"bus": "virtio"
+	}
+	CHOICES = {
+		"cache": ["", "none", "writethrough", "writeback", "directsync",
+			"unsafe"],
+		"io": ["", "native", "threads"],
+		"discard": ["", "unmap", "ignore"],
+		"detect_zeroes": ["", "off", "on", "unmap"],
+		"bus": ["virtio", "scsi"]
+	}
+	# target device prefix of each bus
+	DEVICE_PREFIXES = {"virtio": "vd", "scsi": "sd"}
+
+	def __init__(self, **settings):
+		"""
+		Create a DiskIO object
+
+		:param settings: key/value settings overriding DiskIO.DEFAULTS
+		"""
+		values = dict(DiskIO.DEFAULTS)
+		values.update(settings)
+		unknown = [k for k in values if k not in DiskIO.DEFAULTS]
+		if unknown:
+			cziso.abort("Unknown disk I/O settings: %s" % ", ".join(
+				sorted(unknown)))
+		for key, choices in DiskIO.CHOICES.items():
+			if values[key] not in choices:
+				cziso.abort("Disk I/O setting %s must be one of %s" % (
+					key, ", ".join([c for c in choices if c])))
+		try:
+			self.iothreads = int(values["iothreads"])
+			self.queues = int(values["queues"])
+		except ValueError:
+			cziso.abort("Disk I/O settings iothreads and queues must be integers")
+		if values["detect_zeroes"] == "unmap" and values["discard"] != "unmap":
+			cziso.abort("Disk I/O setting detect_zeroes=unmap requires "
+				"discard=unmap")
+		self.cache = values["cache"]
+		self.io = values["io"]
+		self.discard = values["discard"]
+		self.detect_zeroes = values["detect_zeroes"]
+		self.bus = values["bus"]
+
+	def __str__(self):
+		"""
+		Returns a short description of the settings
+
+		:return: A string describing the settings
+		"""
+		settings = ["%s=%s" % (k, getattr(self, k)) for k in sorted(
+			DiskIO.DEFAULTS.keys()) if str(getattr(self, k)) not in ["", "0"]]
+		return ", ".join(settings)
+
+	def get_device_prefix(self):
+		"""
+		Get the prefix of the disk device names in the VM
+
+		:return: A string containing the prefix (e.g., vd)
+		"""
+		return DiskIO.DEVICE_PREFIXES[self.bus]
+
+	def get_driver_attrs(self, iothread=None):
+		"""
+		Get the attributes of the disk driver element
+
+		:param iothread: An integer containing the iothread of the disk or
+		None
+
+		:return: A string containing the attributes with a leading space
+		"""
+		attrs = ""
+		for key in ["cache", "io", "discard", "detect_zeroes"]:
+			if getattr(self, key):
+				attrs += " %s='%s'" % (key, getattr(self, key))
+		if self.bus == "virtio":
+			if iothread is not None:
+				attrs += " iothread='%i'" % iothread
+			if self.queues > 0:
+				attrs += " queues='%i'" % self.queues
+		return attrs
+
+	def get_target_bus(self):
+		"""
+		Get the bus of the disk target element
+
+		:return: A string containing the bus
+		"""
+		return self.bus
 
 
 class LibvirtFile:
@@ -112,9 +743,15 @@ class LibvirtFile:
 
 		self.disk_xmls = []
 		self.disk_ids = {}
+		self.disk_io = None
+		self.iothreads = 0
+		self.scsi_controller = None
 		self.iface_xml = ""
+		self.profile = VMProfile("default")
+		self.vcpus = self.profile.vcpus
 
-	def add_disk(self, disk_type, device_type, disk, qemu_type="raw"):
+	def add_disk(self, disk_type, device_type, disk, qemu_type="raw",
+	             io=None):
 		"""
 		Add a disk to the libvirt file
 
@@ -122,7 +759,9 @@ class LibvirtFile:
 		:param device_type: A string containing the type of device (disk, cdrom)
 		:param disk: The path to the disk
 		:param qemu_type: A string containing the format of disk (e.g., raw)
-		:return:
+		:param io: A dictionary of DiskIO settings for the disk (e.g., the
+		defaults of its image type); settings from set_disk_io take precedence
+		:return: A string containing the device name in the VM (e.g., vda)
 		"""
 		xml_type = "%s_%s" % (disk_type, device_type)
 		if device_type in self.disk_ids:
@@ -140,7 +779,59 @@ class LibvirtFile:
 			xml_type: os.path.realpath(disk),
 			'qemu_type': qemu_type
 		}
+		if device_type == "disk":
+			settings = dict(io or {})
+			settings.update(self.disk_io or {})
+			disk_io = DiskIO(**settings)
+			self.logger.debug("Disk %s I/O settings: %s" % (disk, disk_io))
+			iothread = None
+			if disk_io.iothreads > 0:
+				# spread the disks over the iothreads
+				self.iothreads = max(self.iothreads, disk_io.iothreads)
+				iothread = (self.disk_ids[device_type] - ord('a')) % \
+					disk_io.iothreads + 1
+			if disk_io.bus == "scsi" and self.scsi_controller is None:
+				self.scsi_controller = LibvirtFile.get_scsi_controller_xml(
+					disk_io, iothread)
+			values.update({
+				'driver_attrs': disk_io.get_driver_attrs(iothread),
+				'device_prefix': disk_io.get_device_prefix(),
+				'bus': disk_io.get_target_bus()
+			})
+			device = "%s%s" % (disk_io.get_device_prefix(), values['id'])
+		else:
+			device = "hd%s" % values['id']
 		self.disk_xmls.append(cziso.fill_template(f, **values))
+		return device
+
+	@staticmethod
+	def get_scsi_controller_xml(disk_io, iothread):
+		"""
+		Get the XML of a virtio-scsi controller
+
+		:param disk_io: An object of type DiskIO
+		:param iothread: An integer containing the iothread of the controller
+		or None
+
+		:return: A string containing the controller XML
+		"""
+		attrs = ""
+		if disk_io.queues > 0:
+			attrs += " queues='%i'" % disk_io.queues
+		if iothread is not None:
+			attrs += " iothread='%i'" % iothread
+		return """    <controller type='scsi' index='0' model='virtio-scsi'>
+      <driver%s/>
+    </controller>""" % attrs
+
+	def get_disk_xmls(self):
+		"""
+		Return the XML of the disks added to the libvirt file (e.g., to
+		hot-plug them into a running VM)
+
+		:return: A list of strings containing the disk XML
+		"""
+		return list(self.disk_xmls)
 
 	def get_name(self):
 		"""
@@ -156,8 +847,25 @@ class LibvirtFile:
 
 		:return:  A string containing the libvirt file
 		"""
+		disks = list(self.disk_xmls)
+		if self.scsi_controller is not None:
+			disks.append(self.scsi_controller)
+		tuning = self.profile.get_tuning_xml(self.vcpus)
+		if self.iothreads > 0:
+			tuning = "<iothreads>%i</iothreads>\n  %s" % (self.iothreads, tuning)
 		return cziso.fill_template(self.libvirt, vm_name = self.name,
-		    disks="\n".join(self.disk_xmls), interface=self.iface_xml)
+		    disks="\n".join(disks), interface=self.iface_xml,
+		    vcpus=self.vcpus, memory=self.profile.memory * 1024,
+		    machine=self.profile.machine, tuning=tuning)
+
+	def set_disk_io(self, settings):
+		"""
+		Set disk I/O settings that override the image type defaults of the
+		disks added afterwards
+
+		:param settings: A dictionary of DiskIO settings
+		"""
+		self.disk_io = settings
 
 	def set_interface(self, iface):
 		"""
@@ -168,5 +876,31 @@ class LibvirtFile:
 		f = os.path.join(self.config_dir, "iface-%s" % LibvirtFile.TEMPLATE_FILE)
 		self.iface_xml = cziso.fill_template(f, iface=iface)
 
+	def set_name(self, name):
+		"""
+		Set the name of the VM instance
+
+		:param name: A string containing the name of the VM instance
+		"""
+		self.name = name
+
+	def set_profile(self, profile):
+		"""
+		Set the resources of the VM from a profile
+
+		:param profile: An object of type VMProfile
+		"""
+		self.logger.debug("Using VM profile %s" % profile)
+		self.profile = profile
+		self.vcpus = profile.vcpus
+
+	def set_vcpus(self, vcpus):
+		"""
+		Set the number of virtual CPUs of the VM
+
+		:param vcpus: An integer containing the number of vCPUs
+		"""
+		self.vcpus = vcpus
+
 
 
@@ -0,0 +1,248 @@
+import cziso
+import cziso.virtualmachine
+import fcntl
+import json
+import logging
+import os
+
+
+class VMPool:
+	"""
+	Convenience class for a pool of booted Clonezilla Live VMs that wait at
+	the console prompt.  Jobs hot-plug their disks into an idle VM instead of
+	booting a new one and return it afterwards.  The pool is kept in a state
+	file in the temp directory so that it is shared by all cziso processes.
+	"""
+	FILENAME = "cziso-vmpool.json"
+	NAME_PREFIX = "cziso-pool"
+
+	def __init__(self, clonezilla):
+		"""
+		Create a VMPool object
+
+		:param clonezilla: An object of type cziso.clonezilla.Clonezilla used
+		to build the libvirt files of the pool VMs
+		"""
+		self.logger = logging.getLogger(self.__module__)
+		self.clonezilla = clonezilla
+		config = clonezilla.config
+		self.path = os.path.join(
+			config.get("cziso", "temp_directory"), VMPool.FILENAME)
+		self.size = int(config.get_default("vm_pool", "size", 0))
+		self.max_jobs = int(config.get_default("vm_pool", "max_jobs", 20))
+
+	def _update(self, function):
+		"""
+		Read, modify and write the state file while holding a lock on it
+
+		:param function: A function that is passed the state hash array and
+		whose return value is returned
+
+		:return: The return value of function
+		"""
+		lock = open("%s.lock" % self.path, "a")
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			state = self._read()
+			result = function(state)
+			tmp = "%s.%i" % (self.path, os.getpid())
+			f = open(tmp, "w")
+			json.dump(state, f, indent=2, sort_keys=True)
+			f.close()
+			os.rename(tmp, self.path)
+			return result
+		finally:
+			lock.close()
+
+	def _read(self):
+		"""
+		Read the state file
+
+		:return: A hash array containing the next VM number and a hash array
+		of VM name to pool entry
+		"""
+		state = {"next_id": 0, "vms": {}}
+		if not os.path.exists(self.path):
+			return state
+		try:
+			f = open(self.path, "r")
+			state = json.load(f)
+			f.close()
+		except ValueError:
+			self.logger.warning("Ignoring corrupt VM pool state %s" % self.path)
+		return state
+
+	def _launch(self, state):
+		"""
+		Boot a new pool VM and add it to the pool
+
+		:param state: The state hash array
+
+		:return: True if successful; otherwise False
+		"""
+		name = "%s-%i" % (VMPool.NAME_PREFIX, state["next_id"])
+		state["next_id"] += 1
+		libvirt_file = self.clonezilla.create_libvirt_file("pool")
+		libvirt_file.set_name(name)
+		libvirt_file.add_disk(
+			"file", "cdrom", self.clonezilla.clonezilla_custom.get_or_download())
+		libvirt_file.set_interface(self.clonezilla.priv_interface)
+		vm = cziso.virtualmachine.VM()
+		if vm.launch(libvirt_file.get_xml()) != 0:
+			self.logger.error("Unable to launch pool VM %s" % name)
+			return False
+		state["vms"][name] = {
+			"jobs": 0, "owner": None, "launched": cziso.get_current_time_string()}
+		self.logger.info("Launched pool VM %s" % name)
+		return True
+
+	def _remove(self, state, name):
+		"""
+		Destroy a pool VM and remove it from the pool
+
+		:param state: The state hash array
+		:param name: A string containing the name of the pool VM
+
+		:return:
+		"""
+		vm = cziso.virtualmachine.VM()
+		if vm.lookup(name):
+			vm.clean()
+		del state["vms"][name]
+		self.logger.info("Removed pool VM %s" % name)
+
+	def acquire(self):
+		"""
+		Take an idle VM from the pool.  Idle VMs that are no longer running
+		and VMs left behind by crashed jobs are replaced.
+
+		:return: An object of type cziso.virtualmachine.VM or None if no VM
+		is idle
+		"""
+		if not os.path.exists(self.path):
+			return None
+
+		def take(state):
+			for name in sorted(state["vms"].keys()):
+				entry = state["vms"][name]
+				if entry.get("retired"):
+					continue
+				if entry["owner"] is not None:
+					if cziso.is_process_alive(entry["owner"]):
+						continue
+					# the job using it died; its disks may still be attached
+					self.logger.warning(
+						"Recycling pool VM %s of dead job %i" % (
+							name, entry["owner"]))
+					self._remove(state, name)
+					self._launch(state)
+					continue
+				vm = cziso.virtualmachine.VM()
+				if not vm.lookup(name) or not vm.is_running():
+					self.logger.warning("Recycling unhealthy pool VM %s" % name)
+					self._remove(state, name)
+					self._launch(state)
+					continue
+				entry["owner"] = os.getpid()
+				return vm
+			return None
+		vm = self._update(take)
+		if vm is None:
+			self.logger.debug("No idle VM in pool")
+		else:
+			self.logger.info("Using pool VM %s" % vm.get_name())
+		return vm
+
+	def is_member(self, vm):
+		"""
+		Check whether a VM belongs to the pool
+
+		:param vm: An object of type cziso.virtualmachine.VM
+
+		:return: True if a pool VM; otherwise False
+		"""
+		return vm.get_name().startswith("%s-" % VMPool.NAME_PREFIX)
+
+	def release(self, vm, healthy=True):
+		"""
+		Return a VM to the pool after its disks were detached.  The VM is
+		replaced by a new one if the job failed or it reached the max jobs.
+
+		:param vm: An object of type cziso.virtualmachine.VM from acquire
+		:param healthy: False if the job failed and the VM may not be usable
+
+		:return:
+		"""
+		name = vm.get_name()
+
+		def give_back(state):
+			entry = state["vms"].get(name)
+			if entry is None:
+				return
+			entry["owner"] = None
+			entry["jobs"] += 1
+			if entry.get("retired"):
+				self._remove(state, name)
+			elif not healthy or entry["jobs"] >= self.max_jobs:
+				self.logger.info("Recycling pool VM %s after %i jobs" % (
+					name, entry["jobs"]))
+				self._remove(state, name)
+				self._launch(state)
+		self._update(give_back)
+
+	def start(self, size=None):
+		"""
+		Boot VMs until the pool has the specified number of VMs
+
+		:param size: An integer containing the number of VMs or None to use
+		the configured size
+
+		:return:
+		"""
+		if size is None:
+			size = self.size
+		if size < 1:
+			cziso.abort("VM pool size must be at least 1")
+
+		def grow(state):
+			while len(state["vms"]) < size:
+				if not self._launch(state):
+					cziso.abort("Unable to start VM pool")
+		self._update(grow)
+
+	def status(self):
+		"""
+		Get the VMs in the pool
+
+		:return: A list of tuples containing the name, state (idle, busy or
+		down) and number of jobs run of each VM
+		"""
+		vms = []
+		for name, entry in sorted(self._read()["vms"].items()):
+			vm = cziso.virtualmachine.VM()
+			if not vm.lookup(name) or not vm.is_running():
+				vm_state = "down"
+			elif entry["owner"] is not None:
+				vm_state = "busy (pid %i)" % entry["owner"]
+			else:
+				vm_state = "idle"
+			vms.append((name, vm_state, entry["jobs"]))
+		return vms
+
+	def stop(self):
+		"""
+		Destroy the idle VMs in the pool; busy VMs are destroyed when their
+		jobs return them
+
+		:return:
+		"""
+		def shrink(state):
+			for name in sorted(state["vms"].keys()):
+				owner = state["vms"][name]["owner"]
+				if owner is not None and cziso.is_process_alive(owner):
+					self.logger.warning(
+						"Pool VM %s is busy; it will be removed when done" % name)
+					state["vms"][name]["retired"] = True
+					continue
+				self._remove(state, name)
+		self._update(shrink)